@@ -1,24 +1,58 @@
-from flask import Flask, request, jsonify, redirect
-import requests
+from flask import Flask, request, jsonify, redirect, Response, stream_with_context, g
 import os
+import secrets
 from dotenv import load_dotenv
 import json
+import atexit
+import time
+from concurrent.futures import wait
 from datetime import datetime
 from flask_cors import CORS
+from graph_client import GraphAPIClient
+from dispatch import OutboundDispatcher, ShardedExecutor, DispatchQueueFull
+from state_store import create_state_store, KeyedLocks
+from session_index import IndexedSessionStore
+from bot_logging import setup_logging, get_logger, log_payload
+from dedup import SeenMessageCache
+from intents import IntentMatcher
+from phones import PhoneNormalizer, is_valid as is_valid_number
+from message_templates import TemplateRegistry, template_payload
+from campaigns import CampaignManager
+from payment_qr import PaymentQRCache, format_amount
+from order_sink import OrderSink, create_backend as create_sink_backend, order_row
+from menu_catalog import MenuCatalog, create_source as create_menu_source, PAGE_PREFIX, ITEM_PREFIX
+from tenants import Tenant, TenantRouter, DEFAULT_TENANT
+from metrics import REGISTRY, FALLBACKS, DUPLICATES, WEBHOOK_LATENCY, PAYMENT_TO_SEND, STORE_SIZE
+from rate_limit import GraphRateLimiter, RateLimitExceeded, rate_limit_code
+from resilience import RetryPolicy, CircuitBreaker, CircuitOpen, CapabilityCache, graph_error_code, MESSAGE_TYPE_ERRORS
+from state_machine import (
+    ConversationMachine, UserState, USER_STATE_CODEC, ORDER_RECEIVED, EDIT, CONFIRM, PAYMENT_COMPLETED
+)
+from eventlog import (
+    EventLog, OrderProjection, ORDER_EDITED, SESSION_CREATED, ORDER_CONFIRMED,
+    ORDER_RECEIVED as EVENT_ORDER_RECEIVED, PAYMENT_COMPLETED as EVENT_PAYMENT_COMPLETED
+)
 
 # Load environment variables
 load_dotenv('Variables.env')
 
+# Logging: JSON lines via a background queue; DEBUG payload dumps are sampled
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json')
+LOG_DEBUG_SAMPLE_RATE = float(os.environ.get('LOG_DEBUG_SAMPLE_RATE', 0.1))
+logger = setup_logging(LOG_LEVEL, LOG_FORMAT, LOG_DEBUG_SAMPLE_RATE)
+
 app = Flask(__name__)
 
 # CORS Configuration
+CORS_ORIGINS = [
+    "https://smitgamer687-byte.github.io",
+    "http://localhost:*",
+    "http://127.0.0.1:*",
+    "https://pay0.shop"
+]
 CORS(app,
-     origins=[
-         "https://smitgamer687-byte.github.io",
-         "http://localhost:*",
-         "http://127.0.0.1:*",
-         "https://pay0.shop"
-     ],
+     origins=CORS_ORIGINS,
      methods=["GET", "POST", "OPTIONS"],
      allow_headers=["Content-Type", "Authorization"],
      supports_credentials=False,
@@ -34,252 +68,632 @@ WEBSITE_URL = os.environ.get('WEBSITE_URL', 'https://chefpal.preview.emergentage
 BASE_PAYMENT_LINK = 'https://pay0.shop/paylink?link=2296&amt='
 SERVER_URL = os.environ.get('SERVER_URL', 'https://whatsapp-order-bot-vj1p.onrender.com')
 
+# Payment QR code sent as an image after the payment link. It encodes the session's own
+# payment link (with the callback), WhatsApp fetches it from /payment/qr?session= while
+# the session is pending; the render starts when the link is sent.
+PAYMENT_QR = os.environ.get('PAYMENT_QR', '1') != '0'
+PAYMENT_QR_TEMPLATE = os.environ.get('PAYMENT_QR_TEMPLATE', BASE_PAYMENT_LINK + '{amount}')
+PAYMENT_QR_CACHE_SIZE = int(os.environ.get('PAYMENT_QR_CACHE_SIZE', 256))
+PAYMENT_QR_WORKERS = int(os.environ.get('PAYMENT_QR_WORKERS', 2))
+PAYMENT_QR_RENDER_TIMEOUT = float(os.environ.get('PAYMENT_QR_RENDER_TIMEOUT', 5))
+
 # WhatsApp API URL
-WHATSAPP_API_URL = f"https://graph.facebook.com/v23.0/{WHATSAPP_PHONE_ID}/messages"
+GRAPH_API_BASE = os.environ.get('GRAPH_API_BASE', 'https://graph.facebook.com/v23.0')
+WHATSAPP_API_URL = f"{GRAPH_API_BASE}/{WHATSAPP_PHONE_ID}/messages"
+
+# Graph API connection pool
+GRAPH_POOL_SIZE = int(os.environ.get('GRAPH_POOL_SIZE', 10))
+GRAPH_CONNECT_TIMEOUT = float(os.environ.get('GRAPH_CONNECT_TIMEOUT', 3.05))
+GRAPH_READ_TIMEOUT = float(os.environ.get('GRAPH_READ_TIMEOUT', 10))
+# The async app's pool (async_app.py) holds no thread per connection, so it can be much larger
+ASYNC_GRAPH_POOL_SIZE = int(os.environ.get('ASYNC_GRAPH_POOL_SIZE', 100))
+
+# Client-side Graph API rate limits (per worker process): business phone throughput and
+# per-recipient pair rate; both slow down further when the API answers 130429/131056
+RATE_LIMIT_MPS = float(os.environ.get('RATE_LIMIT_MPS', 80))
+RATE_LIMIT_RECIPIENT_PER_MINUTE = float(os.environ.get('RATE_LIMIT_RECIPIENT_PER_MINUTE', 10))
+RATE_LIMIT_RECIPIENT_BURST = int(os.environ.get('RATE_LIMIT_RECIPIENT_BURST', 6))
+RATE_LIMIT_MAX_WAIT = float(os.environ.get('RATE_LIMIT_MAX_WAIT', 30))
+
+# Graph API retries (5xx/timeouts, exponential backoff with jitter) and circuit breaker
+GRAPH_RETRY_ATTEMPTS = int(os.environ.get('GRAPH_RETRY_ATTEMPTS', 3))
+GRAPH_RETRY_BASE_DELAY = float(os.environ.get('GRAPH_RETRY_BASE_DELAY', 0.25))
+GRAPH_RETRY_MAX_DELAY = float(os.environ.get('GRAPH_RETRY_MAX_DELAY', 4))
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get('BREAKER_FAILURE_THRESHOLD', 5))
+BREAKER_RESET_TIMEOUT = float(os.environ.get('BREAKER_RESET_TIMEOUT', 30))
+
+# Seconds to send the text fallback directly after the API rejects a CTA/button message
+INTERACTIVE_FAILURE_TTL = float(os.environ.get('INTERACTIVE_FAILURE_TTL', 300))
+# ...and after this many 5xx in a row for one message type
+INTERACTIVE_SERVER_ERRORS = int(os.environ.get('INTERACTIVE_SERVER_ERRORS', 3))
+
+# Conversation/payment state backend: memory, sqlite (shared by gunicorn workers) or redis
+STATE_BACKEND = os.environ.get('STATE_BACKEND', 'memory')
+STATE_DB_PATH = os.environ.get('STATE_DB_PATH', 'bot_state.db')
+REDIS_URL = os.environ.get('REDIS_URL')
+STATE_MAX_ENTRIES = int(os.environ.get('STATE_MAX_ENTRIES', 50000))
+
+# Recently normalized phone numbers kept in an LRU
+PHONE_CACHE_SIZE = int(os.environ.get('PHONE_CACHE_SIZE', 65536))
+
+# Durable event log for order/session state (survives restarts with the memory backend).
+# Needs a persistent disk; one gunicorn worker (process) per directory.
+EVENT_LOG_DIR = os.environ.get('EVENT_LOG_DIR')
+EVENT_LOG_SNAPSHOT_EVERY = int(os.environ.get('EVENT_LOG_SNAPSHOT_EVERY', 5000))
+EVENT_LOG_FSYNC = os.environ.get('EVENT_LOG_FSYNC', '1') != '0'
+# Event data fields naming another record; namespaced per tenant like the event key
+EVENT_REFS = ('order_ref', 'session_id', 'phone')
+
+# Webhook redelivery dedup, keyed on the WhatsApp message id
+DEDUP_TTL = int(os.environ.get('DEDUP_TTL', 24 * 3600))
+DEDUP_MAX_ENTRIES = int(os.environ.get('DEDUP_MAX_ENTRIES', 100000))
+
+# /sessions pagination
+SESSIONS_PAGE_SIZE = int(os.environ.get('SESSIONS_PAGE_SIZE', 100))
+SESSIONS_MAX_PAGE_SIZE = int(os.environ.get('SESSIONS_MAX_PAGE_SIZE', 1000))
+
+# How long (seconds) each conversation/payment stage is kept before it expires
+STAGE_TTLS = {
+    'awaiting_confirmation': int(os.environ.get('TTL_AWAITING_CONFIRMATION', 6 * 3600)),
+    'payment_pending': int(os.environ.get('TTL_PAYMENT_PENDING', 2 * 3600)),
+    'completed': int(os.environ.get('TTL_COMPLETED', 24 * 3600))
+}
+
+# Outbound dispatch (webhooks ack before the Graph API responds)
+DISPATCH_WORKERS = int(os.environ.get('DISPATCH_WORKERS', 8))
+DISPATCH_QUEUE_SIZE = int(os.environ.get('DISPATCH_QUEUE_SIZE', 1000))
+DISPATCH_ENQUEUE_TIMEOUT = float(os.environ.get('DISPATCH_ENQUEUE_TIMEOUT', 2))
+DISPATCH_DRAIN_TIMEOUT = float(os.environ.get('DISPATCH_DRAIN_TIMEOUT', 25))
+
+# Bulk order mode of /webhook/google-sheets ({"orders": [...]})
+BULK_MAX_ORDERS = int(os.environ.get('BULK_MAX_ORDERS', 200))
+BULK_TIME_LIMIT = float(os.environ.get('BULK_TIME_LIMIT', 20))
+
+# Broadcast campaigns: their own worker pool, throttled below the Graph API limit so
+# conversations keep flowing. ADMIN_TOKEN (Bearer) is required to create/control them.
+CAMPAIGN_WORKERS = int(os.environ.get('CAMPAIGN_WORKERS', 4))
+CAMPAIGN_RATE = float(os.environ.get('CAMPAIGN_RATE', 10))
+# Campaign checkpoints and per-recipient markers must outlive a restart (sqlite unless state is shared)
+CAMPAIGN_STATE_BACKEND = os.environ.get('CAMPAIGN_STATE_BACKEND', 'sqlite' if STATE_BACKEND == 'memory' else STATE_BACKEND)
+# One worker runs each campaign; another takes it over this long after that worker stops renewing
+CAMPAIGN_LEASE_TTL = float(os.environ.get('CAMPAIGN_LEASE_TTL', 30))
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+# Payment sessions expire within a day, so source=recent_customers reads a per-customer
+# history kept this many days (in STATE_BACKEND: lost on restart with the memory backend)
+CUSTOMER_HISTORY_DAYS = float(os.environ.get('CUSTOMER_HISTORY_DAYS', 90))
+
+# In-chat menu: a JSON/CSV file or URL (e.g. the sheet published as CSV), re-checked every
+# MENU_REFRESH_INTERVAL seconds; without MENU_SOURCE 'menu' links to WEBSITE_URL as before
+MENU_SOURCE = os.environ.get('MENU_SOURCE', '')
+MENU_REFRESH_INTERVAL = float(os.environ.get('MENU_REFRESH_INTERVAL', 60))
+
+# Completed orders exported in batches: ORDER_SINK = sheets | airtable | memory (off when empty).
+# The buffer is persisted so a restart does not lose unexported orders (sqlite unless state is shared).
+# Each worker leases the rows it buffers; rows of a worker whose lease expired are adopted by the others.
+ORDER_SINK = os.environ.get('ORDER_SINK', '')
+ORDER_SINK_BATCH_SIZE = int(os.environ.get('ORDER_SINK_BATCH_SIZE', 50))
+ORDER_SINK_FLUSH_INTERVAL = float(os.environ.get('ORDER_SINK_FLUSH_INTERVAL', 5))
+ORDER_SINK_STATE_BACKEND = os.environ.get('ORDER_SINK_STATE_BACKEND', 'sqlite' if STATE_BACKEND == 'memory' else STATE_BACKEND)
+ORDER_SINK_LEASE_TTL = float(os.environ.get('ORDER_SINK_LEASE_TTL', 60))
+GOOGLE_SHEETS_KEY = os.environ.get('GOOGLE_SHEETS_KEY')
+GOOGLE_SHEETS_WORKSHEET = os.environ.get('GOOGLE_SHEETS_WORKSHEET', 'Orders')
+GOOGLE_CREDENTIALS_FILE = os.environ.get('GOOGLE_CREDENTIALS_FILE')
+AIRTABLE_API_KEY = os.environ.get('AIRTABLE_API_KEY')
+AIRTABLE_BASE_ID = os.environ.get('AIRTABLE_BASE_ID')
+AIRTABLE_TABLE = os.environ.get('AIRTABLE_TABLE', 'Orders')
+
+# Incoming message lanes (per-customer ordering, cross-customer parallelism)
+MESSAGE_LANES = int(os.environ.get('MESSAGE_LANES', 16))
+MESSAGE_LANE_QUEUE_SIZE = int(os.environ.get('MESSAGE_LANE_QUEUE_SIZE', 200))
+
+# Outbound payloads are pre-serialized templates; slot values use this encoder (auto = orjson if installed)
+JSON_ENCODER = os.environ.get('JSON_ENCODER', 'auto')
+
+# More restaurants in this process: a JSON file of tenants (own number, token, links, limits),
+# re-read when it changes. Webhooks are routed by metadata.phone_number_id.
+TENANTS_FILE = os.environ.get('TENANTS_FILE', '')
+TENANTS_RELOAD_INTERVAL = float(os.environ.get('TENANTS_RELOAD_INTERVAL', 10))
+
+# The restaurant configured by the variables above
+DEFAULT_TENANT_CONFIG = Tenant(
+    DEFAULT_TENANT, WHATSAPP_PHONE_ID, WHATSAPP_TOKEN, WEBSITE_URL, BASE_PAYMENT_LINK,
+    pool_size=GRAPH_POOL_SIZE,
+    messages_per_second=RATE_LIMIT_MPS,
+    recipient_per_minute=RATE_LIMIT_RECIPIENT_PER_MINUTE,
+    recipient_burst=RATE_LIMIT_RECIPIENT_BURST,
+    qr_template=PAYMENT_QR_TEMPLATE,
+    menu_source=MENU_SOURCE
+)
+
+# Static message texts (serialized once at startup, see register_templates)
+WELCOME_MESSAGE = """🍕 Welcome to our restaurant!
+
+To place your order, click below:"""
+
+MENU_MESSAGE = """📋 Our Menu
+
+View full menu with prices:"""
+
+STATUS_MESSAGE = """📋 Order Status
+
+For order updates, contact:
+📞 +91-9327256068"""
+
+HELP_MESSAGE = """🆘 Support
+
+📞 Call: +91-9327256068
+🕒 Hours: 9 AM - 11 PM
+
+Commands:
+• 'hi' - Place order
+• 'menu' - View menu
+• 'status' - Order status"""
+
+DEFAULT_MESSAGE = """Hi! 👋
+
+Commands:
+• 'hi' - Place order
+• 'menu' - View menu
+• 'status' - Order status
+• 'help' - Get support
+
+Ready to order? Type 'hi'!"""
+
+ORDER_BUTTONS = ['Edit Order', 'Confirm Order']
 
 
 class WhatsAppOrderBot:
-    def __init__(self):
-        self.user_states = {}
-        self.payment_sessions = {}
-        print("✅ WhatsAppOrderBot initialized with user_states")
+    def __init__(self, client=None, user_states=None, payment_sessions=None, orders=None, tenant=None,
+                 customers=None):
+        # Which restaurant this bot speaks for; other tenants get their own store namespaces
+        self.tenant = tenant or DEFAULT_TENANT_CONFIG
+        # (An empty store is falsy, so passed-in stores are checked against None)
+        self.user_states = user_states if user_states is not None else create_state_store(
+            self.tenant.namespaced('user_states'), STATE_BACKEND, sqlite_path=STATE_DB_PATH, redis_url=REDIS_URL,
+            max_entries=STATE_MAX_ENTRIES, codec=USER_STATE_CODEC
+        )
+        # Orders waiting for confirmation, referenced from user states by order_ref
+        self.orders = orders if orders is not None else create_state_store(
+            self.tenant.namespaced('orders'), STATE_BACKEND, sqlite_path=STATE_DB_PATH, redis_url=REDIS_URL,
+            max_entries=STATE_MAX_ENTRIES
+        )
+        self.machine = ConversationMachine(self, self.user_states, stage_ttls=STAGE_TTLS)
+        # Indexed by phone, status and creation time for /sessions lookups
+        if payment_sessions is None:
+            payment_sessions = create_state_store(
+                self.tenant.namespaced('payment_sessions'), STATE_BACKEND, sqlite_path=STATE_DB_PATH,
+                redis_url=REDIS_URL, max_entries=STATE_MAX_ENTRIES
+            )
+        if not isinstance(payment_sessions, IndexedSessionStore):
+            payment_sessions = IndexedSessionStore(payment_sessions)
+            payment_sessions.rebuild()
+        self.payment_sessions = payment_sessions
+        # Last pending/completed order per customer, kept well past the session TTLs for campaigns
+        self.customers = customers if customers is not None else create_state_store(
+            self.tenant.namespaced('customers'), STATE_BACKEND, sqlite_path=STATE_DB_PATH, redis_url=REDIS_URL,
+            max_entries=STATE_MAX_ENTRIES
+        )
+        self.session_locks = KeyedLocks()
+        # Durable event log, attached at startup when EVENT_LOG_DIR is set
+        self.events = None
+        # Payment QR cache, attached at startup when PAYMENT_QR is on
+        self.qr_codes = None
+        # Completed-order export, attached at startup when ORDER_SINK is set
+        self.order_sink = None
+        # Menu catalog, attached at startup when MENU_SOURCE is set
+        self.menu = None
+        self.intents = IntentMatcher()
+        self.phones = PhoneNormalizer(PHONE_CACHE_SIZE)
+        self.templates = self.register_templates()
+        # Per tenant: the Graph API throughput limit applies to each business number separately
+        self.client = client or GraphAPIClient(
+            self.tenant.token,
+            self.tenant.phone_id,
+            base_url=GRAPH_API_BASE,
+            pool_size=self.tenant.pool_size,
+            connect_timeout=GRAPH_CONNECT_TIMEOUT,
+            read_timeout=GRAPH_READ_TIMEOUT,
+            limiter=GraphRateLimiter(
+                messages_per_second=self.tenant.messages_per_second,
+                recipient_per_minute=self.tenant.recipient_per_minute,
+                recipient_burst=self.tenant.recipient_burst,
+                max_wait=RATE_LIMIT_MAX_WAIT
+            ),
+            retry=RetryPolicy(GRAPH_RETRY_ATTEMPTS, GRAPH_RETRY_BASE_DELAY, GRAPH_RETRY_MAX_DELAY),
+            breaker=CircuitBreaker('graph_api', BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT)
+        )
+        self.capabilities = CapabilityCache(INTERACTIVE_FAILURE_TTL, INTERACTIVE_SERVER_ERRORS)
+        logger.info(f"✅ WhatsAppOrderBot initialized with user_states (tenant {self.tenant.id})")
 
     def normalize_phone_number(self, phone):
         """Normalize phone number for storage"""
-        if not phone:
-            return None
-        phone = str(phone).strip().replace(' ', '').replace('-', '').replace('(', '').replace(')', '').replace('+', '')
-        phone = phone.lstrip('0')
-        
-        if phone.startswith('91') and len(phone) == 12:
-            return phone
-        elif len(phone) == 10:
-            return f"91{phone}"
-        elif phone.startswith('91'):
-            return phone
-        else:
-            return f"91{phone}"
+        return self.phones.normalize(phone)
+
+    def is_valid_phone(self, normalized):
+        """Digits only, within E.164 length"""
+        return is_valid_number(normalized)
 
     def format_phone_number(self, phone):
         """Format phone for WhatsApp API"""
-        normalized = self.normalize_phone_number(phone)
-        if normalized:
-            return f"{normalized}"
-        return None
+        return self.phones.normalize(phone)
+
+    def register_templates(self):
+        """Pre-serialize the message payloads (static texts are complete except for 'to')"""
+        templates = TemplateRegistry(JSON_ENCODER)
+        templates.text('text')
+        templates.cta('cta_url')
+        templates.cta('welcome', WELCOME_MESSAGE, "Order Now", self.tenant.website_url)
+        templates.cta('menu', MENU_MESSAGE, "View Menu", self.tenant.website_url)
+        templates.text('status', STATUS_MESSAGE)
+        templates.text('help', HELP_MESSAGE)
+        templates.text('default', DEFAULT_MESSAGE)
+        templates.buttons(ORDER_BUTTONS)
+        templates.image('image')
+        templates.register('wa_template', template_payload())
+        return templates
 
     def send_whatsapp_message(self, phone_number, message):
         """Send text message via WhatsApp"""
-        headers = {
-            'Authorization': f'Bearer {WHATSAPP_TOKEN}',
-            'Content-Type': 'application/json'
-        }
+        return self._send_text(phone_number, self.templates.render('text', to=phone_number, body=message))
 
-        payload = {
-            "messaging_product": "whatsapp",
-            "to": phone_number,
-            "type": "text",
-            "text": {"body": message}
-        }
+    def when_sent(self, result, callback):
+        """callback(sent) once a send's outcome is known (right away here; the async bot queues sends)"""
+        callback(result)
+
+    def send_static_text(self, phone_number, name):
+        """Send one of the fully static text templates"""
+        return self._send_text(phone_number, self.templates.render(name, to=phone_number))
 
+    def _send_text(self, phone_number, body, kind='text'):
         try:
-            print(f"📤 Sending WhatsApp message to {phone_number}")
-            response = requests.post(WHATSAPP_API_URL, headers=headers, json=payload)
-            print(f"📥 WhatsApp API Response: {response.status_code} - {response.text}")
+            logger.debug(f"📤 Sending WhatsApp message to {phone_number}")
+            response = self.client.send_raw(body, phone_number, kind)
+            if response.status_code == 200:
+                logger.debug(f"📥 WhatsApp API Response: {response.status_code}")
+            else:
+                logger.warning(f"📥 WhatsApp API Response: {response.status_code} - {response.text}")
             return response.status_code == 200
         except Exception as e:
-            print(f"❌ Error sending message: {e}")
+            logger.error(f"❌ Error sending message: {e}")
             return False
 
     def send_cta_button(self, phone_number, message, button_text, website_url):
         """Send Call-to-Action button"""
-        headers = {
-            'Authorization': f'Bearer {WHATSAPP_TOKEN}',
-            'Content-Type': 'application/json'
-        }
-
-        payload = {
-            "messaging_product": "whatsapp",
-            "to": phone_number,
-            "type": "interactive",
-            "interactive": {
-                "type": "cta_url",
-                "body": {"text": message},
-                "action": {
-                    "name": "cta_url",
-                    "parameters": {
-                        "display_text": button_text,
-                        "url": website_url
-                    }
-                }
-            }
-        }
+        body = self.templates.render('cta_url', to=phone_number, body=message,
+                                     display_text=button_text, url=website_url)
+        return self._send_cta(phone_number, body, f"{message}\n\n🌐 {button_text}: {website_url}")
+
+    def send_static_cta(self, phone_number, name):
+        """Send one of the fully static CTA templates"""
+        template = self.templates[name]
+        return self._send_cta(phone_number, template.render(to=phone_number), template.fallback)
+
+    def payment_qr(self, session_id):
+        """Future of the QR PNG for a pending payment session, None for anything else"""
+        if self.qr_codes is None or not session_id:
+            return None
+        session = self.payment_sessions.get(session_id)
+        if not session or session.get('status') != 'pending':
+            return None
+        amount = format_amount((session.get('order_data') or {}).get('total'))
+        if amount is None:
+            return None
+        # The same redirect as the Pay Now link, so paying by scan also ends at the callback
+        data = f"{self.tenant.qr_template.format(amount=amount)}&redirect={self.payment_callback_url(session_id)}"
+        return self.qr_codes.get(data)
+
+    def send_payment_qr(self, phone_number, total, session_id):
+        """Send the payment QR code as an image (WhatsApp downloads it from /payment/qr)"""
+        # Starts the render now, so it is usually cached by the time WhatsApp asks for it
+        if self.payment_qr(session_id) is None:
+            return False
+        amount = format_amount(total)
+        link = f"{SERVER_URL}/payment/qr?session={session_id}"
+        if not self.tenant.default:
+            link += f"&tenant={self.tenant.id}"
+        body = self.templates.render('image', to=phone_number, link=link,
+                                     caption=f"📷 Scan to pay ₹{amount}\n🔖 Session ID: {session_id}")
+        return self._send_text(phone_number, body, 'image')
+
+    def send_template_message(self, phone_number, template_name, language='en_US'):
+        """Send a pre-approved WhatsApp template (needed outside the 24h customer window)"""
+        body = self.templates.render('wa_template', to=phone_number, name=template_name, language=language)
+        return self._send_text(phone_number, body, 'template')
+
+    def _send_cta(self, phone_number, body, fallback_message):
+        return self._send_interactive('cta_url', phone_number, body, fallback_message)
+
+    def _send_interactive(self, kind, phone_number, body, fallback_message):
+        """Send a pre-rendered interactive message (cta_url, list), plain text if the API rejects it"""
+        # This type was rejected recently: skip straight to the text version
+        if self.capabilities.failing(kind):
+            return self._send_interactive_fallback(kind, phone_number, fallback_message)
 
         try:
-            response = requests.post(WHATSAPP_API_URL, headers=headers, json=payload)
+            response = self.client.send_raw(body, phone_number, kind)
             
             if response.status_code == 200:
+                self.capabilities.succeeded(kind)
                 return True
+            elif rate_limit_code(response):
+                # A fallback text would only add to the throttling
+                return False
             else:
-                fallback_message = f"{message}\n\n🌐 {button_text}: {website_url}"
-                return self.send_whatsapp_message(phone_number, fallback_message)
+                self._interactive_failed(kind, response)
+                return self._send_interactive_fallback(kind, phone_number, fallback_message)
+        except (RateLimitExceeded, CircuitOpen) as e:
+            # Nothing reached the API, and the text fallback would queue on the same limiter or hit the
+            # same open circuit: report not sent, as for a throttled text (callers and retries handle it)
+            logger.warning(f"🚦 {kind} message not sent: {e}")
+            return False
         except Exception as e:
-            print(f"Error sending CTA: {e}")
-            fallback_message = f"{message}\n\n🌐 {button_text}: {website_url}"
-            return self.send_whatsapp_message(phone_number, fallback_message)
+            logger.warning(f"Error sending {kind} message: {e}")
+            return self._send_interactive_fallback(kind, phone_number, fallback_message)
+
+    def _send_interactive_fallback(self, kind, phone_number, fallback_message):
+        FALLBACKS.labels(kind).inc()
+        return self.send_whatsapp_message(phone_number, fallback_message)
+
+    def send_menu(self, phone_number, page=1):
+        """Send a page of the menu catalog as a list message (the website CTA when there is no catalog)"""
+        menu = self.menu.current() if self.menu is not None else None
+        template = menu.page(page) if menu else None
+        if template is None:
+            return self.send_static_cta(phone_number, 'menu')
+        return self._send_interactive('list', phone_number, template.render(to=phone_number), menu.fallback)
+
+    def handle_list_reply(self, phone_number, row_id):
+        """Rows picked from a menu list: another page, or one item's details"""
+        if row_id.startswith(PAGE_PREFIX) and row_id[len(PAGE_PREFIX):].isdigit():
+            return self.send_menu(phone_number, int(row_id[len(PAGE_PREFIX):]))
+        menu = self.menu.current() if self.menu is not None else None
+        template = menu.item(row_id) if menu and row_id.startswith(ITEM_PREFIX) else None
+        if template is None:
+            # Picked from a menu that has since changed: show the current one
+            return self.send_menu(phone_number)
+        return self._send_cta(phone_number, template.render(to=phone_number), template.fallback)
 
     def send_interactive_buttons(self, phone_number, message, buttons):
         """Send interactive buttons"""
-        headers = {
-            'Authorization': f'Bearer {WHATSAPP_TOKEN}',
-            'Content-Type': 'application/json'
-        }
+        if self.capabilities.failing('button'):
+            return self.send_fallback_message(phone_number, message, buttons)
 
-        button_objects = []
-        for i, button_text in enumerate(buttons):
-            button_objects.append({
-                "type": "reply",
-                "reply": {
-                    "id": f"btn_{i+1}",
-                    "title": button_text[:20]
-                }
-            })
-
-        payload = {
-            "messaging_product": "whatsapp",
-            "to": phone_number,
-            "type": "interactive",
-            "interactive": {
-                "type": "button",
-                "body": {"text": message},
-                "action": {"buttons": button_objects}
-            }
-        }
+        body = self.templates.buttons(buttons).render(to=phone_number, body=message)
 
         try:
-            response = requests.post(WHATSAPP_API_URL, headers=headers, json=payload)
+            response = self.client.send_raw(body, phone_number, 'button')
             
             if response.status_code == 200:
+                self.capabilities.succeeded('button')
                 return True
+            elif rate_limit_code(response):
+                return False
             else:
+                self._interactive_failed('button', response)
                 return self.send_fallback_message(phone_number, message, buttons)
+        except (RateLimitExceeded, CircuitOpen) as e:
+            # No text fallback, as in _send_interactive
+            logger.warning(f"🚦 Buttons not sent: {e}")
+            return False
         except Exception as e:
-            print(f"Error sending buttons: {e}")
+            logger.warning(f"Error sending buttons: {e}")
             return self.send_fallback_message(phone_number, message, buttons)
 
+    def _interactive_failed(self, kind, response):
+        # Turn the type off for everyone only when the API rejects the type or its payload,
+        # not for one recipient's error; a 5xx (already retried) only counts toward a streak
+        if response.status_code >= 500:
+            self.capabilities.server_error(kind, f"HTTP {response.status_code}")
+            return
+        code = graph_error_code(response)
+        if code in MESSAGE_TYPE_ERRORS:
+            self.capabilities.mark_failing(kind, f"HTTP {response.status_code}, error {code}")
+
     def send_fallback_message(self, phone_number, message, buttons):
         """Fallback text message"""
+        FALLBACKS.labels('button').inc()
+        return self.send_whatsapp_message(phone_number, self.fallback_text(message, buttons))
+
+    def fallback_text(self, message, buttons):
+        """Buttons as a numbered list, for when interactive messages fail"""
         fallback_message = message + "\n\n"
         for i, button in enumerate(buttons, 1):
             fallback_message += f"{i}. {button}\n"
         fallback_message += "\nReply with the number."
-        return self.send_whatsapp_message(phone_number, fallback_message)
+        return fallback_message
 
     def send_order_confirmation(self, order_data):
         """Send order confirmation with buttons"""
         try:
-            if not hasattr(self, 'user_states'):
-                self.user_states = {}
-                
-            print(f"\n📋 Processing order: {json.dumps(order_data, indent=2)}")
+            log_payload(logger, "📋 Processing order", order_data)
 
-            name = order_data.get('name', 'Customer')
             phone = order_data.get('phone')
-            food_items = order_data.get('foodItems', 'N/A')
-            quantity = order_data.get('quantity', 'N/A')
-            total = order_data.get('total', 0)
-            timestamp = order_data.get('timestamp', datetime.now().strftime('%Y-%m-%d %H:%M'))
+            # The normalized number doubles as the WhatsApp recipient id
+            normalized_phone = whatsapp_phone = self.normalize_phone_number(phone)
 
-            whatsapp_phone = self.format_phone_number(phone)
-            normalized_phone = self.normalize_phone_number(phone)
-
-            if not whatsapp_phone or not normalized_phone:
-                print(f"❌ Invalid phone: {phone}")
+            if not normalized_phone:
+                logger.warning(f"❌ Invalid phone: {phone}")
                 return False
 
-            message = f"""🎉 Order Received!
-
-📋 ORDER SUMMARY:
-👤 Name: {name}
-🍽 Items: {food_items}
-📊 Quantity: {quantity}
-💰 Total: ₹{total}
-⏰ Time: {timestamp}
-
-Please confirm your order:"""
-
-            self.user_states[normalized_phone] = {
-                'stage': 'awaiting_confirmation',
-                'order_data': order_data,
-                'whatsapp_phone': whatsapp_phone
-            }
-
-            buttons = ['Edit Order', 'Confirm Order']
-            success = self.send_interactive_buttons(whatsapp_phone, message, buttons)
+            # The order is stored once; the conversation state only keeps its reference
+            order_ref = f"{normalized_phone}-{time.time_ns()}"
+            self.orders.set(order_ref, order_data, ttl=STAGE_TTLS['awaiting_confirmation'])
 
-            return success
+            return self.machine.dispatch(normalized_phone, ORDER_RECEIVED, order_ref=order_ref,
+                                         order_data=order_data, whatsapp_phone=whatsapp_phone)
 
         except Exception as e:
-            print(f"❌ Error sending confirmation: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception(f"❌ Error sending confirmation: {e}")
             return False
 
+    def record_event(self, event_type, key, data):
+        """Append to the durable event log (when enabled), waiting for the group commit.
+
+        All tenants share one log, so the key and the refs the projection
+        joins on carry the tenant's namespace (the default tenant has none).
+        """
+        if self.events is None:
+            return
+        data = {name: self.tenant.namespaced(value) if name in EVENT_REFS and value else value
+                for name, value in data.items()}
+        if not self.events.append(event_type, self.tenant.namespaced(key), data):
+            logger.warning(f"⚠️ Event log commit failed or timed out for {event_type} {key}")
+
+    def restore(self, projection):
+        """Refill the stores from this tenant's part of an event log projection, keeping anything already stored"""
+        prefix = self.tenant.namespaced('')
+        restored = 0
+        for name, store in (('user_states', self.user_states), ('orders', self.orders),
+                            ('payment_sessions', self.payment_sessions)):
+            for key, value, ttl in projection.items(name):
+                # Phones, session ids and order refs never contain ':', namespaces end with one
+                if not key.startswith(prefix) or ':' in key[len(prefix):]:
+                    continue
+                key = key[len(prefix):]
+                if key in store:
+                    continue
+                if name == 'user_states':
+                    value = UserState(**{field: ref[len(prefix):] if field in EVENT_REFS and ref else ref
+                                         for field, ref in value.items()})
+                store.set(key, value, ttl=ttl)
+                restored += 1
+        return restored
+
     def generate_payment_session(self, normalized_phone, order_data):
-        """Generate unique payment session"""
+        """Generate unique payment session, returns (session_id, session)"""
         timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-        session_id = f"{timestamp}{normalized_phone[-4:]}"
+        # Random tail: two Confirm clicks in the same second must not share (and delete) one session
+        session_id = f"{timestamp}{normalized_phone[-4:]}{secrets.token_hex(3)}"
         
-        self.payment_sessions[session_id] = {
+        session = {
             'phone': normalized_phone,
             'order_data': order_data,
             'timestamp': timestamp,
+            'created_at': time.time(),
             'status': 'pending'
         }
+        self.payment_sessions.set(session_id, session, ttl=STAGE_TTLS['payment_pending'])
         
-        print(f"💾 Payment session created: {session_id}")
-        print(f"📞 Phone: {normalized_phone}")
-        print(f"💰 Amount: ₹{order_data.get('total', 0)}")
+        logger.info(f"💾 Payment session created: {session_id} (phone {normalized_phone}, amount ₹{order_data.get('total', 0)})")
         
-        return session_id
+        return session_id, session
+
+    def remember_customer(self, normalized_phone, status):
+        """Note when a customer last had an order in this status (see CampaignManager.recent_customers)"""
+        try:
+            record = self.customers.get(normalized_phone) or {'phone': normalized_phone, 'seen': {}}
+            record['seen'][status] = time.time()
+            self.customers.set(normalized_phone, record, ttl=CUSTOMER_HISTORY_DAYS * 86400)
+        except Exception as e:
+            logger.error(f"❌ Could not update customer history for {normalized_phone}: {e}")
+
+    def export_order(self, session_id, session):
+        """Hand a completed order to the order sink (buffered, flushed in the background)"""
+        if self.order_sink is None:
+            return
+        try:
+            # Session ids are only unique within a tenant, the sink buffer is shared
+            self.order_sink.add(self.tenant.namespaced(session_id), order_row(session_id, session, self.tenant.id))
+        except Exception as e:
+            # The customer still gets their confirmation; the order stays in /sessions
+            logger.error(f"❌ Could not queue order {session_id} for export: {e}")
 
     def handle_button_response(self, phone_number, button_id, button_text=None):
         """Handle button clicks"""
         try:
-            if not hasattr(self, 'user_states'):
-                self.user_states = {}
-                
             normalized_phone = self.normalize_phone_number(phone_number)
-            current_state = self.user_states.get(normalized_phone, {})
 
-            if normalized_phone in self.user_states and current_state.get('stage') == 'awaiting_confirmation':
-                order_data = current_state.get('order_data', {})
+            if button_id == 'btn_1' or (button_text and 'edit' in button_text.lower()):
+                event = EDIT
+            elif button_id == 'btn_2' or (button_text and 'confirm' in button_text.lower()):
+                event = CONFIRM
+            else:
+                return self.on_session_expired(normalized_phone, None, None, phone_number=phone_number)
+
+            return self.machine.dispatch(normalized_phone, event, phone_number=phone_number)
+
+        except Exception as e:
+            logger.exception(f"❌ Error handling button: {e}")
+            return False
+
+    # Conversation transition handlers, called by self.machine (see state_machine.TRANSITIONS)
+
+    def on_order_received(self, normalized_phone, state, transition, order_ref, order_data, whatsapp_phone):
+        """New order: ask the customer to confirm it"""
+        if state is not None and state.order_ref:
+            # A newer order replaces one still waiting for confirmation
+            self.orders.delete(state.order_ref)
+        self.machine.replace(normalized_phone, transition, order_ref=order_ref, whatsapp_phone=whatsapp_phone)
+        self.record_event(EVENT_ORDER_RECEIVED, normalized_phone,
+                          {'order_ref': order_ref, 'order': order_data, 'whatsapp_phone': whatsapp_phone})
+
+        name = order_data.get('name', 'Customer')
+        food_items = order_data.get('foodItems', 'N/A')
+        quantity = order_data.get('quantity', 'N/A')
+        total = order_data.get('total', 0)
+        timestamp = order_data.get('timestamp', datetime.now().strftime('%Y-%m-%d %H:%M'))
+
+        message = f"""🎉 Order Received!
+
+📋 ORDER SUMMARY:
+👤 Name: {name}
+🍽 Items: {food_items}
+📊 Quantity: {quantity}
+💰 Total: ₹{total}
+⏰ Time: {timestamp}
+
+Please confirm your order:"""
+
+        return self.send_interactive_buttons(whatsapp_phone, message, ORDER_BUTTONS)
+
+    def on_edit_order(self, normalized_phone, state, transition, phone_number):
+        """Edit Order: end the conversation and point the customer at the website"""
+        # Another worker may have handled this click already
+        if not self.machine.advance(normalized_phone, state, transition):
+            return True
+        self.orders.delete(state.order_ref)
+        self.record_event(ORDER_EDITED, normalized_phone, {'order_ref': state.order_ref})
 
-                # Edit Order
-                if button_id == 'btn_1' or (button_text and 'edit' in button_text.lower()):
-                    message = """✏ Edit Your Order
+        message = """✏ Edit Your Order
 
 To make changes, visit our website below."""
 
-                    self.send_cta_button(phone_number, message, "Visit Website", WEBSITE_URL)
-                    
-                    if normalized_phone in self.user_states:
-                        del self.user_states[normalized_phone]
-                    
-                    return True
+        self.send_cta_button(phone_number, message, "Visit Website", self.tenant.website_url)
+        return True
+
+    def on_confirm_order(self, normalized_phone, state, transition, phone_number):
+        """Confirm Order: open a payment session and send the payment link"""
+        order_data = self.orders.get(state.order_ref)
+        if order_data is None:
+            return self.on_session_expired(normalized_phone, state, transition, phone_number=phone_number)
+
+        total = order_data.get('total', 0)
+        name = order_data.get('name', 'Customer')
+        food_items = order_data.get('foodItems', 'N/A')
+
+        # Generate payment session ID
+        session_id, session = self.generate_payment_session(normalized_phone, order_data)
+
+        # Move to payment_pending only if nobody else confirmed first
+        if not self.machine.advance(normalized_phone, state, transition,
+                                    session_id=session_id, whatsapp_phone=state.whatsapp_phone):
+            logger.warning(f"⚠️ Order already confirmed for {normalized_phone}, dropping session {session_id}")
+            self.payment_sessions.delete(session_id)
+            return True
+
+        # The payment session now owns the order. Logged only now: a session dropped above
+        # never reaches the event log, so a replay cannot bring it back.
+        self.orders.delete(state.order_ref)
+        self.record_event(SESSION_CREATED, session_id, {'session': session})
+        self.remember_customer(normalized_phone, 'pending')
+        self.record_event(ORDER_CONFIRMED, normalized_phone, {
+            'session_id': session_id, 'order_ref': state.order_ref, 'whatsapp_phone': state.whatsapp_phone
+        })
+
+        # Create payment link with callback - FIXED URL
+        payment_url = f"{self.tenant.payment_link}{total}&redirect={self.payment_callback_url(session_id)}"
 
-                # Confirm Order - Generate payment session and redirect
-                elif button_id == 'btn_2' or (button_text and 'confirm' in button_text.lower()):
-                    total = order_data.get('total', 0)
-                    name = order_data.get('name', 'Customer')
-                    food_items = order_data.get('foodItems', 'N/A')
-                    
-                    # Generate payment session ID
-                    session_id = self.generate_payment_session(normalized_phone, order_data)
-                    
-                    # Create payment link with callback - FIXED URL
-                    payment_url = f"{BASE_PAYMENT_LINK}{total}&redirect={SERVER_URL}/payment/callback?session={session_id}"
-                    
-                    message = f"""✅ Order Confirmed!
+        message = f"""✅ Order Confirmed!
 
 👤 Customer: {name}
 🍽 Items: {food_items}
@@ -288,55 +702,71 @@ To make changes, visit our website below."""
 
 Click below to complete payment:"""
 
-                    success = self.send_cta_button(phone_number, message, "Pay Now", payment_url)
+        success = self.send_cta_button(phone_number, message, "Pay Now", payment_url)
+        # The QR only goes out under a payment link that was actually sent
+        self.when_sent(success, lambda sent: sent and self.send_payment_qr(phone_number, total, session_id))
 
-                    # Update state
-                    self.user_states[normalized_phone] = {
-                        'stage': 'payment_pending',
-                        'session_id': session_id,
-                        'order_data': order_data
-                    }
+        logger.info(f"✅ Payment link sent with session: {session_id}")
+        logger.debug(f"🔗 Payment URL: {payment_url}")
+        return success
 
-                    print(f"✅ Payment link sent with session: {session_id}")
-                    print(f"🔗 Payment URL: {payment_url}")
-                    return success
+    def payment_callback_url(self, session_id):
+        """Where Pay0 sends the customer back to; other tenants add their id to the path"""
+        # (In the path, not the query: the URL sits unescaped inside Pay0's redirect= parameter)
+        path = '/payment/callback' if self.tenant.default else f'/payment/callback/{self.tenant.id}'
+        return f"{SERVER_URL}{path}?session={session_id}"
 
-            else:
-                message = """Session expired.
+    def on_session_expired(self, normalized_phone, state, transition, phone_number):
+        """Button clicked with no conversation waiting for it"""
+        message = """Session expired.
 
 Type 'hi' to start over."""
-                self.send_whatsapp_message(phone_number, message)
-                return True
+        self.send_whatsapp_message(phone_number, message)
+        return True
 
-        except Exception as e:
-            print(f"❌ Error handling button: {e}")
-            import traceback
-            traceback.print_exc()
-            return False
+    def on_payment_completed(self, normalized_phone, state, transition, session_id):
+        """Payment done: end the conversation if it is still about this session"""
+        if state.session_id == session_id:
+            self.machine.advance(normalized_phone, state, transition)
+        return True
 
-    def process_payment_success(self, session_id):
-        """Process successful payment"""
+    def process_payment_success(self, session_id, received_at=None):
+        """Process successful payment (received_at: monotonic time the callback arrived)"""
         try:
-            print(f"\n💳 Processing payment for session: {session_id}")
+            logger.info(f"💳 Processing payment for session: {session_id}")
             
-            if session_id not in self.payment_sessions:
-                print(f"❌ Session not found: {session_id}")
-                print(f"📋 Available sessions: {list(self.payment_sessions.keys())}")
-                return False
+            # Generate order ID
+            order_id = f"ORD{session_id}"
+
+            # Pay0 may hit several callback URLs for one payment, sometimes concurrently.
+            # The per-session lock serializes this worker; the pending -> completed
+            # compare-and-set makes sure only one caller across workers sends.
+            with self.session_locks.lock_for(session_id):
+                session = self.payment_sessions.get(session_id)
+                if session is None:
+                    logger.warning(f"❌ Session not found: {session_id} (sessions by status: {self.payment_sessions.count_by_status()})")
+                    return False
+
+                if session.get('status') != 'pending':
+                    logger.info(f"🔁 Payment already processed for session: {session_id}")
+                    return True
+
+                completed = dict(session, status='completed', order_id=order_id)
+                if not self.payment_sessions.compare_and_set(session_id, 'status', 'pending', completed,
+                                                             ttl=STAGE_TTLS['completed']):
+                    logger.info(f"🔁 Payment already processed for session: {session_id}")
+                    return True
+                self.record_event(EVENT_PAYMENT_COMPLETED, session_id, {'order_id': order_id, 'phone': session['phone']})
+                self.export_order(session_id, completed)
+                self.remember_customer(session['phone'], 'completed')
             
-            session = self.payment_sessions[session_id]
             normalized_phone = session['phone']
             order_data = session['order_data']
             
-            print(f"✅ Session found!")
-            print(f"📞 Phone: {normalized_phone}")
+            logger.debug(f"✅ Session found, phone: {normalized_phone}")
             
             # Get WhatsApp phone
             whatsapp_phone = self.format_phone_number(normalized_phone)
-            print(f"📱 WhatsApp Phone: {whatsapp_phone}")
-            
-            # Generate order ID
-            order_id = f"ORD{session_id}"
             
             # Get order details
             name = order_data.get('name', 'Customer')
@@ -360,29 +790,26 @@ Type 'hi' to start over."""
 Thank you for your order!
 📞 Contact: +91-9327256068"""
             
-            print(f"📤 Sending confirmation message...")
             success = self.send_whatsapp_message(whatsapp_phone, message)
+            if received_at is not None:
+                PAYMENT_TO_SEND.observe(time.monotonic() - received_at)
             
-            if success:
-                print(f"✅ Payment confirmation sent to WhatsApp: {whatsapp_phone}")
-            else:
-                print(f"❌ Failed to send WhatsApp message to: {whatsapp_phone}")
-            
-            # Update session status
-            self.payment_sessions[session_id]['status'] = 'completed'
-            self.payment_sessions[session_id]['order_id'] = order_id
+            def report(sent):
+                if sent:
+                    logger.info(f"✅ Payment confirmation sent to WhatsApp: {whatsapp_phone}")
+                else:
+                    logger.error(f"❌ Failed to send WhatsApp message to: {whatsapp_phone}")
+
+            self.when_sent(success, report)
             
             # Clean up user state
-            if normalized_phone in self.user_states:
-                del self.user_states[normalized_phone]
+            self.machine.dispatch(normalized_phone, PAYMENT_COMPLETED, session_id=session_id)
             
-            print(f"✅ Payment processed successfully for session: {session_id}")
+            logger.info(f"✅ Payment processed successfully for session: {session_id}")
             return success
             
         except Exception as e:
-            print(f"❌ Error processing payment: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception(f"❌ Error processing payment: {e}")
             return False
 
     def handle_basic_messages(self, phone_number, message_body):
@@ -390,78 +817,198 @@ Thank you for your order!
         message_body = str(message_body).lower().strip()
         normalized_phone = self.normalize_phone_number(phone_number)
 
-        if not hasattr(self, 'user_states'):
-            self.user_states = {}
+        # Stage-specific intents (edit/confirm) are only matched in the confirmation flow
+        current_state = self.user_states.get(normalized_phone)
+        stage = current_state.stage if current_state else None
+        intent = self.intents.match(message_body, stage)
 
-        # Check if in confirmation flow
-        if normalized_phone in self.user_states:
-            current_state = self.user_states[normalized_phone]
-            
-            if current_state.get('stage') == 'awaiting_confirmation':
-                if '1' in message_body or 'edit' in message_body:
-                    return self.handle_button_response(phone_number, 'btn_1', 'edit')
-                elif '2' in message_body or 'confirm' in message_body:
-                    return self.handle_button_response(phone_number, 'btn_2', 'confirm')
+        if intent == 'edit':
+            return self.handle_button_response(phone_number, 'btn_1', 'edit')
+        elif intent == 'confirm':
+            return self.handle_button_response(phone_number, 'btn_2', 'confirm')
 
         # Greetings
-        if any(kw in message_body for kw in ['hi', 'hello', 'hey', 'hy']):
-            message = """🍕 Welcome to our restaurant!
-
-To place your order, click below:"""
-            self.send_cta_button(phone_number, message, "Order Now", WEBSITE_URL)
+        if intent == 'greeting':
+            self.send_static_cta(phone_number, 'welcome')
             return True
 
         # Menu
-        elif 'menu' in message_body:
-            message = """📋 Our Menu
-
-View full menu with prices:"""
-            self.send_cta_button(phone_number, message, "View Menu", WEBSITE_URL)
+        elif intent == 'menu':
+            self.send_menu(phone_number)
             return True
 
         # Status/Payment
-        elif 'status' in message_body or 'order' in message_body:
-            message = """📋 Order Status
-
-For order updates, contact:
-📞 +91-9327256068"""
-            self.send_whatsapp_message(phone_number, message)
+        elif intent == 'status':
+            self.send_static_text(phone_number, 'status')
             return True
 
         # Help
-        elif 'help' in message_body or 'support' in message_body:
-            message = """🆘 Support
-
-📞 Call: +91-9327256068
-🕒 Hours: 9 AM - 11 PM
-
-Commands:
-• 'hi' - Place order
-• 'menu' - View menu
-• 'status' - Order status"""
-            self.send_whatsapp_message(phone_number, message)
+        elif intent == 'help':
+            self.send_static_text(phone_number, 'help')
             return True
 
         # Default
         else:
-            message = """Hi! 👋
-
-Commands:
-• 'hi' - Place order
-• 'menu' - View menu
-• 'status' - Order status
-• 'help' - Get support
-
-Ready to order? Type 'hi'!"""
-            self.send_whatsapp_message(phone_number, message)
+            self.send_static_text(phone_number, 'default')
             return True
 
 
 # Initialize bot GLOBALLY
 bot = WhatsAppOrderBot()
 
-print(f"🤖 Bot initialized: {hasattr(bot, 'user_states')}")
-print(f"📊 User states type: {type(getattr(bot, 'user_states', None))}")
+logger.info(f"🤖 Bot initialized, state backend: {STATE_BACKEND} ({type(bot.user_states).__name__})")
+
+# Rebuild state lost in a restart from the latest snapshot + log tail, then keep logging
+event_log = None
+if EVENT_LOG_DIR:
+    try:
+        event_log = EventLog(EVENT_LOG_DIR, OrderProjection(STAGE_TTLS),
+                             snapshot_every=EVENT_LOG_SNAPSHOT_EVERY, fsync=EVENT_LOG_FSYNC)
+        event_log.replay()
+        logger.info(f"📜 Restored {bot.restore(event_log.projection)} records from the event log")
+        event_log.start()
+        bot.events = event_log
+    except RuntimeError as e:
+        logger.error(f"❌ Event log disabled: {e}")
+        event_log = None
+
+if PAYMENT_QR:
+    try:
+        bot.qr_codes = PaymentQRCache(max_entries=PAYMENT_QR_CACHE_SIZE, workers=PAYMENT_QR_WORKERS)
+    except RuntimeError as e:
+        logger.error(f"❌ Payment QR codes disabled: {e}")
+
+if MENU_SOURCE:
+    bot.menu = MenuCatalog(create_menu_source(MENU_SOURCE), WEBSITE_URL, refresh_interval=MENU_REFRESH_INTERVAL,
+                           encoder=bot.templates.encoder).start()
+
+if ORDER_SINK:
+    try:
+        bot.order_sink = OrderSink(
+            create_sink_backend(ORDER_SINK, spreadsheet_key=GOOGLE_SHEETS_KEY, worksheet=GOOGLE_SHEETS_WORKSHEET,
+                                credentials_file=GOOGLE_CREDENTIALS_FILE, api_key=AIRTABLE_API_KEY,
+                                base_id=AIRTABLE_BASE_ID, table=AIRTABLE_TABLE),
+            create_state_store('order_sink', ORDER_SINK_STATE_BACKEND, sqlite_path=STATE_DB_PATH, redis_url=REDIS_URL),
+            batch_size=ORDER_SINK_BATCH_SIZE,
+            flush_interval=ORDER_SINK_FLUSH_INTERVAL,
+            lease_ttl=ORDER_SINK_LEASE_TTL
+        )
+        STORE_SIZE.set_function(lambda: bot.order_sink.snapshot()['pending'], 'order_sink')
+    except (RuntimeError, ValueError) as e:
+        logger.error(f"❌ Order sink disabled: {e}")
+
+
+def build_tenant_bot(tenant, previous=None):
+    """Bot for a tenant from TENANTS_FILE; a changed tenant keeps its stores and locks"""
+    if previous is not None:
+        target = WhatsAppOrderBot(user_states=previous.user_states, payment_sessions=previous.payment_sessions,
+                                  orders=previous.orders, tenant=tenant, customers=previous.customers)
+        target.session_locks = previous.session_locks
+    else:
+        target = WhatsAppOrderBot(tenant=tenant)
+    # Process-wide: one phone cache, one QR render pool, one order export, one event log
+    target.phones = bot.phones
+    target.qr_codes = bot.qr_codes
+    target.order_sink = bot.order_sink
+    target.events = bot.events
+    if previous is None and target.events is not None:
+        restored = target.restore(target.events.projection)
+        if restored:
+            logger.info(f"📜 Restored {restored} records of tenant {tenant.id} from the event log")
+    menu_source = tenant.menu_source or None
+    if previous is not None and previous.menu is not None and previous.tenant.menu_source == menu_source \
+            and previous.tenant.website_url == tenant.website_url:
+        target.menu = previous.menu
+    elif menu_source:
+        target.menu = MenuCatalog(create_menu_source(menu_source), tenant.website_url,
+                                  refresh_interval=MENU_REFRESH_INTERVAL, encoder=target.templates.encoder).start()
+    return target
+
+
+def retire_tenant_bot(old, new):
+    """Stop what a removed or replaced tenant bot no longer shares with its successor"""
+    if old.menu is not None and (new is None or new.menu is not old.menu):
+        old.menu.shutdown()
+    # Its pooled connections; a send still in flight finishes, the connection is then discarded
+    if new is None or new.client is not old.client:
+        old.client.close()
+
+
+tenants = TenantRouter(bot, build_tenant_bot, TENANTS_FILE or None, TENANTS_RELOAD_INTERVAL,
+                       retire=retire_tenant_bot).start()
+
+# Shared backends also share the seen-id set, so a retry landing on another worker is still skipped
+seen_messages = SeenMessageCache(
+    ttl=DEDUP_TTL,
+    max_entries=DEDUP_MAX_ENTRIES,
+    shared=None if STATE_BACKEND == 'memory' else create_state_store(
+        'seen_messages', STATE_BACKEND, sqlite_path=STATE_DB_PATH, redis_url=REDIS_URL,
+        max_entries=DEDUP_MAX_ENTRIES
+    )
+)
+
+dispatcher = OutboundDispatcher(
+    workers=DISPATCH_WORKERS,
+    queue_size=DISPATCH_QUEUE_SIZE,
+    enqueue_timeout=DISPATCH_ENQUEUE_TIMEOUT
+)
+
+message_executor = ShardedExecutor(
+    lanes=MESSAGE_LANES,
+    queue_size=MESSAGE_LANE_QUEUE_SIZE,
+    enqueue_timeout=DISPATCH_ENQUEUE_TIMEOUT,
+    name='messages'
+)
+
+
+campaigns = CampaignManager(
+    bot,
+    create_state_store('campaigns', CAMPAIGN_STATE_BACKEND, sqlite_path=STATE_DB_PATH, redis_url=REDIS_URL),
+    create_state_store('campaign_markers', CAMPAIGN_STATE_BACKEND, sqlite_path=STATE_DB_PATH, redis_url=REDIS_URL),
+    workers=CAMPAIGN_WORKERS,
+    rate=CAMPAIGN_RATE,
+    history_days=CUSTOMER_HISTORY_DAYS,
+    lease_ttl=CAMPAIGN_LEASE_TTL
+).start()
+
+STORE_SIZE.set_function(lambda: sum(len(target.user_states) for target in tenants.bots()), 'user_states')
+STORE_SIZE.set_function(lambda: sum(len(target.payment_sessions) for target in tenants.bots()), 'payment_sessions')
+STORE_SIZE.set_function(lambda: sum(len(target.orders) for target in tenants.bots()), 'orders')
+
+
+def shutdown_dispatcher():
+    """Drain queued sends before the process exits"""
+    tenants.shutdown()
+    campaigns.shutdown(timeout=DISPATCH_DRAIN_TIMEOUT)
+    message_executor.shutdown(timeout=DISPATCH_DRAIN_TIMEOUT)
+    dispatcher.shutdown(timeout=DISPATCH_DRAIN_TIMEOUT)
+    if bot.qr_codes is not None:
+        bot.qr_codes.shutdown()
+    if bot.order_sink is not None:
+        bot.order_sink.shutdown(timeout=DISPATCH_DRAIN_TIMEOUT)
+    for target in tenants.bots():
+        if target.menu is not None:
+            target.menu.shutdown()
+    if event_log is not None:
+        event_log.close()
+
+
+atexit.register(shutdown_dispatcher)
+
+
+@app.before_request
+def start_timer():
+    g.started = time.monotonic()
+
+
+@app.after_request
+def record_latency(response):
+    started = g.get('started')
+    if started is not None:
+        # Route rule, not the raw path, so /campaigns/<id> stays one series
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        WEBHOOK_LATENCY.labels(route).observe(time.monotonic() - started)
+    return response
 
 
 @app.before_request
@@ -482,18 +1029,25 @@ def google_sheets_webhook():
 
     try:
         data = request.json
-        print(f"📥 Google Sheets webhook: {json.dumps(data, indent=2)}")
+        log_payload(logger, "📥 Google Sheets webhook", data)
+
+        target = tenants.get(request.args.get('tenant') or data.get('tenant'))
+        if target is None:
+            return jsonify({'success': False, 'message': 'Unknown tenant'}), 404
+
+        if isinstance(data.get('orders'), list):
+            return bulk_orders(target, data['orders'], data.get('timestamp', datetime.now().isoformat()))
 
         order_data = data.get('order', {})
         timestamp = data.get('timestamp', datetime.now().isoformat())
 
         if order_data and order_data.get('name') and order_data.get('phone'):
             order_data['timestamp'] = timestamp
-            success = bot.send_order_confirmation(order_data)
+            dispatcher.submit(target.send_order_confirmation, order_data)
 
             return jsonify({
-                'success': success,
-                'message': 'Order processed',
+                'success': True,
+                'message': 'Order queued',
                 'timestamp': timestamp
             }), 200
         else:
@@ -502,129 +1056,278 @@ def google_sheets_webhook():
                 'message': 'Invalid order data'
             }), 400
 
+    except DispatchQueueFull as e:
+        logger.warning(f"⚠️ Outbound queue full, rejecting order: {e}")
+        return jsonify({
+            'success': False,
+            'error': 'Server busy, retry later'
+        }), 503
+
     except Exception as e:
-        print(f"❌ Error: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception(f"❌ Error: {e}")
         return jsonify({
             'success': False,
             'error': str(e)
         }), 500
 
 
+def bulk_orders(target, orders, timestamp):
+    """Queue a batch of sheet rows and report a status per order.
+
+    Orders go through the per-customer message lanes, so several rows for the
+    same phone are confirmed in sheet order. Statuses: success, invalid_order,
+    invalid_phone, send_failed, busy (queue full), timeout (dropped unsent at
+    the time limit) and pending (still sending at the time limit).
+    """
+    if len(orders) > BULK_MAX_ORDERS:
+        return jsonify({
+            'success': False,
+            'error': f'Too many orders in one request (max {BULK_MAX_ORDERS})'
+        }), 413
+
+    started = time.monotonic()
+    deadline = started + BULK_TIME_LIMIT
+    results, futures = queue_bulk_orders(target, orders, timestamp)
+
+    done, not_done = wait(futures.values(), timeout=max(0.0, deadline - time.monotonic()))
+    for index, future in futures.items():
+        if future in done:
+            sent = future.exception() is None and future.result()
+            results[index]['status'] = 'success' if sent else 'send_failed'
+        else:
+            # Still queued: drop it so the sheet can resend; already running: let it finish
+            results[index]['status'] = 'timeout' if future.cancel() else 'pending'
+
+    return jsonify(bulk_report(results, started, timestamp)), 200
+
+
+def queue_bulk_orders(target, orders, timestamp, submit=None):
+    """Validate sheet rows and queue the good ones, returns (results, {index: future})"""
+    submit = submit or message_executor.submit
+    results = []
+    futures = {}
+
+    for index, order_data in enumerate(orders):
+        result = {'index': index}
+        results.append(result)
+        if isinstance(order_data, dict) and 'row' in order_data:
+            result['row'] = order_data['row']
+
+        if not isinstance(order_data, dict) or not order_data.get('name') or not order_data.get('phone'):
+            result['status'] = 'invalid_order'
+            continue
+        normalized_phone = target.normalize_phone_number(order_data['phone'])
+        if not target.is_valid_phone(normalized_phone):
+            result['status'] = 'invalid_phone'
+            continue
+
+        order_data.setdefault('timestamp', timestamp)
+        try:
+            futures[index] = submit(normalized_phone, target.send_order_confirmation, order_data)
+        except DispatchQueueFull:
+            result['status'] = 'busy'
+    return results, futures
+
+
+def bulk_report(results, started, timestamp):
+    summary = {}
+    for result in results:
+        summary[result['status']] = summary.get(result['status'], 0) + 1
+    elapsed_ms = (time.monotonic() - started) * 1000
+    logger.info(f"📦 Bulk orders: {len(results)} in {elapsed_ms:.0f} ms {summary}")
+
+    return {
+        'success': summary.get('success', 0) == len(results),
+        'summary': summary,
+        'results': results,
+        'elapsed_ms': round(elapsed_ms, 1),
+        'timestamp': timestamp
+    }
+
+
+PAYMENT_SUCCESS_STATUSES = ('success', 'completed', 'paid', 'ok', '1', 'true', 'approved')
+
+
+def payment_params(args, form, json_data):
+    """(session id, payment status) from a Pay0 callback's query, form or JSON"""
+    # Get session ID from multiple sources
+    session_id = (
+        args.get('session') or 
+        args.get('sessionId') or
+        args.get('session_id') or
+        form.get('session') or 
+        form.get('sessionId') or
+        json_data.get('session') or
+        json_data.get('sessionId')
+    )
+    
+    # Get payment status
+    payment_status = (
+        args.get('status') or 
+        args.get('payment_status') or
+        form.get('status') or 
+        json_data.get('status', 'success')
+    )
+    return session_id, payment_status
+
+
+def payment_redirect(target, session_id):
+    """Where to send the customer after a successful payment"""
+    # Get phone number for redirect
+    session = target.payment_sessions.get(session_id, {})
+    phone = session.get('phone', '')
+    
+    if phone:
+        # Direct redirect to WhatsApp with pre-filled message
+        logger.info(f"✅ Redirecting to WhatsApp chat for {phone}")
+        return f"https://wa.me/{phone}?text=Order%20confirmed!%20Thanks%20for%20payment."
+    logger.error(f"❌ ERROR: Phone number not found in session! "
+                 f"(sessions by status: {target.payment_sessions.count_by_status()})")
+    return target.tenant.website_url
+
+
 @app.route('/payment/callback', methods=['GET', 'POST'])
-def payment_callback():
+@app.route('/payment/callback/<tenant_id>', methods=['GET', 'POST'])
+def payment_callback(tenant_id=None):
     """Handle Pay0.shop payment callback - ALL METHODS"""
+    target = tenants.get(tenant_id)
+    if target is None:
+        logger.error(f"❌ Payment callback for unknown tenant {tenant_id}")
+        return redirect(WEBSITE_URL)
     try:
-        print(f"\n{'='*70}")
-        print(f"💳 PAYMENT CALLBACK RECEIVED")
-        print(f"{'='*70}")
-        print(f"Method: {request.method}")
-        print(f"URL: {request.url}")
-        print(f"Args: {dict(request.args)}")
-        print(f"Form: {dict(request.form)}")
-        print(f"Headers: {dict(request.headers)}")
-        
+        logger.info(f"💳 PAYMENT CALLBACK RECEIVED ({request.method} {request.path})")
+
         # Try to get JSON data
         json_data = request.get_json(silent=True) or {}
-        print(f"JSON: {json_data}")
+        log_payload(logger, "💳 Payment callback request", {
+            'method': request.method,
+            'url': request.url,
+            'args': dict(request.args),
+            'form': dict(request.form),
+            'headers': {k: v for k, v in request.headers.items() if k.lower() not in ('authorization', 'cookie')},
+            'json': json_data
+        })
         
-        # Get session ID from multiple sources
-        session_id = (
-            request.args.get('session') or 
-            request.args.get('sessionId') or
-            request.args.get('session_id') or
-            request.form.get('session') or 
-            request.form.get('sessionId') or
-            json_data.get('session') or
-            json_data.get('sessionId')
-        )
-        
-        # Get payment status
-        payment_status = (
-            request.args.get('status') or 
-            request.args.get('payment_status') or
-            request.form.get('status') or 
-            json_data.get('status', 'success')
-        )
+        session_id, payment_status = payment_params(request.args, request.form, json_data)
         
-        print(f"\n📝 Extracted Data:")
-        print(f"   Session ID: {session_id}")
-        print(f"   Payment Status: {payment_status}")
-        print(f"{'='*70}\n")
+        logger.info(f"📝 Session ID: {session_id}, payment status: {payment_status}")
         
         if not session_id:
-            print("❌ ERROR: Session ID missing!")
-            print("   Redirecting to website...")
-            return redirect(WEBSITE_URL)
+            logger.error("❌ ERROR: Session ID missing! Redirecting to website...")
+            return redirect(target.tenant.website_url)
         
         # Process payment if successful
-        if payment_status.lower() in ['success', 'completed', 'paid', 'ok', '1', 'true', 'approved']:
-            print(f"✅ Payment successful! Processing...")
-            
+        if payment_status.lower() in PAYMENT_SUCCESS_STATUSES:
             # Send WhatsApp message
-            success = bot.process_payment_success(session_id)
+            success = target.process_payment_success(session_id, received_at=g.get('started'))
             
-            if success:
-                print(f"✅ WhatsApp message sent successfully!")
-            else:
-                print(f"⚠️ Warning: WhatsApp message may have failed")
-            
-            # Get phone number for redirect
-            session = bot.payment_sessions.get(session_id, {})
-            phone = session.get('phone', '')
+            if not success:
+                logger.warning(f"⚠️ Warning: WhatsApp message may have failed")
             
-            print(f"\n🔄 Preparing WhatsApp redirect...")
-            print(f"   Phone: {phone}")
-            
-            if phone:
-                # Direct redirect to WhatsApp with pre-filled message
-                whatsapp_link = f"https://wa.me/{phone}?text=Order%20confirmed!%20Thanks%20for%20payment."
-                print(f"✅ Redirecting to: {whatsapp_link}")
-                print(f"{'='*70}\n")
-                return redirect(whatsapp_link)
-            else:
-                print(f"❌ ERROR: Phone number not found in session!")
-                print(f"   Available sessions: {list(bot.payment_sessions.keys())}")
-                print(f"   Redirecting to website...")
-                return redirect(WEBSITE_URL)
+            return redirect(payment_redirect(target, session_id))
         else:
             # Payment failed - redirect to website
-            print(f"❌ Payment failed or cancelled: {payment_status}")
-            print(f"   Redirecting to website...")
-            return redirect(WEBSITE_URL)
+            logger.warning(f"❌ Payment failed or cancelled: {payment_status}")
+            return redirect(target.tenant.website_url)
             
     except Exception as e:
-        print(f"\n❌ CRITICAL ERROR in payment callback!")
-        print(f"Error: {e}")
-        import traceback
-        traceback.print_exc()
-        print(f"Redirecting to website...\n")
-        return redirect(WEBSITE_URL)
+        logger.exception(f"❌ CRITICAL ERROR in payment callback: {e}")
+        return redirect(target.tenant.website_url)
 
 
 # ALTERNATIVE ENDPOINTS - All redirect to main callback
 @app.route('/webhook/payo-callback', methods=['GET', 'POST'])
 def payo_callback():
     """Alternative callback endpoint - redirects to main"""
-    print("⚠️ Warning: Old callback URL used. Redirecting to new endpoint...")
+    logger.warning("⚠️ Warning: Old callback URL used. Redirecting to new endpoint...")
     return payment_callback()
 
 
 @app.route('/payment/success', methods=['GET', 'POST'])
 def payment_success():
     """Alternative success endpoint"""
-    print("✅ Payment success endpoint called")
+    logger.info("✅ Payment success endpoint called")
     return payment_callback()
 
 
 @app.route('/payment/failure', methods=['GET', 'POST'])
 def payment_failure():
     """Handle payment failure"""
-    print("❌ Payment failed or cancelled")
+    logger.warning("❌ Payment failed or cancelled")
     return redirect(WEBSITE_URL)
 
 
+def whatsapp_jobs(data, resolve):
+    """(user key, handler, args) jobs for the new messages in a webhook payload, plus their ids.
+
+    resolve(phone_number_id) picks the tenant bot for each change (tenants.for_phone_id).
+    """
+    jobs = []
+    message_ids = []
+    marked = []
+    try:
+        if 'entry' in data:
+            for entry in data['entry']:
+                for change in entry.get('changes', []):
+                    if change.get('field') == 'messages':
+                        value = change.get('value', {})
+                        messages = value.get('messages', [])
+                        if not messages:
+                            continue
+                        phone_number_id = value.get('metadata', {}).get('phone_number_id')
+                        target = resolve(phone_number_id)
+                        if target is None:
+                            logger.warning(f"⚠️ Skipping {len(messages)} messages for unknown phone number id "
+                                           f"{phone_number_id}")
+                            continue
+
+                        for message in messages:
+                            # Meta redelivers on slow acks; skip before touching any state
+                            if not seen_messages.first_seen(message.get('id')):
+                                logger.info(f"🔁 Skipping duplicate message {message.get('id')}")
+                                DUPLICATES.inc()
+                                continue
+                            marked.append(message.get('id'))
+
+                            phone_number = message['from']
+                            # Same customer -> same lane, so user_states transitions stay ordered
+                            user_key = target.normalize_phone_number(phone_number)
+
+                            if message.get('type') == 'text':
+                                message_body = message['text']['body']
+                                jobs.append((user_key, target.handle_basic_messages, (phone_number, message_body)))
+                                message_ids.append(message.get('id'))
+
+                            elif message.get('type') == 'interactive':
+                                if 'button_reply' in message['interactive']:
+                                    button_reply = message['interactive']['button_reply']
+                                    button_id = button_reply['id']
+                                    button_text = button_reply.get('title', '')
+                                    jobs.append((user_key, target.handle_button_response,
+                                                 (phone_number, button_id, button_text)))
+                                    message_ids.append(message.get('id'))
+                                elif 'list_reply' in message['interactive']:
+                                    row_id = message['interactive']['list_reply']['id']
+                                    jobs.append((user_key, target.handle_list_reply, (phone_number, row_id)))
+                                    message_ids.append(message.get('id'))
+    except Exception:
+        # Nothing from this payload is queued yet: a redelivery must find every message unseen
+        for message_id in marked:
+            seen_messages.forget(message_id)
+        raise
+    return jobs, message_ids
+
+
+def queue_whatsapp_jobs(jobs, message_ids):
+    try:
+        return message_executor.submit_batch(jobs, label='WhatsApp batch')
+    except Exception as e:
+        # Messages that never got queued must not count as seen on redelivery
+        for message_id in message_ids[getattr(e, 'submitted', 0):]:
+            seen_messages.forget(message_id)
+        raise
+
+
 @app.route('/webhook/whatsapp', methods=['GET', 'POST'])
 def whatsapp_webhook():
     """Handle WhatsApp webhook"""
@@ -640,34 +1343,18 @@ def whatsapp_webhook():
     elif request.method == 'POST':
         try:
             data = request.json
-            print(f"📥 WhatsApp webhook: {json.dumps(data, indent=2)}")
-
-            if 'entry' in data:
-                for entry in data['entry']:
-                    for change in entry.get('changes', []):
-                        if change.get('field') == 'messages':
-                            messages = change.get('value', {}).get('messages', [])
-
-                            for message in messages:
-                                phone_number = message['from']
-
-                                if message.get('type') == 'text':
-                                    message_body = message['text']['body']
-                                    bot.handle_basic_messages(phone_number, message_body)
-
-                                elif message.get('type') == 'interactive':
-                                    if 'button_reply' in message['interactive']:
-                                        button_reply = message['interactive']['button_reply']
-                                        button_id = button_reply['id']
-                                        button_text = button_reply.get('title', '')
-                                        bot.handle_button_response(phone_number, button_id, button_text)
+            log_payload(logger, "📥 WhatsApp webhook", data)
 
+            queue_whatsapp_jobs(*whatsapp_jobs(data, tenants.for_phone_id))
             return jsonify({'status': 'success'}), 200
 
+        except DispatchQueueFull as e:
+            # 503 makes Meta back off and redeliver later instead of piling on
+            logger.warning(f"⚠️ Outbound queue full, asking Meta to retry: {e}")
+            return jsonify({'error': 'Server busy'}), 503
+
         except Exception as e:
-            print(f"❌ Error: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception(f"❌ Error: {e}")
             return jsonify({'error': str(e)}), 500
 
 
@@ -685,7 +1372,7 @@ def test_order():
         'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M')
     }
     
-    print(f"\n🧪 Testing order confirmation...")
+    logger.info("🧪 Testing order confirmation...")
     success = bot.send_order_confirmation(sample_order)
     
     return jsonify({
@@ -701,7 +1388,7 @@ def test_payment():
     session_id = request.args.get('session', 'TEST123456789')
     
     # Create test session
-    bot.payment_sessions[session_id] = {
+    bot.payment_sessions.set(session_id, {
         'phone': '919876543210',
         'order_data': {
             'name': 'Test User',
@@ -710,29 +1397,215 @@ def test_payment():
             'total': 99
         },
         'timestamp': datetime.now().strftime('%Y%m%d%H%M%S'),
+        'created_at': time.time(),
         'status': 'pending'
-    }
+    }, ttl=STAGE_TTLS['payment_pending'])
     
-    print(f"🧪 Test payment session created: {session_id}")
+    logger.info(f"🧪 Test payment session created: {session_id}")
     
     # Redirect to callback
     return redirect(f'/payment/callback?session={session_id}&status=success')
 
 
+def project(record, fields):
+    """Keep only the requested fields of a stored record"""
+    if hasattr(record, 'to_dict'):
+        record = record.to_dict()
+    if not fields:
+        return record
+    return {field: record.get(field) for field in fields}
+
+
 @app.route('/sessions', methods=['GET'])
 def list_sessions():
-    """List all active payment sessions"""
-    return jsonify({
-        'sessions': bot.payment_sessions,
-        'user_states': bot.user_states,
-        'count': len(bot.payment_sessions)
-    })
+    """Page through payment sessions (or user states), filtered by phone, status or age (minutes).
+
+    Query params: tenant, collection=sessions|user_states, limit, cursor, fields=a,b and
+    format=ndjson to stream one JSON row per line instead of a single body.
+    """
+    target = tenants.get(request.args.get('tenant'))
+    if target is None:
+        return jsonify({'success': False, 'error': 'Unknown tenant'}), 404
+    collection = request.args.get('collection', 'sessions')
+    store = target.user_states if collection == 'user_states' else target.payment_sessions
+    name = 'user_states' if collection == 'user_states' else 'sessions'
+    fields = [f for f in request.args.get('fields', '').split(',') if f]
+    limit = min(request.args.get('limit', SESSIONS_PAGE_SIZE, type=int), SESSIONS_MAX_PAGE_SIZE)
+    cursor = request.args.get('cursor')
+
+    phone = request.args.get('phone')
+    status = request.args.get('status')
+    older_than = request.args.get('older_than', type=float)
+    newer_than = request.args.get('newer_than', type=float)
+
+    if name == 'sessions' and (phone or status or older_than is not None or newer_than is not None):
+        sessions = target.payment_sessions.find(
+            phone=target.normalize_phone_number(phone) if phone else None,
+            status=status,
+            older_than=older_than * 60 if older_than is not None else None,
+            newer_than=newer_than * 60 if newer_than is not None else None
+        )
+        return jsonify({
+            'sessions': {sid: project(record, fields) for sid, record in sessions.items()},
+            'count': len(sessions)
+        })
+
+    if request.args.get('format') == 'ndjson':
+        # Stream the whole collection (or up to limit rows if one was given) page by page
+        row_limit = request.args.get('limit', type=int)
+
+        def rows():
+            page_cursor = cursor
+            sent = 0
+            while True:
+                page, page_cursor = store.scan(page_cursor, SESSIONS_MAX_PAGE_SIZE)
+                for key, record in page:
+                    if row_limit is not None and sent >= row_limit:
+                        return
+                    yield json.dumps(dict(project(record, fields), id=key)) + '\n'
+                    sent += 1
+                if page_cursor is None:
+                    return
+
+        return Response(stream_with_context(rows()), mimetype='application/x-ndjson')
+
+    page, next_cursor = store.scan(cursor, limit)
+    response = {
+        name: {key: project(record, fields) for key, record in page},
+        'count': len(store),
+        'next_cursor': next_cursor
+    }
+    if name == 'sessions':
+        response['by_status'] = target.payment_sessions.count_by_status()
+    return jsonify(response)
+
+
+def require_admin():
+    """Error response unless the request carries the ADMIN_TOKEN bearer token"""
+    if not ADMIN_TOKEN:
+        return jsonify({'success': False, 'error': 'ADMIN_TOKEN is not configured'}), 403
+    if request.headers.get('Authorization') != f'Bearer {ADMIN_TOKEN}':
+        return jsonify({'success': False, 'error': 'Unauthorized'}), 401
+    return None
+
+
+@app.route('/campaigns', methods=['GET', 'POST'])
+def campaigns_endpoint():
+    """List campaigns, or start one.
+
+    POST body: message (plus optional button_text/url) or template (+ language),
+    and either recipients: [...] or source: "recent_customers" with days/status.
+    """
+    denied = require_admin()
+    if denied:
+        return denied
+
+    if request.method == 'GET':
+        return jsonify({'campaigns': campaigns.summaries(), 'stats': campaigns.snapshot()})
+
+    data = request.get_json(silent=True) or {}
+    recipients = data.get('recipients')
+    if recipients is None and data.get('source') == 'recent_customers':
+        try:
+            recipients = campaigns.recent_customers(days=data.get('days', 30), status=data.get('status'))
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+    if not isinstance(recipients, list):
+        return jsonify({'success': False, 'error': 'recipients list or source=recent_customers required'}), 400
+
+    try:
+        record = campaigns.create(
+            recipients,
+            message=data.get('message'),
+            button_text=data.get('button_text'),
+            url=data.get('url'),
+            template=data.get('template'),
+            language=data.get('language', 'en_US'),
+            name=data.get('name')
+        )
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    return jsonify({'success': True, 'campaign': campaigns.progress(record['id'])}), 201
+
+
+@app.route('/campaigns/<campaign_id>', methods=['GET'])
+@app.route('/campaigns/<campaign_id>/<action>', methods=['POST'])
+def campaign_endpoint(campaign_id, action=None):
+    """Progress/throughput of one campaign; POST .../pause, .../resume or .../cancel"""
+    denied = require_admin()
+    if denied:
+        return denied
+
+    actions = {'pause': campaigns.pause, 'resume': campaigns.resume, 'cancel': campaigns.cancel}
+    if action is not None:
+        if action not in actions:
+            return jsonify({'success': False, 'error': f'Unknown action {action}'}), 404
+        actions[action](campaign_id)
+
+    progress = campaigns.progress(campaign_id)
+    if progress is None:
+        return jsonify({'success': False, 'error': 'Campaign not found'}), 404
+    return jsonify({'success': True, 'campaign': progress})
+
+
+@app.route('/tenants', methods=['GET'])
+def tenants_endpoint():
+    """Active tenants (without tokens) and reload stats"""
+    denied = require_admin()
+    if denied:
+        return denied
+    return jsonify(tenants.snapshot())
+
+
+@app.route('/tenants/reload', methods=['POST'])
+def tenants_reload():
+    """Re-read TENANTS_FILE now instead of waiting for the next check"""
+    denied = require_admin()
+    if denied:
+        return denied
+    if not tenants.path:
+        return jsonify({'success': False, 'error': 'TENANTS_FILE is not configured'}), 400
+    reloaded = tenants.reload(force=True)
+    return jsonify({'success': reloaded, 'tenants': [target.tenant.id for target in tenants.bots()],
+                    'last_error': tenants.stats['last_error']}), 200 if reloaded else 422
+
+
+@app.route('/payment/qr', methods=['GET'])
+def payment_qr():
+    """Payment QR code PNG for a pending ?session= (rendered on the QR pool, served from cache)"""
+    target = tenants.get(request.args.get('tenant'))
+    png = payment_qr_png(target, request.args.get('session')) if target is not None else None
+    if png is None:
+        return jsonify({'success': False, 'error': 'No pending payment for this session'}), 404
+    # Only valid until the session is paid or expires
+    return Response(png, mimetype='image/png', headers={'Cache-Control': 'private, max-age=900'})
+
+
+def payment_qr_png(target, session_id):
+    future = target.payment_qr(session_id)
+    if future is None:
+        return None
+    try:
+        return future.result(timeout=PAYMENT_QR_RENDER_TIMEOUT)
+    except Exception as e:
+        logger.error(f"❌ Payment QR for session {session_id} unavailable: {e}")
+        return None
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus scrape endpoint"""
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
 
 
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
-    return jsonify({
+    return jsonify(health_info(bot))
+
+
+def health_info(target):
+    return {
         'status': 'healthy',
         'timestamp': datetime.now().isoformat(),
         'service': 'WhatsApp Order Bot with Pay0 Integration',
@@ -743,19 +1616,41 @@ def health_check():
             'payo_callback': '/webhook/payo-callback (redirects to /payment/callback)',
             'test_order': '/test/order (POST)',
             'test_payment': '/test/payment',
-            'sessions': '/sessions'
+            'sessions': '/sessions',
+            'campaigns': '/campaigns',
+            'payment_qr': '/payment/qr?session=',
+            'tenants': '/tenants',
+            'metrics': '/metrics'
         },
         'config': {
             'website_url': WEBSITE_URL,
             'server_url': SERVER_URL,
             'payment_provider': 'Pay0.shop',
-            'whatsapp_configured': bool(WHATSAPP_TOKEN and WHATSAPP_PHONE_ID)
+            'whatsapp_configured': bool(WHATSAPP_TOKEN and WHATSAPP_PHONE_ID),
+            'state_backend': STATE_BACKEND,
+            'tenants': len(tenants.bots())
         },
         'stats': {
-            'active_sessions': len(bot.payment_sessions),
-            'active_users': len(bot.user_states)
+            'active_sessions': len(target.payment_sessions),
+            'active_users': len(target.user_states),
+            'dispatcher': dispatcher.snapshot(),
+            'message_lanes': message_executor.snapshot(),
+            'dedup': seen_messages.snapshot(),
+            'rate_limit': target.client.limiter.snapshot() if getattr(target.client, 'limiter', None) else None,
+            'graph_api': target.client.snapshot() if hasattr(target.client, 'snapshot') else None,
+            'interactive': target.capabilities.snapshot(),
+            'phone_cache': target.phones.cache_info(),
+            'event_log': event_log.snapshot() if event_log is not None else None,
+            'campaigns': campaigns.snapshot(),
+            'payment_qr': target.qr_codes.snapshot() if target.qr_codes is not None else None,
+            'order_sink': target.order_sink.snapshot() if target.order_sink is not None else None,
+            'menu': target.menu.snapshot() if target.menu is not None else None,
+            'expiry': {
+                'user_states': dict(target.user_states.stats),
+                'payment_sessions': dict(target.payment_sessions.stats)
+            }
         }
-    })
+    }
 
 
 if __name__ == '__main__':
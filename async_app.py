@@ -0,0 +1,594 @@
+"""ASGI serving mode: the Chatbot routes on an asyncio event loop.
+
+    uvicorn async_app:app --host 0.0.0.0 --port 5000
+
+Same WhatsAppOrderBot logic, stores, lanes and event log as the Flask app
+(importing Chatbot sets them all up), but Graph API calls are coroutines on
+an httpx pool: a send is queued on the loop behind earlier sends to the same
+number and the handler moves on, so no thread ever waits on the network.
+
+With purely in-memory state (memory stores, no sqlite order sink buffer,
+no event log) the handlers run right on the loop; every loop <-> thread
+handoff costs GIL switches, which under load was slower than the threaded
+app. Sqlite writes, Redis round trips and event log commits do wait on I/O
+and would stall every connection, so with those the handlers run on the
+message lanes (or a worker thread) as in the Flask app.
+
+Served here: /webhook/whatsapp, /webhook/google-sheets, the payment callbacks,
+/payment/qr, /health and /metrics, for every tenant (one AsyncOrderBot per
+tenant bot, rebuilt when a tenants reload replaces it). The admin/test routes
+(/sessions, /campaigns, /tenants, /test/*) stay on the Flask app; campaigns keep
+using the threaded client.
+"""
+import asyncio
+import concurrent.futures
+import json
+import threading
+import time
+from datetime import datetime
+from fnmatch import fnmatch
+from urllib.parse import parse_qsl
+
+from Chatbot import (
+    WhatsAppOrderBot, bot as sync_bot, tenants, dispatcher, event_log, logger, log_payload, whatsapp_jobs,
+    queue_whatsapp_jobs, queue_bulk_orders, bulk_report, payment_params, payment_redirect, health_info,
+    shutdown_dispatcher, DispatchQueueFull, RateLimitExceeded, CircuitOpen, rate_limit_code, CORS_ORIGINS,
+    PAYMENT_SUCCESS_STATUSES, STATE_BACKEND, VERIFY_TOKEN, WEBSITE_URL, GRAPH_API_BASE, ASYNC_GRAPH_POOL_SIZE,
+    GRAPH_CONNECT_TIMEOUT, GRAPH_READ_TIMEOUT, BULK_MAX_ORDERS, BULK_TIME_LIMIT, DISPATCH_DRAIN_TIMEOUT,
+    PAYMENT_QR_RENDER_TIMEOUT, ORDER_SINK_STATE_BACKEND
+)
+from graph_client import AsyncGraphAPIClient
+from metrics import REGISTRY, FALLBACKS, WEBHOOK_LATENCY, PAYMENT_TO_SEND
+
+
+class AsyncOrderBot(WhatsAppOrderBot):
+    """WhatsAppOrderBot whose sends run on the event loop.
+
+    The handlers stay synchronous; the three send primitives queue a
+    coroutine and return a concurrent Future of its result right away.
+    Sends to one number run in the order they were queued, so a customer
+    still sees the confirmation before the payment link.
+    """
+
+    def __init__(self, base, client):
+        super().__init__(client, base.user_states, base.payment_sessions, base.orders, tenant=base.tenant,
+                         customers=base.customers)
+        # The threaded bot this one mirrors (a tenants reload may replace it)
+        self.base = base
+        # One process, one set of locks/caches/event log, whichever bot handles the message
+        self.session_locks = base.session_locks
+        self.capabilities = base.capabilities
+        self.phones = base.phones
+        self.events = base.events
+        self.qr_codes = base.qr_codes
+        self.order_sink = base.order_sink
+        self.menu = base.menu
+        self.loop = None
+        self.outbox = {}
+
+    def _send_text(self, phone_number, body, kind='text'):
+        return self._deliver(phone_number, self._send_text_async, phone_number, body, kind)
+
+    def _send_interactive(self, kind, phone_number, body, fallback_message):
+        return self._deliver(phone_number, self._send_interactive_async, kind, phone_number, body, fallback_message)
+
+    def send_interactive_buttons(self, phone_number, message, buttons):
+        body = self.templates.buttons(buttons).render(to=phone_number, body=message)
+        return self._deliver(phone_number, self._send_interactive_async, 'button', phone_number, body,
+                             self.fallback_text(message, buttons))
+
+    def _deliver(self, phone_number, send, *args):
+        """Queue send(*args) behind earlier sends to phone_number (callable from any thread).
+
+        The returned Future is always truthy: handlers act on the outcome
+        through when_sent(), routes wait for it with delivered().
+        """
+        if self.loop is None:
+            raise RuntimeError("AsyncOrderBot used before the ASGI app started")
+        if on_loop(self.loop):
+            return self.loop.create_task(self._in_order(phone_number, send, args))
+        return asyncio.run_coroutine_threadsafe(self._in_order(phone_number, send, args), self.loop)
+
+    def when_sent(self, result, callback):
+        """callback(sent) when the queued send finishes (on the loop thread)"""
+        if not queued_message(result):
+            return callback(result)
+
+        def done(future):
+            sent = not future.cancelled() and future.exception() is None and future.result()
+            try:
+                callback(sent)
+            except Exception as e:
+                logger.exception(f"❌ Send callback failed: {e}")
+
+        result.add_done_callback(done)
+
+    async def _in_order(self, phone_number, send, args):
+        # Tasks start in the order they were queued, so each one finds its predecessor here
+        previous = self.outbox.get(phone_number)
+        current = self.outbox[phone_number] = asyncio.current_task()
+        try:
+            if previous is not None:
+                await asyncio.wait([previous])
+            return await send(*args)
+        finally:
+            if self.outbox.get(phone_number) is current:
+                del self.outbox[phone_number]
+
+    async def _send_text_async(self, phone_number, body, kind='text'):
+        try:
+            response = await self.client.send_raw(body, phone_number, kind)
+            if response.status_code != 200:
+                logger.warning(f"📥 WhatsApp API Response: {response.status_code} - {response.text}")
+            return response.status_code == 200
+        except Exception as e:
+            logger.error(f"❌ Error sending message: {e}")
+            return False
+
+    async def _send_interactive_async(self, kind, phone_number, body, fallback_message):
+        """Interactive send with the same fallback rules as the threaded _send_interactive"""
+        if not self.capabilities.failing(kind):
+            try:
+                response = await self.client.send_raw(body, phone_number, kind)
+                if response.status_code == 200:
+                    self.capabilities.succeeded(kind)
+                    return True
+                elif rate_limit_code(response):
+                    return False
+                self._interactive_failed(kind, response)
+            except (RateLimitExceeded, CircuitOpen) as e:
+                # No text fallback, as in WhatsAppOrderBot._send_interactive
+                logger.warning(f"🚦 {kind} message not sent: {e}")
+                return False
+            except Exception as e:
+                logger.warning(f"Error sending {kind} message: {e}")
+
+        FALLBACKS.labels(kind).inc()
+        return await self._send_text_async(
+            phone_number, self.templates.render('text', to=phone_number, body=fallback_message))
+
+    async def drain(self, timeout):
+        """Wait for queued sends, returns how many recipients still had messages pending"""
+        pending = list(self.outbox.values())
+        if pending:
+            logger.info(f"🛑 Draining async sends ({len(pending)} recipients)...")
+            _, pending = await asyncio.wait(pending, timeout=timeout)
+        return len(pending)
+
+
+def on_loop(loop):
+    try:
+        return asyncio.get_running_loop() is loop
+    except RuntimeError:
+        return False
+
+
+async def delivered(result):
+    """A handler's return value, once the message it queued (if any) has been sent"""
+    if isinstance(result, asyncio.Future):
+        return await result
+    if isinstance(result, concurrent.futures.Future):
+        return await asyncio.wrap_future(result)
+    return result
+
+
+def queued_message(result):
+    return isinstance(result, (asyncio.Future, concurrent.futures.Future))
+
+
+# Handlers run on the loop only when no store they touch waits on disk or network
+INLINE_STATE = (STATE_BACKEND == 'memory' and event_log is None
+                and (sync_bot.order_sink is None or ORDER_SINK_STATE_BACKEND == 'memory'))
+
+
+async def run_state(fn, *args):
+    """fn(*args) on the loop with in-process state, otherwise on a worker thread"""
+    if INLINE_STATE:
+        return fn(*args)
+    return await asyncio.to_thread(fn, *args)
+
+
+def run_now(key, fn, *args):
+    """Stand-in for message_executor.submit that runs the job right away"""
+    future = concurrent.futures.Future()
+    try:
+        future.set_result(fn(*args))
+    except Exception as e:
+        logger.exception(f"❌ Job failed: {e}")
+        future.set_exception(e)
+    return future
+
+
+def async_client(base):
+    return AsyncGraphAPIClient(
+        base.tenant.token,
+        base.tenant.phone_id,
+        base_url=GRAPH_API_BASE,
+        pool_size=ASYNC_GRAPH_POOL_SIZE,
+        connect_timeout=GRAPH_CONNECT_TIMEOUT,
+        read_timeout=GRAPH_READ_TIMEOUT,
+        # Shared with the threaded client, so campaigns and conversations draw on one budget
+        limiter=base.client.limiter,
+        retry=base.client.retry,
+        breaker=base.client.breaker
+    )
+
+
+bot = AsyncOrderBot(sync_bot, async_client(sync_bot))
+
+# Async bots of the other tenants, by tenant id, created on their first message
+async_bots = {}
+async_bots_lock = threading.Lock()
+
+
+def async_bot(base):
+    """AsyncOrderBot for a tenant bot from the router (None passes through)"""
+    if base is None:
+        return None
+    if base is sync_bot:
+        return bot
+    current = async_bots.get(base.tenant.id)
+    if current is not None and current.base is base:
+        return current
+    with async_bots_lock:
+        current = async_bots.get(base.tenant.id)
+        if current is None or current.base is not base:
+            replaced = current
+            current = AsyncOrderBot(base, async_client(base))
+            current.loop = bot.loop
+            async_bots[base.tenant.id] = current
+            if replaced is not None:
+                # Reloaded tenant: let the old bot finish its queued sends, then close its pool
+                asyncio.run_coroutine_threadsafe(retire(replaced), bot.loop)
+    return current
+
+
+async def retire(old):
+    await old.drain(DISPATCH_DRAIN_TIMEOUT)
+    await old.client.close()
+
+
+def for_phone_id(phone_id):
+    return async_bot(tenants.for_phone_id(phone_id))
+
+
+def for_tenant(tenant_id):
+    return async_bot(tenants.get(tenant_id))
+
+
+# Minimal ASGI plumbing (no framework dependency beyond the server)
+
+def _first_values(pairs):
+    values = {}
+    for key, value in pairs:
+        values.setdefault(key, value)
+    return values
+
+
+class Request:
+    def __init__(self, scope, body):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.query_string = scope.get('query_string', b'').decode('latin-1')
+        self.args = _first_values(parse_qsl(self.query_string, keep_blank_values=True))
+        self.headers = {name.decode('latin-1').lower(): value.decode('latin-1')
+                        for name, value in scope.get('headers', [])}
+        self.body = body
+        self.started = time.monotonic()
+        # Set by /payment/callback/{tenant}
+        self.tenant = None
+
+    @property
+    def url(self):
+        host = self.headers.get('host', '')
+        return f"//{host}{self.path}" + (f"?{self.query_string}" if self.query_string else '')
+
+    def json(self):
+        try:
+            return json.loads(self.body) if self.body else None
+        except ValueError:
+            return None
+
+    @property
+    def form(self):
+        if self.headers.get('content-type', '').startswith('application/x-www-form-urlencoded'):
+            return _first_values(parse_qsl(self.body.decode('utf-8', 'replace'), keep_blank_values=True))
+        return {}
+
+
+class Response:
+    def __init__(self, body=b'', status=200, content_type='application/json', headers=None):
+        self.body = body if isinstance(body, bytes) else body.encode('utf-8')
+        self.status = status
+        self.headers = dict(headers or {})
+        if content_type:
+            self.headers['content-type'] = content_type
+
+    async def send(self, send):
+        self.headers['content-length'] = str(len(self.body))
+        await send({
+            'type': 'http.response.start',
+            'status': self.status,
+            'headers': [(name.encode('latin-1'), value.encode('latin-1')) for name, value in self.headers.items()]
+        })
+        await send({'type': 'http.response.body', 'body': self.body})
+
+
+def json_response(data, status=200):
+    return Response(json.dumps(data, ensure_ascii=False, default=str), status)
+
+
+def redirect(url):
+    return Response(status=302, content_type=None, headers={'location': url})
+
+
+ROUTES = {}
+# Paths ending in a {tenant} segment, by prefix
+PREFIX_ROUTES = {}
+
+
+def route(*paths, methods=('GET',)):
+    def register(handler):
+        for path in paths:
+            if path.endswith('/{tenant}'):
+                PREFIX_ROUTES[path[:-len('{tenant}')]] = (handler, methods, path)
+            else:
+                ROUTES[path] = (handler, methods)
+        return handler
+    return register
+
+
+def match(request):
+    """(handler, methods, route label) for a request, setting request.tenant from the path"""
+    handler, methods = ROUTES.get(request.path, (None, ()))
+    if handler is not None:
+        return handler, methods, request.path
+    prefix, _, tenant_id = request.path.rpartition('/')
+    handler, methods, template = PREFIX_ROUTES.get(prefix + '/', (None, (), 'unmatched'))
+    if handler is not None and tenant_id:
+        request.tenant = tenant_id
+        return handler, methods, template
+    return None, (), 'unmatched'
+
+
+def origin_allowed(origin):
+    return any(fnmatch(origin, pattern) for pattern in CORS_ORIGINS)
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            break
+    request = Request(scope, b''.join(chunks))
+
+    handler, methods, label = match(request)
+    if handler is None:
+        response = json_response({'error': 'Not found'}, 404)
+    elif request.method == 'OPTIONS':
+        response = json_response({'status': 'ok'}, 200)
+        response.headers.update({
+            'access-control-allow-origin': '*',
+            'access-control-allow-headers': 'Content-Type,Authorization',
+            'access-control-allow-methods': 'GET,POST,OPTIONS'
+        })
+    elif request.method not in methods:
+        response = json_response({'error': 'Method not allowed'}, 405)
+    else:
+        try:
+            response = await handler(request)
+        except Exception as e:
+            logger.exception(f"❌ Error: {e}")
+            response = json_response({'error': str(e)}, 500)
+
+    origin = request.headers.get('origin')
+    if origin and 'access-control-allow-origin' not in response.headers and origin_allowed(origin):
+        response.headers['access-control-allow-origin'] = origin
+        response.headers['vary'] = 'Origin'
+    await response.send(send)
+    WEBHOOK_LATENCY.labels(label).observe(time.monotonic() - request.started)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            bot.loop = asyncio.get_running_loop()
+            logger.info(f"🚀 Async app ready (Graph API pool {ASYNC_GRAPH_POOL_SIZE})")
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            # Lanes first: their jobs may still queue sends on the loop
+            await asyncio.to_thread(shutdown_dispatcher)
+            targets = [bot] + list(async_bots.values())
+            left = sum(await asyncio.gather(*[target.drain(DISPATCH_DRAIN_TIMEOUT) for target in targets]))
+            if left:
+                logger.warning(f"⚠️ Async send drain timed out, {left} recipients with unsent messages")
+            for target in targets:
+                await target.client.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+# Routes
+
+@route('/webhook/whatsapp', methods=('GET', 'POST'))
+async def whatsapp_webhook(request):
+    """Handle WhatsApp webhook"""
+    if request.method == 'GET':
+        if request.args.get('hub.verify_token') == VERIFY_TOKEN:
+            return Response(request.args.get('hub.challenge') or '', content_type='text/html; charset=utf-8')
+        return Response('Invalid token', 403, content_type='text/html; charset=utf-8')
+
+    data = request.json()
+    log_payload(logger, "📥 WhatsApp webhook", data)
+    try:
+        if INLINE_STATE:
+            jobs, _ = whatsapp_jobs(data, for_phone_id)
+            for key, handler, args in jobs:
+                run_now(key, handler, *args)
+        else:
+            # Dedup lookups and lane submission can block (shared backends, full lanes)
+            await asyncio.to_thread(lambda: queue_whatsapp_jobs(*whatsapp_jobs(data, for_phone_id)))
+    except DispatchQueueFull as e:
+        logger.warning(f"⚠️ Outbound queue full, asking Meta to retry: {e}")
+        return json_response({'error': 'Server busy'}, 503)
+    return json_response({'status': 'success'})
+
+
+@route('/webhook/google-sheets', methods=('POST',))
+async def google_sheets_webhook(request):
+    """Handle Google Sheets webhook"""
+    data = request.json()
+    log_payload(logger, "📥 Google Sheets webhook", data)
+    if not data:
+        return json_response({'success': False, 'message': 'No data received'}, 400)
+
+    target = for_tenant(request.args.get('tenant') or data.get('tenant'))
+    if target is None:
+        return json_response({'success': False, 'message': 'Unknown tenant'}, 404)
+
+    timestamp = data.get('timestamp', datetime.now().isoformat())
+    if isinstance(data.get('orders'), list):
+        return await bulk_orders(target, data['orders'], timestamp)
+
+    order_data = data.get('order', {})
+    if not (order_data and order_data.get('name') and order_data.get('phone')):
+        return json_response({'success': False, 'message': 'Invalid order data'}, 400)
+    order_data['timestamp'] = timestamp
+    try:
+        if INLINE_STATE:
+            target.send_order_confirmation(order_data)
+        else:
+            await asyncio.to_thread(dispatcher.submit, target.send_order_confirmation, order_data)
+    except DispatchQueueFull as e:
+        logger.warning(f"⚠️ Outbound queue full, rejecting order: {e}")
+        return json_response({'success': False, 'error': 'Server busy, retry later'}, 503)
+    return json_response({'success': True, 'message': 'Order queued', 'timestamp': timestamp})
+
+
+async def bulk_orders(target, orders, timestamp):
+    """Chatbot.bulk_orders, waiting on the sends instead of on lane threads"""
+    if len(orders) > BULK_MAX_ORDERS:
+        return json_response({
+            'success': False,
+            'error': f'Too many orders in one request (max {BULK_MAX_ORDERS})'
+        }, 413)
+
+    started = time.monotonic()
+    if INLINE_STATE:
+        results, futures = queue_bulk_orders(target, orders, timestamp, submit=run_now)
+    else:
+        results, futures = await asyncio.to_thread(queue_bulk_orders, target, orders, timestamp)
+
+    async def outcome(future):
+        try:
+            return await delivered(await asyncio.wrap_future(future))
+        except Exception:
+            return False
+
+    tasks = {index: asyncio.ensure_future(outcome(future)) for index, future in futures.items()}
+    if tasks:
+        await asyncio.wait(tasks.values(), timeout=max(0.0, started + BULK_TIME_LIMIT - time.monotonic()))
+    for index, task in tasks.items():
+        if task.done():
+            results[index]['status'] = 'success' if task.result() else 'send_failed'
+        else:
+            # Still queued on a lane: drop it so the sheet can resend; otherwise let it finish
+            results[index]['status'] = 'timeout' if futures[index].cancel() else 'pending'
+
+    return json_response(bulk_report(results, started, timestamp))
+
+
+@route('/payment/callback', '/payment/callback/{tenant}', '/webhook/payo-callback', '/payment/success',
+       methods=('GET', 'POST'))
+async def payment_callback(request):
+    """Handle Pay0.shop payment callback - ALL METHODS"""
+    target = for_tenant(request.tenant)
+    if target is None:
+        logger.error(f"❌ Payment callback for unknown tenant {request.tenant}")
+        return redirect(WEBSITE_URL)
+    website_url = target.tenant.website_url
+    try:
+        logger.info(f"💳 PAYMENT CALLBACK RECEIVED ({request.method} {request.path})")
+        json_data = request.json()
+        json_data = json_data if isinstance(json_data, dict) else {}
+        log_payload(logger, "💳 Payment callback request", {
+            'method': request.method,
+            'url': request.url,
+            'args': request.args,
+            'form': request.form,
+            'headers': {k: v for k, v in request.headers.items() if k not in ('authorization', 'cookie')},
+            'json': json_data
+        })
+
+        session_id, payment_status = payment_params(request.args, request.form, json_data)
+        logger.info(f"📝 Session ID: {session_id}, payment status: {payment_status}")
+        if not session_id:
+            logger.error("❌ ERROR: Session ID missing! Redirecting to website...")
+            return redirect(website_url)
+
+        if payment_status.lower() not in PAYMENT_SUCCESS_STATUSES:
+            logger.warning(f"❌ Payment failed or cancelled: {payment_status}")
+            return redirect(website_url)
+
+        result = await run_state(target.process_payment_success, session_id)
+        # Redirect once the message is out, like the Flask route
+        success = await delivered(result)
+        if queued_message(result):
+            PAYMENT_TO_SEND.observe(time.monotonic() - request.started)
+        if not success:
+            logger.warning(f"⚠️ Warning: WhatsApp message may have failed")
+        return redirect(payment_redirect(target, session_id))
+
+    except Exception as e:
+        logger.exception(f"❌ CRITICAL ERROR in payment callback: {e}")
+        return redirect(website_url)
+
+
+@route('/payment/failure', methods=('GET', 'POST'))
+async def payment_failure(request):
+    logger.warning("❌ Payment failed or cancelled")
+    return redirect(WEBSITE_URL)
+
+
+@route('/payment/qr')
+async def payment_qr(request):
+    """Payment QR code PNG for a pending ?session= (rendered on the QR pool, served from cache)"""
+    session_id = request.args.get('session')
+    target = tenants.get(request.args.get('tenant'))
+    future = await run_state(target.payment_qr, session_id) if target is not None else None
+    try:
+        png = await asyncio.wait_for(asyncio.wrap_future(future), PAYMENT_QR_RENDER_TIMEOUT) if future else None
+    except Exception as e:
+        logger.error(f"❌ Payment QR for session {session_id} unavailable: {e}")
+        png = None
+    if png is None:
+        return json_response({'success': False, 'error': 'No pending payment for this session'}, 404)
+    return Response(png, content_type='image/png', headers={'cache-control': 'private, max-age=900'})
+
+
+@route('/health')
+async def health_check(request):
+    info = health_info(bot)
+    info['stats']['async'] = {'mode': 'asgi', 'inline_state': INLINE_STATE,
+                              'recipients_sending': sum(len(target.outbox) for target in [bot, *async_bots.values()])}
+    return json_response(info)
+
+
+@route('/metrics')
+async def metrics_endpoint(request):
+    return Response(REGISTRY.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+if __name__ == '__main__':
+    import os
+    import uvicorn
+
+    uvicorn.run(app, host='0.0.0.0', port=int(os.environ.get('PORT', 5000)))
@@ -0,0 +1,125 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import re
+import sys
+from datetime import datetime, timezone
+
+LOGGER_NAME = 'whatsapp_bot'
+
+# 10-13 digit runs (optionally +prefixed) are phone numbers; longer runs are session ids
+PHONE_RE = re.compile(r'(?<![\d*])\+?(\d{6,9})(\d{4})(?!\d)')
+
+_listener = None
+_debug_sample_rate = 1.0
+
+
+def redact(text):
+    """Mask all but the last 4 digits of anything that looks like a phone number"""
+    return PHONE_RE.sub(lambda m: '*' * len(m.group(1)) + m.group(2), text)
+
+
+class RedactingFilter(logging.Filter):
+    """Strips phone numbers from the final message (runs on the listener thread)"""
+
+    def filter(self, record):
+        record.msg = redact(record.getMessage())
+        record.args = None
+        if record.exc_text:
+            record.exc_text = redact(record.exc_text)
+        return True
+
+
+class DebugSamplingFilter(logging.Filter):
+    """Lets through only a fraction of DEBUG records"""
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or getattr(record, 'sampled', False):
+            return True
+        return random.random() < _debug_sample_rate
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that counts and drops records when the queue is full"""
+
+    def __init__(self, record_queue):
+        super().__init__(record_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """One JSON object per line"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage()
+        }
+        fields = getattr(record, 'fields', None)
+        if fields:
+            entry.update(fields)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def setup_logging(level='INFO', fmt='json', debug_sample_rate=1.0, queue_size=10000):
+    """Route the bot's loggers through a non-blocking queue to stdout"""
+    global _listener, _debug_sample_rate
+    _debug_sample_rate = debug_sample_rate
+
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.setLevel(level)
+    logger.propagate = False
+    if _listener is not None:
+        return logger
+
+    output = logging.StreamHandler(sys.stdout)
+    if fmt == 'json':
+        output.setFormatter(JsonLinesFormatter())
+    else:
+        output.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    output.addFilter(RedactingFilter())
+
+    # Request threads only enqueue; redaction, JSON encoding and the stdout write
+    # happen on the listener thread. A full queue drops records instead of blocking.
+    handler = DroppingQueueHandler(queue.Queue(maxsize=queue_size))
+    handler.addFilter(DebugSamplingFilter())
+    logger.addHandler(handler)
+
+    _listener = logging.handlers.QueueListener(handler.queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+    return logger
+
+
+def get_logger(name=None):
+    return logging.getLogger(f"{LOGGER_NAME}.{name}" if name else LOGGER_NAME)
+
+
+def debug_enabled(logger):
+    """True when a DEBUG record from logger would be emitted (and wins the sample draw).
+
+    Check this before building expensive debug output such as payload dumps.
+    """
+    return logger.isEnabledFor(logging.DEBUG) and random.random() < _debug_sample_rate
+
+
+def log_payload(logger, label, data):
+    """Log a full payload at DEBUG, serializing it only if it will be written"""
+    if debug_enabled(logger):
+        # Already sampled by debug_enabled, so skip the second draw
+        logger.debug(f"{label}: {json.dumps(data, ensure_ascii=False, default=str)}", extra={'sampled': True})
@@ -0,0 +1,380 @@
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import wait
+
+from bot_logging import get_logger
+from dispatch import OutboundDispatcher, DispatchQueueFull
+from rate_limit import TokenBucket
+
+logger = get_logger('campaigns')
+
+RUNNING, PAUSED, COMPLETED, CANCELLED = 'running', 'paused', 'completed', 'cancelled'
+
+# Per-recipient delivery markers; 'sending' is written before the send, so a
+# crash mid-send never leads to a second copy (at-most-once delivery)
+SENDING, SENT, FAILED = 'sending', 'sent', 'failed'
+
+
+class CampaignRun:
+    """A campaign running in this process (the one holding its lease)"""
+
+    def __init__(self):
+        self.stop = threading.Event()
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+        self.sent_this_run = 0
+
+    def sent(self):
+        with self.lock:
+            self.sent_this_run += 1
+
+    def throughput(self):
+        elapsed = time.monotonic() - self.started
+        with self.lock:
+            return self.sent_this_run / elapsed if elapsed > 0 else 0.0
+
+
+class CampaignManager:
+    """Throttled broadcasts to a list of customers.
+
+    Each campaign streams its recipients through a shared worker pool at
+    `rate` messages/second (on top of the Graph API limiter). Before each send
+    a per-recipient marker is claimed with compare_and_set, so a restarted or
+    resumed campaign skips everyone who was already messaged.
+
+    With several workers sharing the stores, one process runs each campaign:
+    it holds a lease key in the marker store, renewed by start()'s watcher
+    thread, which also takes over running campaigns whose lease ran out.
+    pause/cancel only change the record's status; the running process reads
+    it back at every checkpoint (every `checkpoint_interval` seconds), and
+    the counts it checkpoints are tallied from the markers, so they stay
+    right whichever process wrote them.
+    """
+
+    def __init__(self, bot, store, markers, workers=4, rate=5.0, queue_size=100,
+                 marker_ttl=7 * 86400, checkpoint_interval=2.0, history_days=90, lease_ttl=30.0):
+        self.bot = bot
+        self.history_days = history_days
+        self.store = store
+        self.markers = markers
+        self.rate = rate
+        self.marker_ttl = marker_ttl
+        self.checkpoint_interval = checkpoint_interval
+        self.lease_ttl = lease_ttl
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.pool = OutboundDispatcher(workers=workers, queue_size=queue_size, name='campaign')
+        self.runs = {}
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+
+    # Recipients
+
+    def dedupe(self, phones):
+        """Normalized, valid, unique numbers in their original order"""
+        numbers, _ = self.bot.phones.normalize_many(phones)
+        return numbers
+
+    def recent_customers(self, days=30, status=None):
+        """Phones with an order (status: pending/completed) in the last `days` days, oldest first.
+
+        Read from the bot's customer history, not the payment sessions, which
+        expire within a day; the history itself only reaches back history_days.
+        """
+        if days > self.history_days:
+            raise ValueError(f"Customer history only covers the last {self.history_days:g} days")
+        cutoff = time.time() - days * 86400
+        recent = []
+        for phone, record in self.bot.customers.items():
+            seen = record.get('seen', {})
+            last = seen.get(status) if status else max(seen.values(), default=None)
+            if last is not None and last >= cutoff:
+                recent.append((last, phone))
+        return [phone for _, phone in sorted(recent)]
+
+    # Lifecycle
+
+    def create(self, recipients, message=None, button_text=None, url=None,
+               template=None, language='en_US', name=None):
+        """Store a new campaign and start sending, returns its record"""
+        if not message and not template:
+            raise ValueError("A campaign needs a message or a template name")
+        if button_text and not url:
+            raise ValueError("button_text needs a url")
+        phones = self.dedupe(recipients)
+        campaign_id = uuid.uuid4().hex[:12]
+        record = {
+            'id': campaign_id,
+            'name': name or campaign_id,
+            'message': message,
+            'button_text': button_text,
+            'url': url,
+            'template': template,
+            'language': language,
+            'recipients': phones,
+            'total': len(phones),
+            'status': RUNNING,
+            'sent': 0,
+            'failed': 0,
+            'skipped': 0,
+            'created_at': time.time(),
+            'updated_at': time.time()
+        }
+        self.store.set(campaign_id, record)
+        logger.info(f"📣 Campaign {campaign_id} created for {len(phones)} recipients "
+                    f"({len(recipients) - len(phones)} duplicates/invalid dropped)")
+        self._start(campaign_id, record)
+        return record
+
+    def _start(self, campaign_id, record):
+        with self.lock:
+            if campaign_id in self.runs or not self._claim(campaign_id):
+                return False
+            run = self.runs[campaign_id] = CampaignRun()
+        threading.Thread(target=self._run, args=(campaign_id, record, run),
+                         name=f"campaign-{campaign_id}", daemon=True).start()
+        return True
+
+    # Ownership
+
+    def _lease(self, campaign_id):
+        return f"{campaign_id}:lease"
+
+    def _claim(self, campaign_id):
+        """Take or renew the campaign's lease, False while another process holds it"""
+        key = self._lease(campaign_id)
+        current = self.markers.get(key)
+        holder = current.get('owner') if current else None
+        if holder not in (None, self.owner):
+            return False
+        return self.markers.compare_and_set(key, 'owner', holder, {'owner': self.owner}, ttl=self.lease_ttl)
+
+    def _release(self, campaign_id):
+        self.markers.compare_and_set(self._lease(campaign_id), 'owner', self.owner, None)
+
+    def _renew(self):
+        with self.lock:
+            runs = list(self.runs.items())
+        for campaign_id, run in runs:
+            if self._claim(campaign_id):
+                continue
+            logger.warning(f"⚠️ Campaign {campaign_id} lease lost, leaving it to its new owner")
+            run.stop.set()
+            with self.lock:
+                if self.runs.get(campaign_id) is run:
+                    del self.runs[campaign_id]
+
+    def start(self):
+        """Resume running campaigns, then keep leases alive and adopt campaigns of stopped workers"""
+        self.resume_incomplete()
+        threading.Thread(target=self._watch, name='campaign-lease', daemon=True).start()
+        return self
+
+    def _watch(self):
+        while not self.stopping.wait(self.lease_ttl / 3):
+            try:
+                self._renew()
+                self.resume_incomplete()
+            except Exception as e:
+                logger.warning(f"⚠️ Campaign lease renewal failed: {e}")
+
+    def _set_status(self, campaign_id, status):
+        return self.store.patch(campaign_id, {'status': status, 'updated_at': time.time()})
+
+    def pause(self, campaign_id):
+        return self._stop(campaign_id, PAUSED)
+
+    def cancel(self, campaign_id):
+        return self._stop(campaign_id, CANCELLED)
+
+    def _stop(self, campaign_id, status):
+        record = self.store.get(campaign_id)
+        if record is None or record['status'] in (COMPLETED, CANCELLED):
+            return record
+        # The process running it (maybe another worker) sees this at its next checkpoint
+        record = self._set_status(campaign_id, status)
+        with self.lock:
+            # Detach a local run now so a quick resume() can start a fresh one
+            run = self.runs.pop(campaign_id, None)
+        if run is not None:
+            run.stop.set()
+        logger.info(f"⏸ Campaign {campaign_id} {status}")
+        return record
+
+    def resume(self, campaign_id):
+        record = self.store.get(campaign_id)
+        if record is None or record['status'] in (COMPLETED, CANCELLED):
+            return record
+        record = self._set_status(campaign_id, RUNNING)
+        self._start(campaign_id, record)
+        return record
+
+    def resume_incomplete(self):
+        """Pick up running campaigns that no live process holds (restarted or stopped workers)"""
+        resumed = 0
+        for campaign_id, record in self.store.items():
+            if record.get('status') == RUNNING and self._start(campaign_id, record):
+                resumed += 1
+        if resumed:
+            logger.info(f"📣 Resumed {resumed} running campaign(s)")
+        return resumed
+
+    # Sending
+
+    def _run(self, campaign_id, record, run):
+        bucket = TokenBucket(self.rate, max(1.0, self.rate))
+        phones = record['recipients']
+        futures = []
+        last_checkpoint = time.monotonic()
+        completed = False
+        try:
+            for start in range(0, len(phones), 100):
+                chunk = phones[start:start + 100]
+                done = self.markers.get_many([self._marker(campaign_id, phone) for phone in chunk])
+                for phone in chunk:
+                    if run.stop.is_set():
+                        return
+                    if self._marker(campaign_id, phone) in done:
+                        continue
+                    time.sleep(bucket.reserve())
+                    future = self._submit(run, campaign_id, record, phone)
+                    if future is None:
+                        return
+                    futures.append(future)
+                    if time.monotonic() - last_checkpoint >= self.checkpoint_interval:
+                        if not self._still_running(campaign_id, phones, run):
+                            return
+                        last_checkpoint = time.monotonic()
+                # Only keep futures that are still running
+                futures = [future for future in futures if not future.done()]
+
+            # Queued sends check run.stop before claiming their marker, so a pause still counts here
+            while futures:
+                futures = list(wait(futures, timeout=self.checkpoint_interval).not_done)
+                if futures and not self._still_running(campaign_id, phones, run):
+                    return
+            current = self.store.get(campaign_id) or {}
+            if current.get('status') == RUNNING and not run.stop.is_set():
+                # Final numbers come from the markers, which also cover earlier runs
+                counts = self._tally(campaign_id, phones, final=True)
+                counts['throughput_per_s'] = round(run.throughput(), 2)
+                self._checkpoint(campaign_id, phones, status=COMPLETED, extra=counts)
+                completed = True
+                logger.info(f"✅ Campaign {campaign_id} completed: {counts}")
+        except Exception as e:
+            logger.exception(f"❌ Campaign {campaign_id} stopped: {e}")
+        finally:
+            with self.lock:
+                if self.runs.get(campaign_id) is run:
+                    del self.runs[campaign_id]
+                # A quick resume() may have started a new run here, which keeps the lease
+                restarted = campaign_id in self.runs
+            if not completed:
+                # Let sends already talking to the API finish, so the checkpoint includes them
+                wait(futures, timeout=self.checkpoint_interval)
+                self._checkpoint(campaign_id, phones)
+            if not restarted:
+                self._release(campaign_id)
+
+    def _still_running(self, campaign_id, phones, run):
+        """Checkpoint, and stop the run if it was paused or cancelled (possibly through another worker)"""
+        current = self._checkpoint(campaign_id, phones)
+        if current is None or current.get('status') != RUNNING:
+            run.stop.set()
+        return not run.stop.is_set()
+
+    def _submit(self, run, campaign_id, record, phone):
+        while True:
+            try:
+                return self.pool.submit(self._send_one, run, campaign_id, record, phone)
+            except DispatchQueueFull:
+                # Pool is busy (or slowed by the Graph API limiter): wait for room
+                if run.stop.wait(0.5):
+                    return None
+
+    def _marker(self, campaign_id, phone):
+        return f"{campaign_id}:{phone}"
+
+    def _send_one(self, run, campaign_id, record, phone):
+        key = self._marker(campaign_id, phone)
+        if run.stop.is_set():
+            return False
+        if not self.markers.compare_and_set(key, 'status', None, {'status': SENDING}, ttl=self.marker_ttl):
+            return False
+
+        bot = self.bot
+        if record.get('template'):
+            ok = bot.send_template_message(phone, record['template'], record.get('language') or 'en_US')
+        elif record.get('button_text'):
+            ok = bot.send_cta_button(phone, record['message'], record['button_text'], record['url'])
+        else:
+            ok = bot.send_whatsapp_message(phone, record['message'])
+
+        self.markers.set(key, {'status': SENT if ok else FAILED}, ttl=self.marker_ttl)
+        if ok:
+            run.sent()
+        return ok
+
+    def _tally(self, campaign_id, phones, final=False):
+        """Counts from the delivery markers; skipped are sends that never finished (once final: no result)"""
+        counts = {SENT: 0, FAILED: 0, SENDING: 0}
+        for start in range(0, len(phones), 500):
+            markers = self.markers.get_many([self._marker(campaign_id, phone) for phone in phones[start:start + 500]])
+            for marker in markers.values():
+                if marker.get('status') in counts:
+                    counts[marker['status']] += 1
+        skipped = len(phones) - counts[SENT] - counts[FAILED] if final else counts[SENDING]
+        return {'sent': counts[SENT], 'failed': counts[FAILED], 'skipped': skipped}
+
+    def _checkpoint(self, campaign_id, phones, status=None, extra=None):
+        changes = dict(self._tally(campaign_id, phones), updated_at=time.time())
+        if extra:
+            changes.update(extra)
+        if status:
+            changes['status'] = status
+        return self.store.patch(campaign_id, changes)
+
+    # Reporting
+
+    def progress(self, campaign_id):
+        """Campaign record (without the recipient list) plus live progress"""
+        record = self.store.get(campaign_id)
+        if record is None:
+            return None
+        info = {key: value for key, value in record.items() if key != 'recipients'}
+        with self.lock:
+            run = self.runs.get(campaign_id)
+        # Counts as of the last checkpoint, written by whichever process runs it
+        throughput = run.throughput() if run is not None else info.get('throughput_per_s') or 0.0
+        processed = info['sent'] + info['failed'] + info['skipped']
+        remaining = max(0, info['total'] - processed)
+        info['processed'] = processed
+        info['remaining'] = remaining
+        info['percent'] = round(100.0 * processed / info['total'], 1) if info['total'] else 100.0
+        info['active_here'] = run is not None
+        info['throughput_per_s'] = round(throughput, 2)
+        info['eta_seconds'] = round(remaining / throughput) if throughput else None
+        return info
+
+    def summaries(self):
+        return [self.progress(campaign_id) for campaign_id in self.store.keys()]
+
+    def snapshot(self):
+        with self.lock:
+            running = list(self.runs)
+        return {'running_here': running, 'pool': self.pool.snapshot()}
+
+    def shutdown(self, timeout=10):
+        """Stop feeding new sends (campaigns stay 'running': another worker or a restart resumes them)"""
+        self.stopping.set()
+        with self.lock:
+            runs = list(self.runs.items())
+        for _, run in runs:
+            run.stop.set()
+        drained = self.pool.shutdown(timeout=timeout)
+        # Hand the campaigns over now instead of after the lease runs out
+        for campaign_id, _ in runs:
+            self._release(campaign_id)
+        return drained
@@ -0,0 +1,59 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class SeenMessageCache:
+    """Remembers recently handled WhatsApp message ids so redeliveries are skipped.
+
+    A bounded LRU with TTL answers repeats seen by this worker; an optional
+    shared StateStore (sqlite/redis) makes the first-seen check atomic across
+    workers.
+    """
+
+    def __init__(self, ttl=86400, max_entries=100000, shared=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.shared = shared
+        self.local = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {'checked': 0, 'duplicates': 0}
+
+    def _remember(self, message_id, now):
+        local = self.local
+        local[message_id] = now + self.ttl
+        local.move_to_end(message_id)
+        while len(local) > self.max_entries:
+            local.popitem(last=False)
+
+    def first_seen(self, message_id):
+        """Record message_id, returns False if it was already handled"""
+        if not message_id:
+            return True
+        now = time.time()
+        with self.lock:
+            self.stats['checked'] += 1
+            expires = self.local.get(message_id)
+            if expires is not None and expires > now:
+                self.stats['duplicates'] += 1
+                return False
+            self._remember(message_id, now)
+
+        if self.shared is not None:
+            claimed = self.shared.compare_and_set(message_id, 'seen', None, {'seen': True}, ttl=self.ttl)
+            if not claimed:
+                with self.lock:
+                    self.stats['duplicates'] += 1
+                return False
+        return True
+
+    def forget(self, message_id):
+        """Undo first_seen for a message that could not be processed"""
+        with self.lock:
+            self.local.pop(message_id, None)
+        if self.shared is not None:
+            self.shared.delete(message_id)
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats, cached=len(self.local))
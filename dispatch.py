@@ -0,0 +1,210 @@
+import queue
+import threading
+import time
+import zlib
+from concurrent.futures import Future
+
+from bot_logging import get_logger
+from metrics import QUEUE_WAIT
+
+logger = get_logger('dispatch')
+
+
+class DispatchQueueFull(Exception):
+    """Raised when the outbound queue stays full past the enqueue timeout"""
+
+
+class OutboundDispatcher:
+    """Bounded queue drained by a pool of worker threads"""
+
+    _STOP = object()
+
+    def __init__(self, workers=4, queue_size=1000, enqueue_timeout=2.0, name='outbound', queue_label=None):
+        self.name = name
+        self.queue_wait = QUEUE_WAIT.labels(queue_label or name)
+        self.enqueue_timeout = enqueue_timeout
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.workers = []
+        self.closed = False
+        self._lock = threading.Lock()
+        self.stats = {
+            'submitted': 0,
+            'completed': 0,
+            'failed': 0,
+            'rejected': 0,
+            'in_flight': 0
+        }
+
+        for i in range(workers):
+            worker = threading.Thread(target=self._run, name=f"{name}-{i+1}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, fn, *args, **kwargs):
+        """Queue a call, blocking up to enqueue_timeout while the queue is full"""
+        if self.closed:
+            raise DispatchQueueFull(f"{self.name} dispatcher is shut down")
+
+        future = Future()
+        try:
+            self.queue.put((future, fn, args, kwargs, time.monotonic()), timeout=self.enqueue_timeout)
+        except queue.Full:
+            with self._lock:
+                self.stats['rejected'] += 1
+            raise DispatchQueueFull(f"{self.name} queue is full ({self.queue.maxsize} pending)")
+
+        with self._lock:
+            self.stats['submitted'] += 1
+        return future
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is self._STOP:
+                    return
+                future, fn, args, kwargs, enqueued_at = item
+                if not future.set_running_or_notify_cancel():
+                    continue
+                self.queue_wait.observe(time.monotonic() - enqueued_at)
+
+                with self._lock:
+                    self.stats['in_flight'] += 1
+                try:
+                    future.set_result(fn(*args, **kwargs))
+                    with self._lock:
+                        self.stats['completed'] += 1
+                except Exception as e:
+                    logger.exception(f"❌ {self.name} job failed: {e}")
+                    future.set_exception(e)
+                    with self._lock:
+                        self.stats['failed'] += 1
+                finally:
+                    with self._lock:
+                        self.stats['in_flight'] -= 1
+            finally:
+                self.queue.task_done()
+
+    def snapshot(self):
+        """Current counters plus queue depth"""
+        with self._lock:
+            stats = dict(self.stats)
+        stats['queued'] = self.queue.qsize()
+        stats['workers'] = len(self.workers)
+        return stats
+
+    def shutdown(self, timeout=30, verbose=True):
+        """Stop accepting work and drain whatever is already queued"""
+        with self._lock:
+            if self.closed:
+                return True
+            self.closed = True
+
+        if verbose:
+            logger.info(f"🛑 Draining {self.name} dispatcher ({self.queue.qsize()} queued)...")
+        deadline = time.monotonic() + timeout
+        for _ in self.workers:
+            # Stop markers queue up behind pending jobs, so workers finish those first
+            remaining = max(0.0, deadline - time.monotonic())
+            try:
+                self.queue.put(self._STOP, timeout=remaining)
+            except queue.Full:
+                break
+
+        for worker in self.workers:
+            worker.join(max(0.0, deadline - time.monotonic()))
+
+        alive = sum(1 for worker in self.workers if worker.is_alive())
+        if alive:
+            logger.warning(f"⚠️ {self.name} dispatcher drain timed out, {self.queue.qsize()} jobs dropped")
+            return False
+        if verbose:
+            logger.info(f"✅ {self.name} dispatcher drained")
+        return True
+
+
+class ShardedExecutor:
+    """Runs jobs in key-affine lanes: same key in order, different keys in parallel"""
+
+    def __init__(self, lanes=8, queue_size=200, enqueue_timeout=2.0, name='sharded'):
+        self.name = name
+        self.lanes = [
+            OutboundDispatcher(workers=1, queue_size=queue_size,
+                               enqueue_timeout=enqueue_timeout, name=f"{name}-lane{i+1}", queue_label=name)
+            for i in range(lanes)
+        ]
+        self._lock = threading.Lock()
+        self.batch_stats = {
+            'batches': 0,
+            'messages': 0,
+            'last_ms': 0.0,
+            'max_ms': 0.0,
+            'total_ms': 0.0
+        }
+
+    def lane_for(self, key):
+        return self.lanes[zlib.crc32(str(key).encode()) % len(self.lanes)]
+
+    def submit(self, key, fn, *args, **kwargs):
+        """Queue a call on the lane owning key"""
+        return self.lane_for(key).submit(fn, *args, **kwargs)
+
+    def submit_batch(self, jobs, label='batch'):
+        """Queue (key, fn, args) jobs and report when the whole batch has finished"""
+        started = time.monotonic()
+        futures = []
+        for key, fn, args in jobs:
+            try:
+                futures.append(self.submit(key, fn, *args))
+            except DispatchQueueFull as e:
+                # Let the caller know which jobs made it in before the lane filled up
+                e.submitted = len(futures)
+                raise
+        if not futures:
+            return futures
+
+        pending = [len(futures)]
+        pending_lock = threading.Lock()
+
+        def on_done(_):
+            with pending_lock:
+                pending[0] -= 1
+                if pending[0]:
+                    return
+            self._record_batch(label, len(futures), (time.monotonic() - started) * 1000)
+
+        for future in futures:
+            future.add_done_callback(on_done)
+        return futures
+
+    def _record_batch(self, label, size, elapsed_ms):
+        with self._lock:
+            stats = self.batch_stats
+            stats['batches'] += 1
+            stats['messages'] += size
+            stats['last_ms'] = round(elapsed_ms, 2)
+            stats['max_ms'] = round(max(stats['max_ms'], elapsed_ms), 2)
+            stats['total_ms'] += elapsed_ms
+        logger.info(f"⏱ {label}: {size} messages handled in {elapsed_ms:.1f} ms")
+
+    def snapshot(self):
+        """Batch timings plus per-lane queue depth"""
+        with self._lock:
+            stats = dict(self.batch_stats)
+        stats['avg_ms'] = round(stats['total_ms'] / stats['batches'], 2) if stats['batches'] else 0.0
+        stats['total_ms'] = round(stats['total_ms'], 2)
+        stats['lanes'] = len(self.lanes)
+        stats['queued'] = sum(lane.queue.qsize() for lane in self.lanes)
+        return stats
+
+    def shutdown(self, timeout=30):
+        """Drain every lane within a shared deadline"""
+        queued = sum(lane.queue.qsize() for lane in self.lanes)
+        logger.info(f"🛑 Draining {self.name} lanes ({queued} queued)...")
+        deadline = time.monotonic() + timeout
+        drained = True
+        for lane in self.lanes:
+            drained = lane.shutdown(timeout=max(0.0, deadline - time.monotonic()), verbose=False) and drained
+        if drained:
+            logger.info(f"✅ {self.name} lanes drained")
+        return drained
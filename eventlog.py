@@ -0,0 +1,342 @@
+import glob
+import json
+import os
+import queue
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from bot_logging import get_logger
+from state_machine import AWAITING_CONFIRMATION, PAYMENT_PENDING
+
+logger = get_logger('eventlog')
+
+# Event types
+ORDER_RECEIVED = 'order_received'
+ORDER_EDITED = 'order_edited'
+SESSION_CREATED = 'session_created'
+ORDER_CONFIRMED = 'order_confirmed'
+PAYMENT_COMPLETED = 'payment_completed'
+
+
+class OrderProjection:
+    """Order/session state folded from events, as {collection: {key: [expires_at, value]}}.
+
+    Mirrors what the bot keeps in user_states, orders and payment_sessions,
+    with the same per-stage TTLs, so it can repopulate empty stores.
+    """
+
+    COLLECTIONS = ('user_states', 'orders', 'payment_sessions')
+
+    def __init__(self, stage_ttls):
+        self.stage_ttls = stage_ttls
+        self.collections = {name: {} for name in self.COLLECTIONS}
+        self.handlers = {
+            ORDER_RECEIVED: self._order_received,
+            ORDER_EDITED: self._order_edited,
+            SESSION_CREATED: self._session_created,
+            ORDER_CONFIRMED: self._order_confirmed,
+            PAYMENT_COMPLETED: self._payment_completed
+        }
+
+    def apply(self, event):
+        handler = self.handlers.get(event['type'])
+        if handler is not None:
+            handler(event['key'], event['data'], event['ts'])
+
+    def _get(self, name, key):
+        entry = self.collections[name].get(key)
+        return entry[1] if entry is not None else None
+
+    def _put(self, name, key, value, ts, stage):
+        self.collections[name][key] = [ts + self.stage_ttls[stage], value]
+
+    def _order_received(self, phone, data, ts):
+        previous = self._get('user_states', phone)
+        if previous and previous.get('order_ref'):
+            self.collections['orders'].pop(previous['order_ref'], None)
+        self._put('orders', data['order_ref'], data['order'], ts, AWAITING_CONFIRMATION)
+        self._put('user_states', phone, {
+            'stage': AWAITING_CONFIRMATION,
+            'order_ref': data['order_ref'],
+            'whatsapp_phone': data.get('whatsapp_phone'),
+            'updated_at': ts
+        }, ts, AWAITING_CONFIRMATION)
+
+    def _order_edited(self, phone, data, ts):
+        self.collections['user_states'].pop(phone, None)
+        self.collections['orders'].pop(data.get('order_ref'), None)
+
+    def _session_created(self, session_id, data, ts):
+        self._put('payment_sessions', session_id, data['session'], ts, PAYMENT_PENDING)
+
+    def _order_confirmed(self, phone, data, ts):
+        self.collections['orders'].pop(data.get('order_ref'), None)
+        self._put('user_states', phone, {
+            'stage': PAYMENT_PENDING,
+            'session_id': data['session_id'],
+            'whatsapp_phone': data.get('whatsapp_phone'),
+            'updated_at': ts
+        }, ts, PAYMENT_PENDING)
+
+    def _payment_completed(self, session_id, data, ts):
+        session = self._get('payment_sessions', session_id)
+        if session is not None:
+            completed = dict(session, status='completed', order_id=data.get('order_id'))
+            self._put('payment_sessions', session_id, completed, ts, 'completed')
+        state = self._get('user_states', data.get('phone'))
+        if state is not None and state.get('session_id') == session_id:
+            self.collections['user_states'].pop(data['phone'], None)
+
+    def prune(self, now=None):
+        """Drop entries whose TTL has run out"""
+        now = now or time.time()
+        for collection in self.collections.values():
+            for key in [key for key, (expires_at, _) in collection.items() if expires_at <= now]:
+                del collection[key]
+
+    def items(self, name, now=None):
+        """Live (key, value, seconds left) entries of one collection"""
+        now = now or time.time()
+        # list() copies in one step, so a tenant bot can restore while the writer thread applies events
+        return [(key, value, expires_at - now)
+                for key, (expires_at, value) in list(self.collections[name].items()) if expires_at > now]
+
+    def dump(self):
+        self.prune()
+        return self.collections
+
+    def load(self, collections):
+        self.collections = {name: dict(collections.get(name, {})) for name in self.COLLECTIONS}
+
+
+class _Ack(threading.Event):
+    """Set once an appended event's batch is settled; failed when it never reached the disk"""
+    failed = False
+
+
+class EventLog:
+    """Append-only JSON-lines event log with group commit and snapshots.
+
+    append() hands the event to a writer thread, which writes everything that
+    queued up while the previous fsync was running as one batch and fsyncs once
+    for the lot. Events are folded into `projection` once they are on disk (a
+    failed batch is cut off the segment again and its waiters told so); every
+    `snapshot_every` events the projection is written to a snapshot file and
+    older log segments are deleted, so replay() only reads the tail.
+    """
+
+    _STOP = object()
+
+    def __init__(self, directory, projection, snapshot_every=5000, fsync=True, max_batch=1000):
+        self.directory = directory
+        self.projection = projection
+        self.snapshot_every = snapshot_every
+        self.fsync = fsync
+        self.max_batch = max_batch
+        self.seq = 0
+        self.snapshot_seq = 0
+        self.queue = queue.Queue()
+        self.segment = None
+        self.writer = None
+        self.lock = threading.Lock()
+        self.stats = {
+            'appended': 0, 'batches': 0, 'max_batch': 0, 'commit_ms': 0.0,
+            'snapshots': 0, 'replayed': 0, 'replay_ms': 0.0, 'torn_lines': 0
+        }
+
+        os.makedirs(directory, exist_ok=True)
+        # One writer per directory: a second process would interleave sequence numbers
+        self._lock_file = open(os.path.join(directory, 'eventlog.lock'), 'w')
+        if fcntl is not None:
+            try:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                self._lock_file.close()
+                raise RuntimeError(f"Event log {directory} is in use by another process")
+
+    def _path(self, kind, seq):
+        extension = 'json' if kind == 'snapshot' else 'log'
+        return os.path.join(self.directory, f"{kind}-{seq:012d}.{extension}")
+
+    def _files(self, kind):
+        return sorted(glob.glob(os.path.join(self.directory, f"{kind}-*")))
+
+    # Startup
+
+    def replay(self):
+        """Load the newest snapshot, then apply the log tail after it"""
+        started = time.monotonic()
+        for path in reversed(self._files('snapshot')):
+            if path.endswith('.json'):
+                with open(path, encoding='utf-8') as f:
+                    snapshot = json.load(f)
+                self.projection.load(snapshot['collections'])
+                self.seq = self.snapshot_seq = snapshot['seq']
+                break
+
+        replayed = 0
+        apply = self.projection.apply
+        for path in self._files('events'):
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        # Torn write from a crash: nothing after it in this segment was acknowledged
+                        self.stats['torn_lines'] += 1
+                        break
+                    if event['seq'] <= self.seq:
+                        continue
+                    apply(event)
+                    self.seq = event['seq']
+                    replayed += 1
+
+        elapsed_ms = (time.monotonic() - started) * 1000
+        self.stats['replayed'] = replayed
+        self.stats['replay_ms'] = round(elapsed_ms, 1)
+        logger.info(f"📜 Event log replayed: snapshot @{self.snapshot_seq} + {replayed} events in {elapsed_ms:.0f} ms")
+        return replayed
+
+    def start(self):
+        # Appends always go to a fresh segment, never after a possibly torn line
+        self.segment = open(self._path('events', self.seq + 1), 'a', encoding='utf-8')
+        self.writer = threading.Thread(target=self._run, name='eventlog-writer', daemon=True)
+        self.writer.start()
+
+    # Writing
+
+    def append(self, event_type, key, data, wait=True, timeout=5.0):
+        """Log an event; with wait, return once it is on disk (False on timeout or a failed write)"""
+        done = _Ack() if wait else None
+        self.queue.put(({'type': event_type, 'key': key, 'data': data, 'ts': time.time()}, done))
+        return done.wait(timeout) and not done.failed if wait else True
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            # Group commit: take whatever arrived while the last batch was being synced
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = any(item is self._STOP for item in batch)
+            batch = [item for item in batch if item is not self._STOP]
+            if batch:
+                try:
+                    self._commit(batch)
+                except Exception as e:
+                    logger.exception(f"❌ Event log write failed: {e}")
+            if stop:
+                return
+
+    def _commit(self, batch):
+        started = time.monotonic()
+        lines = []
+        for offset, (event, _) in enumerate(batch, 1):
+            event['seq'] = self.seq + offset
+            lines.append(json.dumps(event, ensure_ascii=False, separators=(',', ':')) + '\n')
+        size = os.fstat(self.segment.fileno()).st_size
+        try:
+            self.segment.write(''.join(lines))
+            self.segment.flush()
+            if self.fsync:
+                os.fsync(self.segment.fileno())
+        except Exception:
+            self._discard(size, len(batch))
+            for _, done in batch:
+                if done is not None:
+                    done.failed = True
+                    done.set()
+            raise
+
+        # Only what is on disk reaches the projection (and so the next snapshot)
+        self.seq += len(batch)
+        for event, _ in batch:
+            self.projection.apply(event)
+        for _, done in batch:
+            if done is not None:
+                done.set()
+
+        with self.lock:
+            stats = self.stats
+            stats['appended'] += len(batch)
+            stats['batches'] += 1
+            stats['max_batch'] = max(stats['max_batch'], len(batch))
+            stats['commit_ms'] += (time.monotonic() - started) * 1000
+        if self.seq - self.snapshot_seq >= self.snapshot_every:
+            self._snapshot()
+
+    def _discard(self, size, count):
+        """Cut a failed batch off the segment, so replay never applies it and its seqs can be reused"""
+        path = self.segment.name
+        try:
+            self.segment.close()
+        except Exception:
+            # Closing flushes whatever is still buffered; the truncate below removes it again
+            pass
+        try:
+            os.truncate(path, size)
+        except OSError as e:
+            # Part of the batch may survive on disk: never hand out its sequence numbers again
+            logger.error(f"❌ Could not cut a failed batch off {path}: {e}")
+            self.seq += count
+        self.segment = open(path, 'a', encoding='utf-8')
+
+    def _snapshot(self):
+        """Write the projection at the current seq and drop the log before it"""
+        started = time.monotonic()
+        path = self._path('snapshot', self.seq)
+        tmp = path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'seq': self.seq, 'ts': time.time(), 'collections': self.projection.dump()},
+                      f, ensure_ascii=False, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+        self.segment.close()
+        self.segment = open(self._path('events', self.seq + 1), 'a', encoding='utf-8')
+        current = self.segment.name
+        for old in self._files('events'):
+            if old != current:
+                os.remove(old)
+        for old in self._files('snapshot'):
+            if old != path:
+                os.remove(old)
+        self.snapshot_seq = self.seq
+        with self.lock:
+            self.stats['snapshots'] += 1
+        logger.info(f"📸 Event log snapshot @{self.seq} in {(time.monotonic() - started) * 1000:.0f} ms")
+
+    def snapshot(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats['avg_batch'] = round(stats['appended'] / stats['batches'], 2) if stats['batches'] else 0.0
+        stats['commit_ms'] = round(stats['commit_ms'], 1)
+        stats['seq'] = self.seq
+        stats['snapshot_seq'] = self.snapshot_seq
+        stats['tail'] = self.seq - self.snapshot_seq
+        return stats
+
+    def close(self, timeout=10):
+        """Flush pending events and write a final snapshot so the next start replays nothing"""
+        if self.writer is None:
+            return
+        self.queue.put(self._STOP)
+        self.writer.join(timeout)
+        if self.writer.is_alive():
+            # Still committing: snapshotting here would race it on the segment; replay covers the tail
+            logger.warning(f"⚠️ Event log writer still busy after {timeout}s, no final snapshot")
+            return
+        if self.seq > self.snapshot_seq:
+            self._snapshot()
+        self.segment.close()
+        self.writer = None
+        self._lock_file.close()
+
@@ -0,0 +1,9 @@
+# Gunicorn settings picked up automatically from the working directory
+
+
+def worker_exit(server, worker):
+    """Drain queued WhatsApp sends before the worker goes away"""
+    import sys
+    chatbot = sys.modules.get('Chatbot')
+    if chatbot is not None:
+        chatbot.shutdown_dispatcher()
@@ -0,0 +1,61 @@
+import re
+
+# Intents in priority order: when a message matches several, the first one listed wins
+INTENT_KEYWORDS = {
+    'greeting': ['hi', 'hello', 'hey', 'hy'],
+    'menu': ['menu'],
+    'status': ['status', 'order'],
+    'help': ['help', 'support']
+}
+
+# Extra intents that only apply in a given conversation stage (checked before the global ones)
+STAGE_INTENTS = {
+    'awaiting_confirmation': {
+        'edit': ['edit', '1'],
+        'confirm': ['confirm', '2']
+    }
+}
+
+
+WORD_RE = re.compile(r'\w+')
+
+
+class IntentMatcher:
+    """Whole-word keyword matcher built once from the keyword tables.
+
+    Each stage gets one flat {keyword: (rank, intent)} table, so matching is a
+    single tokenizing pass with a hash lookup per word.
+    """
+
+    def __init__(self, keywords=INTENT_KEYWORDS, stage_intents=STAGE_INTENTS):
+        self.keywords = keywords
+        self.stage_intents = stage_intents
+        self.tables = {None: self._compile(keywords)}
+        for stage, intents in stage_intents.items():
+            self.tables[stage] = self._compile({**intents, **keywords})
+
+    @staticmethod
+    def _compile(table):
+        lookup = {}
+        for rank, (intent, words) in enumerate(table.items()):
+            for word in words:
+                word = word.lower()
+                if not WORD_RE.fullmatch(word):
+                    raise ValueError(f"Intent keyword must be a single word: {word!r}")
+                # An earlier (higher priority) intent keeps a shared keyword
+                lookup.setdefault(word, (rank, intent))
+        return lookup
+
+    def match(self, text, stage=None):
+        """Highest-priority intent found in text, or None"""
+        lookup = self.tables.get(stage) or self.tables[None]
+        best = None
+        best_rank = float('inf')
+        for word in WORD_RE.findall(text.lower()):
+            entry = lookup.get(word)
+            if entry is not None and entry[0] < best_rank:
+                best_rank, best = entry
+                if best_rank == 0:
+                    break
+        return best
+
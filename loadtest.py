@@ -0,0 +1,237 @@
+"""Sync (gunicorn gthread + Flask) vs async (uvicorn + async_app) under load.
+
+    python loadtest.py --conversations 1000 --latency 0.1
+
+Starts a Graph API stub in this process (every send takes --latency seconds),
+then each server in turn with the stub as GRAPH_API_BASE, and runs that many
+conversations at once: sheet order -> confirmation buttons, "Confirm Order"
+click -> payment link, payment callback -> "Payment Received". A step waits
+until the stub has received the message the previous one triggered.
+
+The stub and the client speak bare HTTP/1.1 over asyncio streams so this
+process stays light next to the server under test. Client-side rate limits
+are lifted so the serving model is what is measured; both servers keep their
+defaults otherwise (one process each, memory state).
+"""
+import argparse
+import asyncio
+import collections
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import time
+from urllib.parse import urlencode
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def read_message(reader):
+    """(first line, headers, body) of one HTTP/1.1 message with a Content-Length"""
+    head = await reader.readuntil(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+    headers = {}
+    for line in lines[1:]:
+        if ':' in line:
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get('content-length', 0)))
+    return lines[0], headers, body
+
+
+class GraphStub:
+    """Stand-in for POST /{phone_id}/messages with a fixed latency"""
+
+    RESPONSE = b'{"messages":[{"id":"wamid.stub"}]}'
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.inboxes = collections.defaultdict(asyncio.Queue)
+        self.received = 0
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                _, _, body = await read_message(reader)
+                await asyncio.sleep(self.latency)
+                payload = json.loads(body)
+                self.received += 1
+                self.inboxes[payload['to']].put_nowait(payload)
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n%s'
+                             % (len(self.RESPONSE), self.RESPONSE))
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            # Client went away, or the run is over and the loop is shutting down
+            pass
+        finally:
+            writer.close()
+
+
+class Client:
+    """One keep-alive connection, like a single user agent"""
+
+    def __init__(self, port):
+        self.port = port
+        self.reader = self.writer = None
+
+    async def request(self, method, path, payload=None):
+        body = json.dumps(payload).encode() if payload is not None else b''
+        for attempt in (1, 2):
+            if self.writer is None:
+                self.reader, self.writer = await asyncio.open_connection('127.0.0.1', self.port)
+            self.writer.write(f"{method} {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Type: application/json\r\n"
+                              f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+            try:
+                status_line, headers, _ = await read_message(self.reader)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                # Server closed an idle keep-alive connection: reconnect once
+                self.close()
+                if attempt == 2:
+                    raise
+                continue
+            if headers.get('connection', '').lower() == 'close':
+                self.close()
+            return int(status_line.split()[1])
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+async def conversation(port, stub, i, timeout):
+    phone = f"98{i:08d}"
+    to = f"91{phone}"
+    inbox = stub.inboxes[to]
+    client = Client(port)
+    started = time.monotonic()
+    try:
+        await client.request('POST', '/webhook/google-sheets', {
+            'order': {'name': f'Load {i}', 'phone': phone, 'foodItems': 'Margherita', 'quantity': 1, 'total': 299}})
+        await asyncio.wait_for(inbox.get(), timeout)
+
+        await client.request('POST', '/webhook/whatsapp', {'entry': [{'changes': [{
+            'field': 'messages', 'value': {'messages': [{
+                'id': f'wamid.load{i}', 'from': to, 'type': 'interactive',
+                'interactive': {'button_reply': {'id': 'btn_2', 'title': 'Confirm Order'}}}]}}]}]})
+        link = await asyncio.wait_for(inbox.get(), timeout)
+        session_id = re.search(r'session=(\w+)', link['interactive']['action']['parameters']['url']).group(1)
+
+        await client.request('GET', '/payment/callback?' + urlencode({'session': session_id, 'status': 'success'}))
+        await asyncio.wait_for(inbox.get(), timeout)
+        return time.monotonic() - started
+    finally:
+        client.close()
+
+
+def start_server(mode, port, graph_port, threads):
+    env = dict(
+        os.environ,
+        GRAPH_API_BASE=f'http://127.0.0.1:{graph_port}',
+        WHATSAPP_TOKEN='load-test',
+        WHATSAPP_PHONE_ID='123',
+        LOG_LEVEL='ERROR',
+        STATE_BACKEND='memory',
+        RATE_LIMIT_MPS='100000',
+        RATE_LIMIT_RECIPIENT_PER_MINUTE='100000',
+        EVENT_LOG_DIR='',
+        # The QR image is a 4th send per conversation; the comparison stays on the 3-step flow
+        PAYMENT_QR='0'
+    )
+    if mode == 'sync':
+        command = ['gunicorn', '-k', 'gthread', '-w', '1', '--threads', str(threads), '--backlog', '4096',
+                   '-b', f'127.0.0.1:{port}', '--log-level', 'error', 'Chatbot:app']
+    else:
+        command = [sys.executable, '-m', 'uvicorn', 'async_app:app', '--port', str(port), '--backlog', '4096',
+                   '--log-level', 'error']
+    return subprocess.Popen(command, cwd=HERE, env=env)
+
+
+def process_threads(pid):
+    """Threads of the serving process (gunicorn's worker, not its master)"""
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as children:
+            pids = children.read().split()
+        pid = int(pids[0]) if pids else pid
+        with open(f'/proc/{pid}/status') as status:
+            return int(next(line for line in status if line.startswith('Threads:')).split()[1])
+    except (OSError, StopIteration, ValueError):
+        return None
+
+
+async def run(mode, stub, graph_port, args):
+    port = free_port()
+    server = start_server(mode, port, graph_port, args.threads)
+    try:
+        probe = Client(port)
+        for _ in range(300):
+            try:
+                if await probe.request('GET', '/health') == 200:
+                    break
+            except OSError:
+                pass
+            await asyncio.sleep(0.1)
+        probe.close()
+
+        received = stub.received
+        started = time.monotonic()
+        results = await asyncio.gather(
+            *[conversation(port, stub, i, args.timeout) for i in range(args.conversations)],
+            return_exceptions=True)
+        elapsed = time.monotonic() - started
+        threads = process_threads(server.pid)
+    finally:
+        server.terminate()
+        server.wait(30)
+
+    durations = sorted(result for result in results if not isinstance(result, BaseException))
+
+    def percentile(p):
+        return durations[min(len(durations) - 1, int(p * len(durations)))] if durations else float('nan')
+
+    return {
+        'mode': mode,
+        'seconds': elapsed,
+        'conversations_per_s': len(durations) / elapsed,
+        'messages_per_s': (stub.received - received) / elapsed,
+        'p50': percentile(0.5),
+        'p95': percentile(0.95),
+        'p99': percentile(0.99),
+        'errors': len(results) - len(durations),
+        'threads': threads
+    }
+
+
+async def main(args):
+    stub = GraphStub(args.latency)
+    graph_port = free_port()
+    graph = await asyncio.start_server(stub.handle, '127.0.0.1', graph_port, backlog=4096)
+
+    print(f"📈 {args.conversations} concurrent conversations (3 Graph API sends each), "
+          f"stub latency {args.latency * 1000:.0f} ms, gunicorn threads {args.threads}")
+    print(f"{'mode':6} {'total s':>8} {'conv/s':>8} {'msg/s':>8} {'p50 s':>7} {'p95 s':>7} {'p99 s':>7} "
+          f"{'errors':>6} {'threads':>7}")
+    for mode in args.modes:
+        stub.inboxes.clear()
+        result = await run(mode, stub, graph_port, args)
+        print(f"{result['mode']:6} {result['seconds']:8.2f} {result['conversations_per_s']:8.1f} "
+              f"{result['messages_per_s']:8.1f} {result['p50']:7.2f} {result['p95']:7.2f} {result['p99']:7.2f} "
+              f"{result['errors']:6d} {result['threads'] or '?':>7}")
+    graph.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--conversations', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0.1, help='Graph API stub latency in seconds')
+    parser.add_argument('--threads', type=int, default=8, help='gunicorn gthread threads for the sync server')
+    parser.add_argument('--timeout', type=float, default=300)
+    parser.add_argument('--modes', nargs='+', default=['sync', 'async'], choices=['sync', 'async'])
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,304 @@
+import csv
+import hashlib
+import io
+import json
+import os
+import re
+import threading
+import time
+
+import requests
+
+from bot_logging import get_logger
+from message_templates import PayloadTemplate, list_payload, cta_payload, get_encoder
+from payment_qr import format_amount
+
+logger = get_logger('menu_catalog')
+
+# WhatsApp list message limits
+LIST_ROWS = 10
+ROW_TITLE = 24
+ROW_DESCRIPTION = 72
+SECTION_TITLE = 24
+BUTTON_TEXT = 20
+BODY_TEXT = 4096
+
+# Row id prefixes of list replies
+PAGE_PREFIX = 'menu_page_'
+ITEM_PREFIX = 'menu_item_'
+
+
+def _clip(text, limit):
+    text = str(text).strip()
+    return text if len(text) <= limit else text[:limit - 1] + '…'
+
+
+def _slug(text):
+    return re.sub(r'[^a-z0-9]+', '-', str(text).lower()).strip('-') or 'item'
+
+
+def price_text(value):
+    amount = format_amount(value)
+    return f"₹{amount}" if amount is not None else str(value)
+
+
+def parse_items(records, default_section='Menu'):
+    """[(section title, [item, ...]), ...] from item dicts.
+
+    An item needs a name; price, description, id and section/category are
+    optional, and available=false (or no/0) hides it.
+    """
+    sections = {}
+    for record in records:
+        record = {str(key).strip().lower(): value for key, value in record.items() if key is not None}
+        name = str(record.get('name') or record.get('item') or '').strip()
+        if not name or str(record.get('available', 'true')).strip().lower() in ('false', 'no', '0'):
+            continue
+        section = str(record.get('section') or record.get('category') or default_section).strip()
+        sections.setdefault(section, []).append({
+            'id': str(record.get('id') or '').strip() or _slug(name),
+            'name': name,
+            'price': record.get('price', ''),
+            'description': str(record.get('description') or '').strip()
+        })
+    return list(sections.items())
+
+
+def parse_json(data):
+    """{"sections": [{"title": ..., "items": [...]}]} or a flat list of items with a "section"/"category" field"""
+    if isinstance(data, dict) and 'sections' in data:
+        records = [dict(item, section=section.get('title', 'Menu'))
+                   for section in data['sections'] for item in section.get('items', [])]
+    elif isinstance(data, dict):
+        records = data.get('items', [])
+    else:
+        records = data
+    return parse_items(records)
+
+
+def parse_csv(text):
+    """One item per row, header row with name,price[,description,section|category,id,available]"""
+    return parse_items(csv.DictReader(io.StringIO(text)))
+
+
+class FileSource:
+    """Menu JSON/CSV file, re-read only when its mtime or size changes"""
+
+    def __init__(self, path):
+        self.path = path
+        self.tag = None
+
+    def fetch(self):
+        """Parsed sections, or None when the file is unchanged"""
+        stat = os.stat(self.path)
+        tag = (stat.st_mtime_ns, stat.st_size)
+        if tag == self.tag:
+            return None
+        with open(self.path, encoding='utf-8') as f:
+            text = f.read()
+        sections = parse_csv(text) if self.path.lower().endswith('.csv') else parse_json(json.loads(text))
+        self.tag = tag
+        return sections
+
+
+class URLSource:
+    """Menu JSON or CSV over HTTP (e.g. a Google Sheet published as CSV), conditional GETs via ETag/Last-Modified"""
+
+    def __init__(self, url, timeout=10):
+        self.url = url
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.etag = None
+        self.last_modified = None
+
+    def fetch(self):
+        """Parsed sections, or None on 304 Not Modified"""
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        response = self.session.get(self.url, headers=headers, timeout=self.timeout)
+        if response.status_code == 304:
+            return None
+        response.raise_for_status()
+        content_type = response.headers.get('Content-Type', '')
+        if 'csv' in content_type or 'format=csv' in self.url or self.url.lower().endswith('.csv'):
+            sections = parse_csv(response.content.decode('utf-8-sig'))
+        else:
+            sections = parse_json(response.json())
+        self.etag = response.headers.get('ETag')
+        self.last_modified = response.headers.get('Last-Modified')
+        return sections
+
+
+def create_source(location):
+    """URLSource for http(s) locations, FileSource otherwise"""
+    if location.startswith(('http://', 'https://')):
+        return URLSource(location)
+    return FileSource(location)
+
+
+class MenuVersion:
+    """One loaded menu with every outgoing payload already serialized.
+
+    The list is split into pages of at most 10 rows (a WhatsApp limit); all
+    but the last page end with a "More items" row that opens the next one.
+    Each page and each item's detail message is a template whose only slot
+    is 'to'.
+    """
+
+    def __init__(self, sections, digest, order_url, body, button, encoder):
+        self.sections = sections
+        self.digest = digest
+        self.loaded_at = time.time()
+        self.items = {}
+        entries = []
+        for title, items in sections:
+            for item in items:
+                row_id = ITEM_PREFIX + item['id']
+                suffix = 2
+                while row_id in self.items:
+                    row_id = f"{ITEM_PREFIX}{item['id']}-{suffix}"
+                    suffix += 1
+                self.items[row_id] = self._item_template(row_id, item, order_url, encoder)
+                entries.append((title, row_id, item))
+
+        chunks = []
+        while entries:
+            size = len(entries) if len(entries) <= LIST_ROWS else LIST_ROWS - 1
+            chunks.append(entries[:size])
+            entries = entries[size:]
+
+        self.pages = []
+        for number, chunk in enumerate(chunks, 1):
+            page_sections = []
+            for title, row_id, item in chunk:
+                if not page_sections or page_sections[-1]['title'] != _clip(title, SECTION_TITLE):
+                    page_sections.append({'title': _clip(title, SECTION_TITLE), 'rows': []})
+                description = price_text(item['price']) if item['price'] != '' else ''
+                if item['description']:
+                    description = f"{description} · {item['description']}" if description else item['description']
+                row = {'id': row_id, 'title': _clip(item['name'], ROW_TITLE)}
+                if description:
+                    row['description'] = _clip(description, ROW_DESCRIPTION)
+                page_sections[-1]['rows'].append(row)
+            if number < len(chunks):
+                page_sections.append({'title': 'More', 'rows': [
+                    {'id': f"{PAGE_PREFIX}{number + 1}", 'title': 'More items ➡️',
+                     'description': f"Page {number + 1} of {len(chunks)}"}
+                ]})
+            footer = f"Page {number} of {len(chunks)}" if len(chunks) > 1 else None
+            self.pages.append(PayloadTemplate(
+                f"menu[{digest}] page {number}",
+                list_payload(_clip(body, BODY_TEXT), _clip(button, BUTTON_TEXT), page_sections, footer),
+                encoder
+            ))
+        self.fallback = self._fallback_text(body, order_url)
+
+    @staticmethod
+    def _item_template(row_id, item, order_url, encoder):
+        text = f"🍽 {item['name']}"
+        if item['price'] != '':
+            text += f"\n💰 {price_text(item['price'])}"
+        if item['description']:
+            text += f"\n\n{item['description']}"
+        return PayloadTemplate(row_id, cta_payload(text, "Order Now", order_url), encoder,
+                               fallback=f"{text}\n\n🌐 Order Now: {order_url}")
+
+    def _fallback_text(self, body, order_url):
+        # Used when list messages are rejected: the whole menu as plain text
+        lines = [body.split('\n')[0]]
+        for title, items in self.sections:
+            lines.append(f"\n*{title}*")
+            for item in items:
+                price = f" – {price_text(item['price'])}" if item['price'] != '' else ''
+                lines.append(f"• {item['name']}{price}")
+        tail = f"\n\n🌐 Order: {order_url}"
+        return _clip('\n'.join(lines), BODY_TEXT - len(tail)) + tail
+
+    def page(self, number=1):
+        if 1 <= number <= len(self.pages):
+            return self.pages[number - 1]
+        return None
+
+    def item(self, row_id):
+        return self.items.get(row_id)
+
+    def __len__(self):
+        return len(self.items)
+
+
+class MenuCatalog:
+    """The current menu, reloaded from its source in the background.
+
+    A refresh asks the source whether anything changed (mtime for files,
+    ETag/Last-Modified for URLs) and only rebuilds the pre-serialized
+    payloads when the parsed menu actually differs; readers just take the
+    current MenuVersion, which is swapped in whole.
+    """
+
+    def __init__(self, source, order_url, refresh_interval=60, encoder='auto',
+                 body="📋 Our Menu\n\nTap the button below to browse dishes and prices.", button='View Menu'):
+        self.source = source
+        self.order_url = order_url
+        self.refresh_interval = refresh_interval
+        self.encoder = get_encoder(encoder) if isinstance(encoder, str) else encoder
+        self.body = body
+        self.button = button
+        self.version = None
+        self.stop = threading.Event()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.stats = {'checks': 0, 'unchanged': 0, 'loaded': 0, 'errors': 0, 'last_error': None}
+
+    def current(self):
+        return self.version
+
+    def refresh(self):
+        """Reload the menu if its source changed, returns True when a new version was installed"""
+        with self.lock:
+            self.stats['checks'] += 1
+            try:
+                sections = self.source.fetch()
+            except Exception as e:
+                self.stats['errors'] += 1
+                self.stats['last_error'] = str(e)
+                logger.error(f"❌ Menu refresh failed, keeping the current menu: {e}")
+                return False
+            digest = None
+            if sections is not None:
+                digest = hashlib.sha1(json.dumps(sections, sort_keys=True, default=str).encode()).hexdigest()[:12]
+            if sections is None or (self.version is not None and digest == self.version.digest):
+                self.stats['unchanged'] += 1
+                return False
+            version = MenuVersion(sections, digest, self.order_url, self.body, self.button, self.encoder)
+            self.version = version
+            self.stats['loaded'] += 1
+        logger.info(f"📋 Menu {digest} loaded: {len(version)} items on {len(version.pages)} pages")
+        return True
+
+    def start(self):
+        """Initial load, then a background refresh every refresh_interval seconds"""
+        self.refresh()
+        if self.refresh_interval > 0:
+            self.thread = threading.Thread(target=self._run, name='menu-refresh', daemon=True)
+            self.thread.start()
+        return self
+
+    def _run(self):
+        while not self.stop.wait(self.refresh_interval):
+            self.refresh()
+
+    def shutdown(self):
+        self.stop.set()
+
+    def snapshot(self):
+        version = self.version
+        with self.lock:
+            stats = dict(self.stats)
+        stats['version'] = version.digest if version is not None else None
+        stats['items'] = len(version) if version is not None else 0
+        stats['pages'] = len(version.pages) if version is not None else 0
+        return stats
+
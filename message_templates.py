@@ -0,0 +1,215 @@
+import json
+import re
+from json.encoder import encode_basestring
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Placeholder strings that mark dynamic fields while a skeleton is serialized
+_SLOT_MARK = '@@slot:{}@@'
+_SLOT_RE = re.compile(r'"@@slot:(\w+)@@"')
+
+
+def _json_dumps(value):
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def _json_string(value):
+    return encode_basestring(value).encode('utf-8')
+
+
+def get_encoder(name='auto'):
+    """JSON encoder for slot values: 'json', 'orjson', or 'auto' (orjson when installed)"""
+    if name == 'orjson' or (name == 'auto' and orjson is not None):
+        if orjson is None:
+            raise RuntimeError("JSON_ENCODER=orjson but orjson is not installed")
+        return orjson.dumps
+    return _json_dumps
+
+
+class Slot:
+    """Marks a dynamic field in a payload skeleton"""
+
+    def __init__(self, name):
+        self.name = name
+
+
+class PayloadTemplate:
+    """A message payload serialized once, with dynamic fields spliced in per send.
+
+    The skeleton is split into static byte chunks around its slots, so a send
+    only encodes the slot values and joins the pieces.
+    """
+
+    def __init__(self, name, skeleton, encoder=_json_dumps, fallback=None):
+        self.name = name
+        self.fallback = fallback
+        self.encoder = encoder
+        text = json.dumps(self._mark(skeleton), ensure_ascii=False, separators=(',', ':'))
+        pieces = _SLOT_RE.split(text)
+        self.chunks = [piece.encode('utf-8') for piece in pieces[0::2]]
+        self.slots = pieces[1::2]
+        if len(set(self.slots)) != len(self.slots):
+            raise ValueError(f"Template {name!r} uses a slot more than once")
+
+    @classmethod
+    def _mark(cls, value):
+        if isinstance(value, Slot):
+            return _SLOT_MARK.format(value.name)
+        if isinstance(value, dict):
+            return {key: cls._mark(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [cls._mark(item) for item in value]
+        return value
+
+    def render(self, **values):
+        """Request body bytes with every slot filled in"""
+        chunks = self.chunks
+        encode = self.encoder
+        parts = [chunks[0]]
+        for i, slot in enumerate(self.slots, 1):
+            value = values[slot]
+            # Plain strings (the common case) skip the general encoder
+            parts.append(_json_string(value) if type(value) is str else encode(value))
+            parts.append(chunks[i])
+        return b''.join(parts)
+
+
+def text_payload(body):
+    return {
+        "messaging_product": "whatsapp",
+        "to": Slot('to'),
+        "type": "text",
+        "text": {"body": body}
+    }
+
+
+def cta_payload(body, display_text, url):
+    return {
+        "messaging_product": "whatsapp",
+        "to": Slot('to'),
+        "type": "interactive",
+        "interactive": {
+            "type": "cta_url",
+            "body": {"text": body},
+            "action": {
+                "name": "cta_url",
+                "parameters": {
+                    "display_text": display_text,
+                    "url": url
+                }
+            }
+        }
+    }
+
+
+def buttons_payload(body, titles):
+    return {
+        "messaging_product": "whatsapp",
+        "to": Slot('to'),
+        "type": "interactive",
+        "interactive": {
+            "type": "button",
+            "body": {"text": body},
+            "action": {"buttons": [
+                {"type": "reply", "reply": {"id": f"btn_{i}", "title": title[:20]}}
+                for i, title in enumerate(titles, 1)
+            ]}
+        }
+    }
+
+
+def list_payload(body, button, sections, footer=None):
+    """Interactive list: sections of {'title', 'rows': [{'id', 'title', 'description'}]}"""
+    interactive = {
+        "type": "list",
+        "body": {"text": body},
+        "action": {"button": button, "sections": sections}
+    }
+    if footer:
+        interactive["footer"] = {"text": footer}
+    return {
+        "messaging_product": "whatsapp",
+        "to": Slot('to'),
+        "type": "interactive",
+        "interactive": interactive
+    }
+
+
+def image_payload(link, caption):
+    """Image fetched by WhatsApp from a public URL"""
+    return {
+        "messaging_product": "whatsapp",
+        "to": Slot('to'),
+        "type": "image",
+        "image": {"link": link, "caption": caption}
+    }
+
+
+def template_payload():
+    """Pre-approved WhatsApp template message (name and language filled in per send)"""
+    return {
+        "messaging_product": "whatsapp",
+        "to": Slot('to'),
+        "type": "template",
+        "template": {"name": Slot('name'), "language": {"code": Slot('language')}}
+    }
+
+
+class TemplateRegistry:
+    """Named payload templates, built at startup.
+
+    Arguments left as None become slots, so text('text') is the generic text
+    message and text('help', HELP_MESSAGE) is fully static except for 'to'.
+    """
+
+    def __init__(self, encoder='auto'):
+        self.encoder = get_encoder(encoder) if isinstance(encoder, str) else encoder
+        self.templates = {}
+        self.button_sets = {}
+
+    def register(self, name, skeleton, fallback=None):
+        template = PayloadTemplate(name, skeleton, self.encoder, fallback)
+        self.templates[name] = template
+        return template
+
+    def text(self, name, body=None):
+        return self.register(name, text_payload(body if body is not None else Slot('body')))
+
+    def cta(self, name, body=None, display_text=None, url=None):
+        # Static CTAs carry their plain-text fallback ready-made
+        fallback = None
+        if None not in (body, display_text, url):
+            fallback = f"{body}\n\n🌐 {display_text}: {url}"
+        return self.register(name, cta_payload(
+            body if body is not None else Slot('body'),
+            display_text if display_text is not None else Slot('display_text'),
+            url if url is not None else Slot('url')
+        ), fallback)
+
+    def image(self, name, link=None, caption=None):
+        return self.register(name, image_payload(
+            link if link is not None else Slot('link'),
+            caption if caption is not None else Slot('caption')
+        ))
+
+    def buttons(self, titles):
+        """Template for a reply-button set, built on first use and then reused"""
+        titles = tuple(titles)
+        template = self.button_sets.get(titles)
+        if template is None:
+            template = PayloadTemplate(f"buttons{list(titles)}", buttons_payload(Slot('body'), titles), self.encoder)
+            self.button_sets[titles] = template
+        return template
+
+    def render(self, name, **values):
+        return self.templates[name].render(**values)
+
+    def __getitem__(self, name):
+        return self.templates[name]
+
+    def __contains__(self, name):
+        return name in self.templates
+
@@ -0,0 +1,244 @@
+import threading
+import weakref
+from bisect import bisect_left
+
+# Latency buckets in seconds (Graph API calls, webhook handling, queue waits)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class _ShardHolder:
+    __slots__ = ('shard', '__weakref__')
+
+    def __init__(self, shard):
+        self.shard = shard
+
+
+class _PerThread:
+    """Per-thread slots of numbers, summed at scrape time.
+
+    Each thread writes only to its own list, so recording takes no lock and
+    allocates nothing once the thread has its shard. When a thread exits its
+    counts are folded into `retired`, so short-lived request threads don't pile
+    up shards.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.shards = {}
+        self.retired = [0] * size
+
+    def _shard(self):
+        try:
+            return self.local.holder.shard
+        except AttributeError:
+            shard = [0] * self.size
+            holder = self.local.holder = _ShardHolder(shard)
+            with self.lock:
+                self.shards[id(shard)] = shard
+            weakref.finalize(holder, self._retire, shard)
+            return shard
+
+    def _retire(self, shard):
+        with self.lock:
+            self.shards.pop(id(shard), None)
+            for i, value in enumerate(shard):
+                self.retired[i] += value
+
+    def totals(self):
+        with self.lock:
+            totals = list(self.retired)
+            shards = list(self.shards.values())
+        for shard in shards:
+            for i, value in enumerate(shard):
+                totals[i] += value
+        return totals
+
+
+class _HistogramChild(_PerThread):
+    def __init__(self, buckets):
+        # Layout: one count per bucket, one for +Inf, then the running sum
+        super().__init__(len(buckets) + 2)
+        self.buckets = buckets
+
+    def observe(self, value):
+        try:
+            shard = self.local.holder.shard
+        except AttributeError:
+            shard = self._shard()
+        shard[bisect_left(self.buckets, value)] += 1
+        shard[-1] += value
+
+
+class _CounterChild(_PerThread):
+    def __init__(self):
+        super().__init__(1)
+
+    def inc(self, amount=1):
+        try:
+            shard = self.local.holder.shard
+        except AttributeError:
+            shard = self._shard()
+        shard[0] += amount
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        self.lock = threading.Lock()
+        (registry if registry is not None else REGISTRY).register(self)
+        if not self.labelnames and hasattr(self, '_child'):
+            # Unlabelled metrics export zeros from the start
+            self.labels()
+
+    def labels(self, *values):
+        """Child for one label combination (look it up once and keep it on hot paths)"""
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.get(values)
+                if child is None:
+                    child = self.children[values] = self._child()
+        return child
+
+    def _header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS, registry=None):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def render(self):
+        lines = self._header()
+        for values, child in sorted(self.children.items()):
+            totals = child.totals()
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), totals):
+                cumulative += count
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, values, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, values)} {totals[-1]}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, values)} {cumulative}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def render(self):
+        lines = self._header()
+        for values, child in sorted(self.children.items()):
+            lines.append(f"{self.name}{_labels(self.labelnames, values)} {child.totals()[0]}")
+        return lines
+
+
+class Gauge(_Metric):
+    """Value read from a callback at scrape time"""
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self.functions = {}
+
+    def set_function(self, fn, *values):
+        self.functions[values] = fn
+
+    def render(self):
+        lines = self._header()
+        for values, fn in sorted(self.functions.items()):
+            try:
+                value = fn()
+            except Exception:
+                continue
+            lines.append(f"{self.name}{_labels(self.labelnames, values)} {value}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def render(self):
+        """Prometheus text exposition format"""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+# Hot-path metrics shared across modules
+GRAPH_API_LATENCY = Histogram('whatsapp_graph_api_request_seconds', 'Graph API call latency',
+                              ['type', 'status'])
+WEBHOOK_LATENCY = Histogram('whatsapp_bot_request_seconds', 'HTTP request handling time', ['route'])
+QUEUE_WAIT = Histogram('whatsapp_bot_queue_wait_seconds', 'Time jobs spend queued before a worker runs them',
+                       ['queue'])
+PAYMENT_TO_SEND = Histogram('whatsapp_bot_payment_to_send_seconds',
+                            'Payment callback received to "Payment Received" message sent')
+FALLBACKS = Counter('whatsapp_bot_fallbacks_total', 'Interactive messages sent as plain-text fallbacks', ['type'])
+RETRIES = Counter('whatsapp_graph_api_retries_total', 'Graph API calls retried after a transient failure')
+DUPLICATES = Counter('whatsapp_bot_duplicate_messages_total', 'Redelivered webhook messages skipped')
+STORE_SIZE = Gauge('whatsapp_bot_store_entries', 'Records held in a state store', ['store'])
+
+
+if __name__ == '__main__':
+    import timeit
+
+    child = GRAPH_API_LATENCY.labels('text', '200')
+    runs = 1000000
+    per_call = timeit.timeit(lambda: child.observe(0.042), number=runs) / runs * 1e9
+    print(f"⏱ histogram observe: {per_call:.0f} ns")
+    counter = FALLBACKS.labels('cta_url')
+    per_call = timeit.timeit(lambda: counter.inc(), number=runs) / runs * 1e9
+    print(f"⏱ counter inc:       {per_call:.0f} ns")
+
+    def work():
+        for _ in range(10000):
+            child.observe(0.003)
+    before = sum(child.totals()[:-1])
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    del threads
+    counted = sum(child.totals()[:-1]) - before
+    print(f"{'✅' if counted == 80000 else '❌'} 8 threads x 10000 observations, {counted} counted after "
+          f"they exited ({len(child.shards)} live shards)")
+    print('\n'.join(REGISTRY.render().splitlines()[:6]))
@@ -0,0 +1,289 @@
+import os
+import socket
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+
+try:
+    import gspread
+except ImportError:
+    gspread = None
+
+try:
+    from pyairtable import Api as AirtableApi
+except ImportError:
+    AirtableApi = None
+
+from bot_logging import get_logger
+from resilience import RetryPolicy
+
+logger = get_logger('order_sink')
+
+# Column order of the exported sheet/table
+COLUMNS = ('order_id', 'session_id', 'paid_at', 'name', 'phone', 'items', 'quantity', 'total', 'tenant')
+
+# Store keys of the per-process leases (the rest of the namespace is queued orders)
+LEASE_PREFIX = 'lease:'
+
+# Bookkeeping fields of a stored row, never exported
+_INTERNAL = ('queued_at', 'owner')
+
+
+def order_row(session_id, session, tenant='default'):
+    """Flat record of a completed payment session"""
+    order_data = session.get('order_data') or {}
+    return {
+        'order_id': session.get('order_id') or f"ORD{session_id}",
+        'session_id': session_id,
+        'paid_at': datetime.now().isoformat(timespec='seconds'),
+        'name': order_data.get('name', ''),
+        'phone': session.get('phone', ''),
+        'items': order_data.get('foodItems', ''),
+        'quantity': order_data.get('quantity', ''),
+        'total': order_data.get('total', 0),
+        'tenant': tenant
+    }
+
+
+class MemoryBackend:
+    """In-process stand-in for a spreadsheet (tests, local runs)"""
+
+    def __init__(self):
+        self.rows = []
+        self.batches = 0
+        self.fail_next = 0
+        self.lock = threading.Lock()
+
+    def append(self, records):
+        with self.lock:
+            if self.fail_next:
+                self.fail_next -= 1
+                raise ConnectionError("Simulated backend failure")
+            self.rows.extend(records)
+            self.batches += 1
+
+
+class SheetsBackend:
+    """Appends rows to a Google Sheets worksheet (one API call per batch)"""
+
+    def __init__(self, spreadsheet_key, worksheet='Orders', credentials_file=None):
+        if gspread is None:
+            raise RuntimeError("The Google Sheets order sink needs gspread (pip install gspread)")
+        self.spreadsheet_key = spreadsheet_key
+        self.worksheet_name = worksheet
+        self.credentials_file = credentials_file
+        self.worksheet = None
+
+    def _open(self):
+        # On first flush, so startup never waits on Google and a failed login is retried like a failed append
+        if self.worksheet is None:
+            client = gspread.service_account(filename=self.credentials_file) if self.credentials_file \
+                else gspread.service_account()
+            self.worksheet = client.open_by_key(self.spreadsheet_key).worksheet(self.worksheet_name)
+        return self.worksheet
+
+    def append(self, records):
+        rows = [[record.get(column, '') for column in COLUMNS] for record in records]
+        self._open().append_rows(rows, value_input_option='USER_ENTERED')
+
+
+class AirtableBackend:
+    """Creates Airtable records (pyairtable sends them 10 per request)"""
+
+    def __init__(self, api_key, base_id, table='Orders'):
+        if AirtableApi is None:
+            raise RuntimeError("The Airtable order sink needs pyairtable (pip install pyairtable)")
+        self.table = AirtableApi(api_key).table(base_id, table)
+
+    def append(self, records):
+        self.table.batch_create([{column: record.get(column, '') for column in COLUMNS} for record in records],
+                                typecast=True)
+
+
+def create_backend(kind, **options):
+    """Backend by name: 'sheets', 'airtable' or 'memory'"""
+    if kind == 'sheets':
+        if not options.get('spreadsheet_key'):
+            raise ValueError("The Google Sheets order sink needs a spreadsheet key")
+        return SheetsBackend(options['spreadsheet_key'], options.get('worksheet') or 'Orders',
+                             options.get('credentials_file'))
+    if kind == 'airtable':
+        if not (options.get('api_key') and options.get('base_id')):
+            raise ValueError("The Airtable order sink needs an API key and a base id")
+        return AirtableBackend(options['api_key'], options['base_id'], options.get('table') or 'Orders')
+    if kind == 'memory':
+        return MemoryBackend()
+    raise ValueError(f"Unknown order sink backend: {kind}")
+
+
+class OrderSink:
+    """Write-behind export of completed orders, appended in batches.
+
+    add() only records the row in a durable StateStore, keyed by session id
+    (the bot adds an order once, on its pending -> completed swap), and wakes
+    the flusher thread; the backend is never called on the caller's thread. The flusher
+    appends up to batch_size rows once that many are waiting or
+    flush_interval seconds after the oldest arrived, and deletes them from
+    the store only after the backend accepted them. Failed batches are
+    retried with backoff.
+
+    Several workers can share the store: each row names the process that
+    queued it, and each process keeps a lease key alive in the store. Only
+    rows whose owner's lease has run out (a crashed or restarted worker) are
+    taken over, claimed with compare_and_set so exactly one process does it.
+    Delivery is at-least-once: a crash between the append and the delete can
+    repeat a batch (rows carry the session id).
+    """
+
+    def __init__(self, backend, store, batch_size=50, flush_interval=5.0, retry=None, lease_ttl=60.0):
+        self.backend = backend
+        self.store = store
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retry = retry or RetryPolicy(attempts=8, base_delay=1.0, max_delay=60.0)
+        self.lease_ttl = lease_ttl
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.pending = OrderedDict()
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stop = threading.Event()
+        self.stopping = False
+        self.stats = {'queued': 0, 'flushed': 0, 'batches': 0, 'failures': 0, 'adopted': 0, 'last_error': None}
+        self._renew()
+        # Orders a dead process buffered but never flushed
+        adopted = self._adopt()
+        if adopted:
+            logger.info(f"📦 Order sink resumed with {adopted} unflushed orders")
+        self.thread = threading.Thread(target=self._run, name='order-sink', daemon=True)
+        self.thread.start()
+        # Separate from the flusher, so a slow append never lets the lease lapse
+        self.lease_thread = threading.Thread(target=self._keep_lease, name='order-sink-lease', daemon=True)
+        self.lease_thread.start()
+
+    def _renew(self):
+        self.store.set(LEASE_PREFIX + self.owner, {'renewed_at': time.time()}, ttl=self.lease_ttl)
+
+    def _adopt(self):
+        """Claim rows whose owner holds no lease any more, returns how many were taken over"""
+        items = self.store.items()
+        live = {key[len(LEASE_PREFIX):] for key, _ in items if key.startswith(LEASE_PREFIX)}
+        orphans = [(key, record) for key, record in items
+                   if not key.startswith(LEASE_PREFIX) and record.get('owner') not in live and key not in self.pending]
+        adopted = 0
+        for key, record in sorted(orphans, key=lambda item: item[1].get('queued_at', 0)):
+            claimed = dict(record, owner=self.owner)
+            # (Rows from before owners existed have owner None, which CAS also matches on a row just
+            # deleted; that needs another worker to claim, append and delete it inside this loop)
+            if not self.store.compare_and_set(key, 'owner', record.get('owner'), claimed):
+                continue
+            with self.lock:
+                self.pending[key] = claimed
+                self.stats['adopted'] += 1
+            adopted += 1
+        if adopted:
+            self.wake.set()
+        return adopted
+
+    def _keep_lease(self):
+        while not self.stop.wait(self.lease_ttl / 3):
+            try:
+                self._renew()
+                adopted = self._adopt()
+                if adopted:
+                    logger.info(f"📦 Order sink took over {adopted} orders from a stopped worker")
+            except Exception as e:
+                logger.warning(f"⚠️ Order sink lease renewal failed: {e}")
+
+    def add(self, session_id, record):
+        """Queue an order for export (a local store write, never a backend call)"""
+        record = dict(record, queued_at=time.time(), owner=self.owner)
+        with self.lock:
+            if session_id in self.pending:
+                return
+            # Under the lock, so a flush cannot delete the key before it is written
+            self.store.set(session_id, record)
+            self.pending[session_id] = record
+            self.stats['queued'] += 1
+            # The first order starts the flush_interval clock, a full batch goes right away
+            wake = len(self.pending) == 1 or len(self.pending) >= self.batch_size
+        if wake:
+            self.wake.set()
+
+    def _next_batch(self):
+        with self.lock:
+            return list(self.pending.items())[:self.batch_size]
+
+    def _due(self):
+        """Seconds until the oldest pending order must be flushed (0 = now, None = nothing pending)"""
+        with self.lock:
+            if not self.pending:
+                return None
+            if len(self.pending) >= self.batch_size or self.stopping:
+                return 0
+            oldest = next(iter(self.pending.values()))
+        return max(0.0, oldest['queued_at'] + self.flush_interval - time.time())
+
+    def _run(self):
+        failures = 0
+        while True:
+            due = self._due()
+            if due is None and self.stopping:
+                return
+            if due != 0:
+                self.wake.wait(due)
+                self.wake.clear()
+                continue
+            batch = self._next_batch()
+            if self.flush(batch):
+                failures = 0
+                continue
+            failures += 1
+            if self.stopping:
+                return
+            # Keep the orders and try again later (attempts only caps the backoff growth)
+            self.wake.wait(self.retry.delay(min(failures, self.retry.attempts)))
+            self.wake.clear()
+
+    def flush(self, batch):
+        """Append one batch to the backend, returns True when it was accepted"""
+        records = [{key: value for key, value in record.items() if key not in _INTERNAL} for _, record in batch]
+        try:
+            self.backend.append(records)
+        except Exception as e:
+            with self.lock:
+                self.stats['failures'] += 1
+                self.stats['last_error'] = str(e)
+            logger.warning(f"⚠️ Order sink flush of {len(batch)} orders failed, will retry: {e}")
+            return False
+
+        for key, _ in batch:
+            self.store.delete(key)
+        with self.lock:
+            for key, _ in batch:
+                self.pending.pop(key, None)
+            self.stats['flushed'] += len(batch)
+            self.stats['batches'] += 1
+        logger.info(f"📤 Order sink appended {len(batch)} orders")
+        return True
+
+    def shutdown(self, timeout=10):
+        """Flush what is pending; anything left stays in the store for the next start"""
+        logger.info(f"🛑 Flushing order sink ({len(self.pending)} pending)...")
+        self.stopping = True
+        self.stop.set()
+        self.wake.set()
+        self.thread.join(timeout)
+        if self.pending:
+            logger.warning(f"⚠️ {len(self.pending)} orders left unflushed in the order sink store")
+        else:
+            logger.info("✅ Order sink flushed")
+        # Without a lease, whatever is left goes to the next worker that checks
+        self.store.delete(LEASE_PREFIX + self.owner)
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats, pending=len(self.pending), batch_size=self.batch_size,
+                        flush_interval=self.flush_interval, owner=self.owner)
+
@@ -0,0 +1,104 @@
+import io
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from decimal import Decimal, InvalidOperation
+
+try:
+    import qrcode
+    from qrcode.constants import ERROR_CORRECT_M
+except ImportError:
+    qrcode = None
+
+from bot_logging import get_logger
+
+logger = get_logger('payment_qr')
+
+
+def format_amount(value, max_amount=None):
+    """Canonical amount string ('299', '249.5') or None if it is not a positive amount"""
+    try:
+        amount = Decimal(str(value).strip()).quantize(Decimal('0.01'))
+    except (InvalidOperation, ValueError):
+        return None
+    if not amount.is_finite() or amount <= 0 or (max_amount is not None and amount > max_amount):
+        return None
+    # 299.00 and 299 are the same QR code
+    text = format(amount, 'f')
+    return text.rstrip('0').rstrip('.') if '.' in text else text
+
+
+def render_png(data, box_size=8, border=2):
+    """PNG bytes of a QR code for data"""
+    code = qrcode.QRCode(error_correction=ERROR_CORRECT_M, box_size=box_size, border=border)
+    code.add_data(data)
+    code.make(fit=True)
+    buffer = io.BytesIO()
+    code.make_image().save(buffer)
+    return buffer.getvalue()
+
+
+class PaymentQRCache:
+    """Rendered payment QR codes, LRU-cached by the link they encode.
+
+    Each payment session has its own link (it carries the session's callback),
+    so a QR code is rendered once per session: the bot starts the render when
+    it sends the payment link, and WhatsApp's fetch of the image usually finds
+    it done. Rendering (QR layout + PNG encoding, a few ms of CPU) runs on a
+    small thread pool: callers get a Future, concurrent requests for the same
+    link share one render, and request threads only ever wait.
+    """
+
+    def __init__(self, max_entries=256, workers=2, box_size=8):
+        if qrcode is None:
+            raise RuntimeError("Payment QR codes need qrcode and Pillow (pip install qrcode Pillow)")
+        self.max_entries = max_entries
+        self.box_size = box_size
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='qr-render')
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'rendered': 0, 'failed': 0, 'render_seconds': 0.0}
+
+    def get(self, key):
+        """Future of the PNG bytes of a QR code for the link key"""
+        with self.lock:
+            future = self.cache.get(key)
+            if future is not None:
+                self.cache.move_to_end(key)
+                self.stats['hits'] += 1
+                return future
+            self.stats['misses'] += 1
+            future = Future()
+            self.cache[key] = future
+            while len(self.cache) > self.max_entries:
+                self.cache.popitem(last=False)
+        self.pool.submit(self._render, key, future)
+        return future
+
+    def _render(self, key, future):
+        started = time.perf_counter()
+        try:
+            png = render_png(key, self.box_size)
+        except Exception as e:
+            logger.error(f"❌ QR render failed for {key}: {e}")
+            with self.lock:
+                self.stats['failed'] += 1
+                # Let the next request try again
+                if self.cache.get(key) is future:
+                    del self.cache[key]
+            future.set_exception(e)
+            return
+        with self.lock:
+            self.stats['rendered'] += 1
+            self.stats['render_seconds'] += time.perf_counter() - started
+        future.set_result(png)
+
+    def snapshot(self):
+        with self.lock:
+            stats = dict(self.stats, cached=len(self.cache), max_entries=self.max_entries)
+        stats['render_seconds'] = round(stats['render_seconds'], 3)
+        return stats
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
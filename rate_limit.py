@@ -0,0 +1,206 @@
+import threading
+import time
+from collections import OrderedDict
+
+from bot_logging import get_logger
+
+logger = get_logger('rate_limit')
+
+# Graph API error codes that mean "slow down"
+THROUGHPUT_LIMIT = 130429   # business phone number messages/second
+PAIR_RATE_LIMIT = 131056    # too many messages to one recipient
+
+# Pause applied when the response carries no Retry-After
+DEFAULT_RETRY_AFTER = {THROUGHPUT_LIMIT: 1.0, PAIR_RATE_LIMIT: 6.0}
+
+
+class RateLimitExceeded(Exception):
+    """Raised when a send would have to wait longer than the limiter's max_wait"""
+
+
+def rate_limit_code(response):
+    """Graph API throttling error code of a response, or None"""
+    if response is None or response.status_code == 200:
+        return None
+    cached = getattr(response, '_rate_limit_code', False)
+    if cached is not False:
+        return cached
+    code = None
+    try:
+        code = response.json().get('error', {}).get('code')
+    except (ValueError, AttributeError):
+        pass
+    if code not in DEFAULT_RETRY_AFTER:
+        code = THROUGHPUT_LIMIT if response.status_code == 429 else None
+    response._rate_limit_code = code
+    return code
+
+
+def retry_after(response, default):
+    try:
+        return max(0.0, float(response.headers.get('Retry-After')))
+    except (TypeError, ValueError):
+        return default
+
+
+class TokenBucket:
+    """Token bucket that hands out reservations, so waiters are served in order.
+
+    reserve() takes a token even when the bucket is empty and returns how long
+    the caller has to sleep before its reserved slot comes up. The refill rate
+    backs off multiplicatively on throttle() and creeps back up on recover().
+    """
+
+    def __init__(self, rate, burst, min_rate=None):
+        self.target_rate = rate
+        self.rate = rate
+        self.min_rate = min_rate or rate / 16
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, max_wait=None):
+        """Take a token, returns seconds to wait (None if that exceeds max_wait)"""
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            wait = max(0.0, self.blocked_until - now) + max(0.0, 1 - self.tokens) / self.rate
+            if max_wait is not None and wait > max_wait:
+                return None
+            self.tokens -= 1
+            return wait
+
+    def throttle(self, pause):
+        """The API pushed back: halve the rate and stop handing out slots for pause seconds"""
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+            self.blocked_until = max(self.blocked_until, now + pause)
+
+    def recover(self):
+        if self.rate < self.target_rate:
+            with self.lock:
+                self.rate = min(self.target_rate, self.rate + self.target_rate / 50)
+
+    def refund(self):
+        with self.lock:
+            self.tokens += 1
+
+
+class GraphRateLimiter:
+    """Client-side rate limits for one WhatsApp business phone number.
+
+    Every send takes a token from the phone number's bucket and from the
+    recipient's pair-rate bucket, sleeping until both allow it. Throttling
+    errors from the Graph API (and their Retry-After) slow the matching bucket.
+    """
+
+    def __init__(self, messages_per_second=80, burst=None, recipient_per_minute=10,
+                 recipient_burst=10, max_wait=30.0, max_recipients=10000):
+        self.phone = TokenBucket(messages_per_second, burst or messages_per_second)
+        self.recipient_rate = recipient_per_minute / 60.0
+        self.recipient_burst = recipient_burst
+        self.max_wait = max_wait
+        self.max_recipients = max_recipients
+        self.recipients = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {
+            'sends': 0, 'delayed': 0, 'rejected': 0, 'waiting': 0,
+            'wait_seconds': 0.0, 'max_wait_ms': 0.0,
+            'throttled': {str(THROUGHPUT_LIMIT): 0, str(PAIR_RATE_LIMIT): 0}
+        }
+
+    def _recipient(self, to):
+        with self.lock:
+            bucket = self.recipients.get(to)
+            if bucket is None:
+                bucket = TokenBucket(self.recipient_rate, self.recipient_burst)
+                self.recipients[to] = bucket
+                while len(self.recipients) > self.max_recipients:
+                    self.recipients.popitem(last=False)
+            else:
+                self.recipients.move_to_end(to)
+            return bucket
+
+    def acquire(self, to=None):
+        """Block until a message to `to` may be sent, returns the seconds waited"""
+        wait = self.reserve(to)
+        if wait > 0:
+            try:
+                time.sleep(wait)
+            finally:
+                self.end_wait()
+        return wait
+
+    def reserve(self, to=None):
+        """Claim a send slot without sleeping, returns the seconds until it comes up.
+
+        A positive wait counts as 'waiting' until end_wait() is called (the
+        async client sleeps on the event loop instead of in acquire()).
+        """
+        buckets = [self.phone] if to is None else [self._recipient(to), self.phone]
+        wait = 0.0
+        for i, bucket in enumerate(buckets):
+            reserved = bucket.reserve(self.max_wait)
+            if reserved is None:
+                for taken in buckets[:i]:
+                    taken.refund()
+                with self.lock:
+                    self.stats['rejected'] += 1
+                raise RateLimitExceeded(f"Send to {to} would wait more than {self.max_wait}s")
+            wait = max(wait, reserved)
+
+        with self.lock:
+            stats = self.stats
+            stats['sends'] += 1
+            if wait > 0:
+                stats['delayed'] += 1
+                stats['wait_seconds'] += wait
+                stats['max_wait_ms'] = max(stats['max_wait_ms'], wait * 1000)
+                stats['waiting'] += 1
+        return wait
+
+    def end_wait(self):
+        with self.lock:
+            self.stats['waiting'] -= 1
+
+    def observe(self, to, response):
+        """Adapt to a Graph API response, returns its throttling code (or None)"""
+        code = rate_limit_code(response)
+        if code is None:
+            if response.status_code == 200:
+                self.phone.recover()
+                bucket = self.recipients.get(to)
+                if bucket is not None:
+                    bucket.recover()
+            return None
+
+        pause = retry_after(response, DEFAULT_RETRY_AFTER[code])
+        if code == PAIR_RATE_LIMIT and to is not None:
+            self._recipient(to).throttle(pause)
+        else:
+            self.phone.throttle(pause)
+        with self.lock:
+            self.stats['throttled'][str(code)] += 1
+        logger.warning(f"🚦 Graph API throttled ({code}) sending to {to}, pausing {pause:.1f}s")
+        return code
+
+    def snapshot(self):
+        with self.lock:
+            stats = dict(self.stats, throttled=dict(self.stats['throttled']))
+            recipients = len(self.recipients)
+        delayed = stats['delayed']
+        stats['avg_wait_ms'] = round(stats['wait_seconds'] * 1000 / delayed, 1) if delayed else 0.0
+        stats['wait_seconds'] = round(stats['wait_seconds'], 3)
+        stats['max_wait_ms'] = round(stats['max_wait_ms'], 1)
+        stats['phone_rate'] = round(self.phone.rate, 2)
+        stats['recipients_tracked'] = recipients
+        return stats
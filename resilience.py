@@ -0,0 +1,168 @@
+import random
+import threading
+import time
+
+from bot_logging import get_logger
+
+logger = get_logger('resilience')
+
+# Graph API statuses worth retrying (the request may succeed on a second try)
+TRANSIENT_STATUSES = frozenset([500, 502, 503, 504])
+
+# Graph API error codes that reject a message type itself: invalid parameter, missing or invalid
+# parameter value, unsupported message type. Others (131047 outside the 24h window, 131026
+# undeliverable, throttling, ...) are about one recipient or one moment.
+MESSAGE_TYPE_ERRORS = frozenset([100, 131008, 131009, 131051])
+
+
+def graph_error_code(response):
+    """error.code of a Graph API error response, or None"""
+    try:
+        return response.json().get('error', {}).get('code')
+    except (ValueError, AttributeError):
+        return None
+
+
+class CircuitOpen(Exception):
+    """Raised instead of calling the Graph API while the breaker is open"""
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter"""
+
+    def __init__(self, attempts=3, base_delay=0.25, max_delay=4.0):
+        self.attempts = max(1, attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, retry):
+        """Sleep before retry number `retry` (1-based)"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (retry - 1)))
+
+
+class CircuitBreaker:
+    """Stops calls to a failing dependency for reset_timeout seconds.
+
+    closed -> open after failure_threshold consecutive failures; once the
+    timeout has passed a single probe call is let through (half_open) and its
+    result closes or re-opens the circuit.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.lock = threading.Lock()
+        self.stats = {'opened': 0, 'rejected': 0}
+
+    def allow(self):
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return True
+            self.stats['rejected'] += 1
+            return False
+
+    def record_success(self):
+        with self.lock:
+            if self.state != self.CLOSED:
+                logger.info(f"🟢 Circuit {self.name} closed")
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.stats['opened'] += 1
+                    logger.warning(f"🔴 Circuit {self.name} open for {self.reset_timeout:.0f}s "
+                                   f"after {self.failures} failures")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def release(self):
+        """A call let through by allow() ended without a verdict on the dependency"""
+        with self.lock:
+            # Back to open, already past the timeout: the next call is the new probe
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+
+    def snapshot(self):
+        with self.lock:
+            retry_in = 0.0
+            if self.state == self.OPEN:
+                retry_in = max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+            return dict(self.stats, state=self.state, failures=self.failures, retry_in=round(retry_in, 1))
+
+
+class CapabilityCache:
+    """Remembers for a short while which message types the API is rejecting.
+
+    Senders check failing(kind) and go straight to their plain-text fallback
+    instead of paying for a doomed interactive request first. A rejection of
+    the type marks it at once; server errors only after server_error_limit
+    of them in a row for that type (a success resets the count).
+    """
+
+    def __init__(self, ttl=300.0, server_error_limit=3):
+        self.ttl = ttl
+        self.server_error_limit = server_error_limit
+        self.until = {}
+        self.server_errors = {}
+        self.lock = threading.Lock()
+        self.stats = {'marked': 0, 'skipped': 0, 'server_errors': 0}
+
+    def failing(self, kind):
+        until = self.until.get(kind)
+        if until is None:
+            return False
+        if until <= time.monotonic():
+            with self.lock:
+                self.until.pop(kind, None)
+            return False
+        with self.lock:
+            self.stats['skipped'] += 1
+        return True
+
+    def mark_failing(self, kind, reason=None):
+        with self.lock:
+            if kind not in self.until:
+                self.stats['marked'] += 1
+                logger.warning(f"⚠️ {kind} messages failing ({reason}), using text fallback for {self.ttl:.0f}s")
+            self.until[kind] = time.monotonic() + self.ttl
+
+    def server_error(self, kind, reason=None):
+        """A 5xx for this type (after retries); marks it failing once they keep coming"""
+        with self.lock:
+            self.stats['server_errors'] += 1
+            count = self.server_errors[kind] = self.server_errors.get(kind, 0) + 1
+            if count >= self.server_error_limit:
+                # Counted afresh once the mark runs out
+                del self.server_errors[kind]
+        if count >= self.server_error_limit:
+            self.mark_failing(kind, f"{count} server errors in a row, last {reason}")
+
+    def succeeded(self, kind):
+        # Checked first: the common case takes no lock
+        if kind in self.server_errors:
+            with self.lock:
+                self.server_errors.pop(kind, None)
+
+    def clear(self, kind):
+        with self.lock:
+            self.until.pop(kind, None)
+            self.server_errors.pop(kind, None)
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self.lock:
+            failing = {kind: round(until - now, 1) for kind, until in self.until.items() if until > now}
+            return dict(self.stats, failing=failing, server_error_streaks=dict(self.server_errors))
@@ -0,0 +1,188 @@
+import bisect
+import threading
+import time
+from datetime import datetime
+
+from state_store import StateStore
+
+
+def created_at(record):
+    """Creation time of a payment session as epoch seconds"""
+    value = record.get('created_at')
+    if value is not None:
+        return float(value)
+    try:
+        return datetime.strptime(record.get('timestamp', ''), '%Y%m%d%H%M%S').timestamp()
+    except ValueError:
+        return 0.0
+
+
+class IndexedSessionStore(StateStore):
+    """Wraps a payment session store with indexes by phone, status and creation time.
+
+    Writes go through the wrapper and the store reports expiry/eviction, so the
+    indexes stay in step with it. With a shared backend each worker only indexes
+    what it has written or loaded through rebuild(); ids whose record has gone
+    are dropped the next time a lookup touches them.
+    """
+
+    def __init__(self, store):
+        super().__init__()
+        self.store = store
+        self.stats = store.stats
+        self.lock = threading.RLock()
+        self.by_phone = {}
+        self.by_status = {}
+        self.by_time = []
+        self.entries = {}
+        store.on_remove(self._forget)
+
+    # Index maintenance
+
+    def _unindex(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        phone, status, created = entry
+        for index, value in ((self.by_phone, phone), (self.by_status, status)):
+            ids = index.get(value)
+            if ids is not None:
+                ids.discard(key)
+                if not ids:
+                    del index[value]
+        pos = bisect.bisect_left(self.by_time, (created, key))
+        if pos < len(self.by_time) and self.by_time[pos] == (created, key):
+            del self.by_time[pos]
+
+    def _index(self, key, record):
+        with self.lock:
+            self._unindex(key)
+            if record is None:
+                return
+            phone = record.get('phone')
+            status = record.get('status')
+            created = created_at(record)
+            self.entries[key] = (phone, status, created)
+            self.by_phone.setdefault(phone, set()).add(key)
+            self.by_status.setdefault(status, set()).add(key)
+            bisect.insort(self.by_time, (created, key))
+
+    def _forget(self, keys):
+        with self.lock:
+            for key in keys:
+                self._unindex(key)
+
+    def rebuild(self):
+        """Re-read every session from the backing store"""
+        records = self.store.items()
+        with self.lock:
+            self.by_phone, self.by_status, self.by_time, self.entries = {}, {}, [], {}
+            for key, record in records:
+                self._index(key, record)
+        return len(self.entries)
+
+    def _load(self, ids):
+        """Fetch indexed ids, pruning the ones that have expired in the store"""
+        records = self.store.get_many(ids)
+        missing = [key for key in ids if key not in records]
+        if missing:
+            with self.lock:
+                for key in missing:
+                    self._unindex(key)
+        return records
+
+    # Lookups
+
+    def ids_for_phone(self, phone, status=None):
+        with self.lock:
+            ids = set(self.by_phone.get(phone, ()))
+            if status is not None:
+                ids &= self.by_status.get(status, set())
+        return sorted(ids)
+
+    def ids_with_status(self, status):
+        with self.lock:
+            return sorted(self.by_status.get(status, ()))
+
+    def ids_created_between(self, start=None, end=None):
+        """Session ids created in [start, end), oldest first"""
+        with self.lock:
+            lo = 0 if start is None else bisect.bisect_left(self.by_time, (start, ''))
+            hi = len(self.by_time) if end is None else bisect.bisect_left(self.by_time, (end, ''))
+            return [key for _, key in self.by_time[lo:hi]]
+
+    def ids_older_than(self, seconds):
+        return self.ids_created_between(end=time.time() - seconds)
+
+    def find(self, phone=None, status=None, older_than=None, newer_than=None):
+        """Sessions matching every given filter, as {session_id: record}"""
+        candidates = None
+        if phone is not None:
+            candidates = set(self.ids_for_phone(phone))
+        if status is not None:
+            matches = set(self.ids_with_status(status))
+            candidates = matches if candidates is None else candidates & matches
+        if older_than is not None or newer_than is not None:
+            now = time.time()
+            start = None if newer_than is None else now - newer_than
+            end = None if older_than is None else now - older_than
+            matches = set(self.ids_created_between(start, end))
+            candidates = matches if candidates is None else candidates & matches
+        if candidates is None:
+            return dict(self.items())
+        return self._load(sorted(candidates))
+
+    def count_by_status(self):
+        with self.lock:
+            return {status: len(ids) for status, ids in self.by_status.items()}
+
+    # StateStore interface, delegated to the backing store
+
+    def get(self, key, default=None):
+        return self.store.get(key, default)
+
+    def set(self, key, value, ttl=None):
+        self.store.set(key, value, ttl=ttl)
+        self._index(key, value)
+
+    def delete(self, key):
+        removed = self.store.delete(key)
+        self._index(key, None)
+        return removed
+
+    def keys(self):
+        return self.store.keys()
+
+    def purge_expired(self):
+        return self.store.purge_expired()
+
+    def get_many(self, keys):
+        return self.store.get_many(keys)
+
+    def set_many(self, mapping, ttl=None):
+        self.store.set_many(mapping, ttl=ttl)
+        for key, value in mapping.items():
+            self._index(key, value)
+
+    def compare_and_set(self, key, field, expected, value, ttl=None):
+        swapped = self.store.compare_and_set(key, field, expected, value, ttl=ttl)
+        if swapped:
+            self._index(key, value)
+        return swapped
+
+    def patch(self, key, changes, ttl=None):
+        updated = self.store.patch(key, changes, ttl=ttl)
+        self._index(key, updated)
+        return updated
+
+    def scan(self, cursor=None, limit=100):
+        return self.store.scan(cursor, limit)
+
+    def items(self):
+        return self.store.items()
+
+    def __len__(self):
+        return len(self.store)
+
+    def __contains__(self, key):
+        return key in self.store
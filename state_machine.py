@@ -0,0 +1,154 @@
+import time
+
+# Conversation stages (None = no active conversation)
+AWAITING_CONFIRMATION = 'awaiting_confirmation'
+PAYMENT_PENDING = 'payment_pending'
+
+# Events
+ORDER_RECEIVED = 'order_received'
+EDIT = 'edit'
+CONFIRM = 'confirm'
+PAYMENT_COMPLETED = 'payment_completed'
+
+ANY = '*'
+
+
+class UserState:
+    """Compact per-customer conversation record.
+
+    Holds a reference to the order (or payment session) instead of a copy of it.
+    """
+
+    __slots__ = ('stage', 'order_ref', 'session_id', 'whatsapp_phone', 'updated_at')
+
+    def __init__(self, stage, order_ref=None, session_id=None, whatsapp_phone=None, updated_at=None):
+        self.stage = stage
+        self.order_ref = order_ref
+        self.session_id = session_id
+        self.whatsapp_phone = whatsapp_phone
+        self.updated_at = updated_at or time.time()
+
+    def to_record(self):
+        """Positional list used by the shared (sqlite/redis) backends"""
+        return [self.stage, self.order_ref, self.session_id, self.whatsapp_phone, self.updated_at]
+
+    @classmethod
+    def from_record(cls, record):
+        if isinstance(record, dict):
+            # Dict-shaped states written before the state machine existed
+            return cls(record.get('stage'), session_id=record.get('session_id'),
+                       whatsapp_phone=record.get('whatsapp_phone'))
+        return cls(*record)
+
+    @property
+    def version(self):
+        """Identifies this exact record: a new order in the same stage has another order_ref"""
+        return (self.stage, self.order_ref, self.session_id)
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return f"UserState({self.stage!r}, order_ref={self.order_ref!r}, session_id={self.session_id!r})"
+
+
+# (encode, decode) pair for the serializing state store backends
+USER_STATE_CODEC = (UserState.to_record, UserState.from_record)
+
+
+class Transition:
+    __slots__ = ('stage', 'event', 'handler', 'next_stage')
+
+    def __init__(self, stage, event, handler, next_stage):
+        self.stage = stage
+        self.event = event
+        self.handler = handler
+        self.next_stage = next_stage
+
+
+# (stage, event, handler method on the bot, stage after a successful transition)
+TRANSITIONS = [
+    (ANY, ORDER_RECEIVED, 'on_order_received', AWAITING_CONFIRMATION),
+    (AWAITING_CONFIRMATION, EDIT, 'on_edit_order', None),
+    (AWAITING_CONFIRMATION, CONFIRM, 'on_confirm_order', PAYMENT_PENDING),
+    (PAYMENT_PENDING, PAYMENT_COMPLETED, 'on_payment_completed', None),
+    (ANY, EDIT, 'on_session_expired', None),
+    (ANY, CONFIRM, 'on_session_expired', None)
+]
+
+
+class ConversationMachine:
+    """Transition-table engine over a user state store.
+
+    dispatch() looks up (stage, event) in a dict (falling back to (ANY, event))
+    and calls the handler with the current record; handlers commit their stage
+    change with advance(), which is a compare-and-set on the stored record's
+    version (stage plus the order/session it is about), so a new order that
+    replaced the record in the same stage is not mistaken for the one read.
+    """
+
+    def __init__(self, owner, store, transitions=TRANSITIONS, stage_ttls=None):
+        self.owner = owner
+        self.store = store
+        self.stage_ttls = stage_ttls or {}
+        self.table = {}
+        for stage, event, handler, next_stage in transitions:
+            key = (stage, event)
+            if key in self.table:
+                raise ValueError(f"Duplicate transition for {key}")
+            self.table[key] = Transition(stage, event, handler, next_stage)
+
+    def dispatch(self, key, event, **context):
+        state = self.store.get(key)
+        stage = state.stage if state is not None else None
+        transition = self.table.get((stage, event)) or self.table.get((ANY, event))
+        if transition is None:
+            return None
+        return getattr(self.owner, transition.handler)(key, state, transition, **context)
+
+    def advance(self, key, state, transition, **fields):
+        """Atomically move key from state's stage to transition.next_stage.
+
+        Returns the new record (or True when the conversation ends), or None if
+        another request changed or replaced the record first.
+        """
+        expected = state.version if state is not None else None
+        if transition.next_stage is None:
+            return True if self.store.compare_and_set(key, 'version', expected, None) else None
+
+        new_state = UserState(transition.next_stage, **fields)
+        ttl = self.stage_ttls.get(transition.next_stage)
+        if self.store.compare_and_set(key, 'version', expected, new_state, ttl=ttl):
+            return new_state
+        return None
+
+    def replace(self, key, transition, **fields):
+        """Unconditionally start transition.next_stage (used when a new order supersedes the old one)"""
+        new_state = UserState(transition.next_stage, **fields)
+        self.store.set(key, new_state, ttl=self.stage_ttls.get(transition.next_stage))
+        return new_state
+
+    def describe(self):
+        """Transition table as aligned text, for auditing"""
+        rows = [('STAGE', 'EVENT', 'HANDLER', 'NEXT STAGE')]
+        for t in self.table.values():
+            rows.append((str(t.stage or '-'), t.event, t.handler, str(t.next_stage or '(end)')))
+        widths = [max(len(row[i]) for row in rows) for i in range(4)]
+        return '\n'.join('  '.join(cell.ljust(w) for cell, w in zip(row, widths)).rstrip() for row in rows)
+
+    def to_dot(self):
+        """Transition graph in Graphviz DOT format"""
+        lines = ['digraph conversation {', '  rankdir=LR;']
+        for t in self.table.values():
+            source = t.stage or 'idle'
+            target = t.next_stage or 'idle'
+            lines.append(f'  "{source}" -> "{target}" [label="{t.event} / {t.handler}"];')
+        lines.append('}')
+        return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    import sys
+
+    machine = ConversationMachine(owner=None, store=None)
+    print(machine.to_dot() if '--dot' in sys.argv else machine.describe())
@@ -0,0 +1,718 @@
+import bisect
+import heapq
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+def _field(value, name):
+    """Read a field from a stored record (None when the record is missing)"""
+    if value is None:
+        return None
+    if isinstance(value, dict):
+        return value.get(name)
+    return getattr(value, name, None)
+
+
+def _deadline(ttl, now=None):
+    """Absolute expiry time for a ttl in seconds (None = never expires)"""
+    if ttl is None:
+        return None
+    return (now or time.time()) + ttl
+
+
+class KeyedLocks:
+    """Fixed pool of locks picked by key hash, for per-key critical sections in one process"""
+
+    def __init__(self, stripes=64):
+        self.locks = [threading.Lock() for _ in range(stripes)]
+
+    def lock_for(self, key):
+        return self.locks[hash(key) % len(self.locks)]
+
+
+class StateStore:
+    """Key/value store for bot state with dict-style access.
+
+    Every write takes an optional ttl in seconds; expired records read as missing.
+    Backends that serialize take an optional (encode, decode) codec applied
+    around JSON, so records can be objects rather than plain dicts.
+    """
+
+    def __init__(self, codec=None):
+        self.encode, self.decode = codec or (None, None)
+        self.stats = {'expired': 0, 'evicted': 0}
+        self.stats_lock = threading.Lock()
+        self.removal_listeners = []
+
+    def _dumps(self, value):
+        return json.dumps(self.encode(value) if self.encode else value)
+
+    def _loads(self, raw):
+        value = json.loads(raw)
+        return self.decode(value) if self.decode else value
+
+    def _count(self, name, amount=1):
+        if amount:
+            with self.stats_lock:
+                self.stats[name] += amount
+
+    def on_remove(self, listener):
+        """Call listener(keys) whenever records are expired or evicted"""
+        self.removal_listeners.append(listener)
+
+    def _removed(self, name, keys):
+        self._count(name, len(keys))
+        if keys:
+            for listener in self.removal_listeners:
+                listener(keys)
+
+    def get(self, key, default=None):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None):
+        raise NotImplementedError
+
+    def delete(self, key):
+        """Remove key, returns True if it existed"""
+        raise NotImplementedError
+
+    def keys(self):
+        raise NotImplementedError
+
+    def purge_expired(self):
+        """Drop expired records, returns how many were removed"""
+        return 0
+
+    def get_many(self, keys):
+        """Fetch several keys at once, missing keys are left out"""
+        result = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                result[key] = value
+        return result
+
+    def set_many(self, mapping, ttl=None):
+        for key, value in mapping.items():
+            self.set(key, value, ttl=ttl)
+
+    def compare_and_set(self, key, field, expected, value, ttl=None):
+        """Atomically replace key with value if its `field` equals expected.
+
+        A missing record matches expected=None; value=None deletes the record.
+        Returns True when the swap happened.
+        """
+        raise NotImplementedError
+
+    def patch(self, key, changes, ttl=None):
+        """Atomically merge changes into an existing record, returns the new record or None"""
+        raise NotImplementedError
+
+    def scan(self, cursor=None, limit=100):
+        """One page of (key, value) pairs plus the cursor for the next page (None at the end)"""
+        keys = self.keys()
+        if cursor is not None:
+            keys = keys[bisect.bisect_right(keys, cursor):]
+        page = keys[:limit]
+        values = self.get_many(page)
+        next_cursor = page[-1] if len(keys) > limit else None
+        return [(key, values[key]) for key in page if key in values], next_cursor
+
+    def items(self):
+        keys = self.keys()
+        values = self.get_many(keys)
+        return [(key, values[key]) for key in keys if key in values]
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        if not self.delete(key):
+            raise KeyError(key)
+
+
+class MemoryStateStore(StateStore):
+    """Per-process store, the default for single-worker deployments.
+
+    Expiry uses a min-heap of deadlines (stale heap entries are skipped lazily),
+    and max_entries evicts the least recently written record. A sorted key list
+    backs cursor pagination.
+    """
+
+    def __init__(self, namespace='default', max_entries=None):
+        super().__init__()
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.data = OrderedDict()
+        self.sorted_keys = []
+        self.deadlines = {}
+        self.heap = []
+        self.lock = threading.RLock()
+
+    def _expired(self, key, now):
+        deadline = self.deadlines.get(key)
+        return deadline is not None and deadline <= now
+
+    def _unsort(self, key):
+        pos = bisect.bisect_left(self.sorted_keys, key)
+        if pos < len(self.sorted_keys) and self.sorted_keys[pos] == key:
+            del self.sorted_keys[pos]
+
+    def _remove(self, key):
+        self.deadlines.pop(key, None)
+        if self.data.pop(key, None) is None:
+            return False
+        self._unsort(key)
+        return True
+
+    def _store(self, key, value, ttl, now):
+        data = self.data
+        if key in data:
+            data.move_to_end(key)
+        else:
+            bisect.insort(self.sorted_keys, key)
+        data[key] = value
+
+        deadline = _deadline(ttl, now)
+        if deadline is None:
+            self.deadlines.pop(key, None)
+        else:
+            self.deadlines[key] = deadline
+            heapq.heappush(self.heap, (deadline, key))
+
+        if self.max_entries and len(data) > self.max_entries:
+            evicted = []
+            while len(data) > self.max_entries:
+                oldest, _ = data.popitem(last=False)
+                self.deadlines.pop(oldest, None)
+                self._unsort(oldest)
+                evicted.append(oldest)
+            self._removed('evicted', evicted)
+
+    def _purge(self, now):
+        heap = self.heap
+        deadlines = self.deadlines
+        expired = []
+        while heap and heap[0][0] <= now:
+            deadline, key = heapq.heappop(heap)
+            # Skip heap entries left behind by rewrites or deletes
+            if deadlines.get(key) == deadline:
+                self._remove(key)
+                expired.append(key)
+
+        # Rebuild when rewritten keys leave too many stale entries behind
+        if len(heap) > 2 * len(deadlines) + 64:
+            self.heap = [(deadline, key) for key, deadline in deadlines.items()]
+            heapq.heapify(self.heap)
+
+        self._removed('expired', expired)
+        return len(expired)
+
+    def purge_expired(self):
+        with self.lock:
+            return self._purge(time.time())
+
+    def get(self, key, default=None):
+        value = self.data.get(key)
+        if value is None:
+            return default
+        if self._expired(key, time.time()):
+            with self.lock:
+                self._purge(time.time())
+            return default
+        return value
+
+    def set(self, key, value, ttl=None):
+        with self.lock:
+            now = time.time()
+            self._purge(now)
+            self._store(key, value, ttl, now)
+
+    def delete(self, key):
+        with self.lock:
+            return self._remove(key)
+
+    def keys(self):
+        with self.lock:
+            self._purge(time.time())
+            return list(self.data)
+
+    def get_many(self, keys):
+        now = time.time()
+        data = self.data
+        with self.lock:
+            return {key: data[key] for key in keys if key in data and not self._expired(key, now)}
+
+    def set_many(self, mapping, ttl=None):
+        with self.lock:
+            now = time.time()
+            self._purge(now)
+            for key, value in mapping.items():
+                self._store(key, value, ttl, now)
+
+    def compare_and_set(self, key, field, expected, value, ttl=None):
+        with self.lock:
+            now = time.time()
+            self._purge(now)
+            if _field(self.data.get(key), field) != expected:
+                return False
+            if value is None:
+                self._remove(key)
+            else:
+                self._store(key, value, ttl, now)
+            return True
+
+    def patch(self, key, changes, ttl=None):
+        with self.lock:
+            now = time.time()
+            self._purge(now)
+            current = self.data.get(key)
+            if current is None:
+                return None
+            updated = dict(current, **changes)
+            if ttl is None:
+                # Keep the record's existing deadline
+                deadline = self.deadlines.get(key)
+                ttl = None if deadline is None else deadline - now
+            self._store(key, updated, ttl, now)
+            return updated
+
+    def scan(self, cursor=None, limit=100):
+        with self.lock:
+            self._purge(time.time())
+            keys = self.sorted_keys
+            start = 0 if cursor is None else bisect.bisect_right(keys, cursor)
+            page = keys[start:start + limit]
+            next_cursor = page[-1] if start + limit < len(keys) else None
+            return [(key, self.data[key]) for key in page], next_cursor
+
+    def items(self):
+        with self.lock:
+            self._purge(time.time())
+            return list(self.data.items())
+
+    def __len__(self):
+        with self.lock:
+            self._purge(time.time())
+            return len(self.data)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+
+class SQLiteStateStore(StateStore):
+    """SQLite (WAL mode) store shared by every worker process on the host.
+
+    Expired rows are filtered on read and deleted through the expires_at index
+    at most once per purge_interval; max_entries trims the least recently written rows.
+    Row counts per namespace are kept by triggers, so len() never counts the table
+    (it may include rows expired since the last purge).
+    """
+
+    BATCH = 500
+    LIVE = "namespace = ? AND (expires_at IS NULL OR expires_at > ?)"
+
+    def __init__(self, path, namespace='default', busy_timeout=5.0, max_entries=None, purge_interval=30.0,
+                 codec=None):
+        super().__init__(codec)
+        self.path = path
+        self.namespace = namespace
+        self.busy_timeout = busy_timeout
+        self.max_entries = max_entries
+        self.purge_interval = purge_interval
+        self.next_purge = 0.0
+        self.local = threading.local()
+
+        self._transaction(self._create_schema)
+
+    @staticmethod
+    def _create_schema(conn):
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS state ("
+            "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+            "PRIMARY KEY (namespace, key)) WITHOUT ROWID"
+        )
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(state)")}
+        if 'expires_at' not in columns:
+            conn.execute("ALTER TABLE state ADD COLUMN expires_at REAL")
+        if 'updated_at' not in columns:
+            conn.execute("ALTER TABLE state ADD COLUMN updated_at REAL NOT NULL DEFAULT 0")
+        conn.execute("CREATE INDEX IF NOT EXISTS state_expiry ON state (namespace, expires_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS state_age ON state (namespace, updated_at)")
+
+        exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'state_counts'"
+        ).fetchone()
+        if not exists:
+            conn.execute("CREATE TABLE state_counts (namespace TEXT PRIMARY KEY, rows INTEGER NOT NULL)")
+            conn.execute(
+                "INSERT INTO state_counts SELECT namespace, COUNT(*) FROM state GROUP BY namespace"
+            )
+            conn.execute(
+                "CREATE TRIGGER state_count_insert AFTER INSERT ON state BEGIN "
+                "INSERT INTO state_counts (namespace, rows) VALUES (NEW.namespace, 1) "
+                "ON CONFLICT (namespace) DO UPDATE SET rows = rows + 1; END"
+            )
+            conn.execute(
+                "CREATE TRIGGER state_count_delete AFTER DELETE ON state BEGIN "
+                "UPDATE state_counts SET rows = rows - 1 WHERE namespace = OLD.namespace; END"
+            )
+
+    def _conn(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            # Autocommit mode; transactions are opened explicitly with BEGIN IMMEDIATE
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    def _read(self, conn, key):
+        row = conn.execute(
+            f"SELECT value, expires_at FROM state WHERE {self.LIVE} AND key = ?",
+            (self.namespace, time.time(), key)
+        ).fetchone()
+        return (self._loads(row[0]), row[1]) if row else (None, None)
+
+    # Upsert rather than INSERT OR REPLACE so the row-count triggers see real inserts only
+    UPSERT = (
+        "INSERT INTO state (namespace, key, value, expires_at, updated_at) VALUES (?, ?, ?, ?, ?) "
+        "ON CONFLICT (namespace, key) DO UPDATE SET "
+        "value = excluded.value, expires_at = excluded.expires_at, updated_at = excluded.updated_at"
+    )
+
+    def _write(self, conn, key, value, ttl):
+        now = time.time()
+        conn.execute(self.UPSERT, (self.namespace, key, self._dumps(value), _deadline(ttl, now), now))
+
+    def _delete(self, conn, key):
+        cursor = conn.execute(
+            "DELETE FROM state WHERE namespace = ? AND key = ?", (self.namespace, key)
+        )
+        return cursor.rowcount > 0
+
+    def _transaction(self, fn):
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            result = fn(conn)
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        return result
+
+    def _maybe_purge(self):
+        if time.monotonic() >= self.next_purge:
+            self.purge_expired()
+
+    def purge_expired(self):
+        self.next_purge = time.monotonic() + self.purge_interval
+        conn = self._conn()
+        expired = [row[0] for row in conn.execute(
+            "DELETE FROM state WHERE namespace = ? AND expires_at <= ? RETURNING key",
+            (self.namespace, time.time())
+        )]
+        self._removed('expired', expired)
+
+        if self.max_entries:
+            count = conn.execute(
+                "SELECT COUNT(*) FROM state WHERE namespace = ?", (self.namespace,)
+            ).fetchone()[0]
+            if count > self.max_entries:
+                evicted = [row[0] for row in conn.execute(
+                    "DELETE FROM state WHERE namespace = ? AND key IN ("
+                    "SELECT key FROM state WHERE namespace = ? ORDER BY updated_at LIMIT ?) RETURNING key",
+                    (self.namespace, self.namespace, count - self.max_entries)
+                )]
+                self._removed('evicted', evicted)
+        return len(expired)
+
+    def get(self, key, default=None):
+        value, _ = self._read(self._conn(), key)
+        return default if value is None else value
+
+    def set(self, key, value, ttl=None):
+        self._maybe_purge()
+        self._write(self._conn(), key, value, ttl)
+
+    def delete(self, key):
+        return self._delete(self._conn(), key)
+
+    def keys(self):
+        rows = self._conn().execute(
+            f"SELECT key FROM state WHERE {self.LIVE} ORDER BY key", (self.namespace, time.time())
+        )
+        return [row[0] for row in rows]
+
+    def get_many(self, keys):
+        keys = list(keys)
+        conn = self._conn()
+        now = time.time()
+        result = {}
+        for i in range(0, len(keys), self.BATCH):
+            chunk = keys[i:i + self.BATCH]
+            placeholders = ','.join('?' * len(chunk))
+            rows = conn.execute(
+                f"SELECT key, value FROM state WHERE {self.LIVE} AND key IN ({placeholders})",
+                [self.namespace, now] + chunk
+            )
+            for key, value in rows:
+                result[key] = self._loads(value)
+        return result
+
+    def set_many(self, mapping, ttl=None):
+        self._maybe_purge()
+        now = time.time()
+        deadline = _deadline(ttl, now)
+        rows = [(self.namespace, key, self._dumps(value), deadline, now) for key, value in mapping.items()]
+
+        def write(conn):
+            conn.executemany(self.UPSERT, rows)
+        self._transaction(write)
+
+    def compare_and_set(self, key, field, expected, value, ttl=None):
+        self._maybe_purge()
+
+        def swap(conn):
+            current, _ = self._read(conn, key)
+            if _field(current, field) != expected:
+                return False
+            if value is None:
+                self._delete(conn, key)
+            else:
+                self._write(conn, key, value, ttl)
+            return True
+        return self._transaction(swap)
+
+    def patch(self, key, changes, ttl=None):
+        def merge(conn):
+            current, expires_at = self._read(conn, key)
+            if current is None:
+                return None
+            updated = dict(current, **changes)
+            remaining = ttl
+            if remaining is None and expires_at is not None:
+                remaining = expires_at - time.time()
+            self._write(conn, key, updated, remaining)
+            return updated
+        return self._transaction(merge)
+
+    def items(self):
+        rows = self._conn().execute(
+            f"SELECT key, value FROM state WHERE {self.LIVE} ORDER BY key", (self.namespace, time.time())
+        )
+        return [(key, self._loads(value)) for key, value in rows]
+
+    def scan(self, cursor=None, limit=100):
+        rows = self._conn().execute(
+            f"SELECT key, value FROM state WHERE {self.LIVE} AND key > ? ORDER BY key LIMIT ?",
+            (self.namespace, time.time(), '' if cursor is None else cursor, limit + 1)
+        ).fetchall()
+        next_cursor = rows[limit - 1][0] if len(rows) > limit else None
+        return [(key, self._loads(value)) for key, value in rows[:limit]], next_cursor
+
+    def __len__(self):
+        self._maybe_purge()
+        row = self._conn().execute(
+            "SELECT rows FROM state_counts WHERE namespace = ?", (self.namespace,)
+        ).fetchone()
+        return row[0] if row else 0
+
+
+class RedisStateStore(StateStore):
+    """Store for any Redis-protocol server, shared across hosts.
+
+    Records expire natively (PX); a sorted set scored by deadline tracks live keys
+    so counts and expiry counters never need a keyspace scan.
+    """
+
+    NEVER = float('inf')
+
+    def __init__(self, url='redis://localhost:6379/0', namespace='default', client=None,
+                 max_retries=10, max_entries=None, codec=None):
+        super().__init__(codec)
+        if client is None:
+            if redis is None:
+                raise RuntimeError("redis package is not installed (pip install redis)")
+            client = redis.Redis.from_url(url)
+        self.client = client
+        # Resolved once: an injected client works without the redis package (nothing to catch then)
+        self.watch_error = getattr(redis, 'WatchError', ())
+        self.namespace = namespace
+        self.prefix = f"bot:{namespace}:"
+        self.index_key = f"bot:{namespace}#expiry"
+        self.max_retries = max_retries
+        self.max_entries = max_entries
+
+    def _key(self, key):
+        return self.prefix + key
+
+    def _decode(self, raw):
+        return self._loads(raw) if raw is not None else None
+
+    def _queue_write(self, pipe, key, value, ttl, now):
+        if ttl is None:
+            pipe.set(self._key(key), self._dumps(value))
+            pipe.zadd(self.index_key, {key: self.NEVER})
+        else:
+            pipe.set(self._key(key), self._dumps(value), px=max(1, int(ttl * 1000)))
+            pipe.zadd(self.index_key, {key: now + ttl})
+
+    def purge_expired(self):
+        now = time.time()
+        expired = [self._member(m) for m in self.client.zrangebyscore(self.index_key, '-inf', now)]
+        if expired:
+            self.client.zrem(self.index_key, *expired)
+        self._removed('expired', expired)
+
+        if self.max_entries:
+            excess = self.client.zcard(self.index_key) - self.max_entries
+            if excess > 0:
+                # Evict the records closest to expiry first
+                evicted = [self._member(m) for m, _ in self.client.zpopmin(self.index_key, excess)]
+                if evicted:
+                    self.client.delete(*[self._key(key) for key in evicted])
+                self._removed('evicted', evicted)
+        return len(expired)
+
+    @staticmethod
+    def _member(member):
+        return member.decode() if isinstance(member, bytes) else member
+
+    def get(self, key, default=None):
+        # None keys (legacy states without an order_ref) are simply absent, as in the other backends
+        if key is None:
+            return default
+        value = self._decode(self.client.get(self._key(key)))
+        return default if value is None else value
+
+    def set(self, key, value, ttl=None):
+        pipe = self.client.pipeline(transaction=True)
+        self._queue_write(pipe, key, value, ttl, time.time())
+        pipe.execute()
+        if self.max_entries:
+            self.purge_expired()
+
+    def delete(self, key):
+        if key is None:
+            return False
+        pipe = self.client.pipeline(transaction=True)
+        pipe.delete(self._key(key))
+        pipe.zrem(self.index_key, key)
+        removed, _ = pipe.execute()
+        return removed > 0
+
+    def keys(self):
+        self.purge_expired()
+        return sorted(self._member(member) for member in self.client.zrange(self.index_key, 0, -1))
+
+    def get_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return {}
+        raws = self.client.mget([self._key(key) for key in keys])
+        return {key: self._decode(raw) for key, raw in zip(keys, raws) if raw is not None}
+
+    def set_many(self, mapping, ttl=None):
+        if not mapping:
+            return
+        now = time.time()
+        pipe = self.client.pipeline(transaction=True)
+        for key, value in mapping.items():
+            self._queue_write(pipe, key, value, ttl, now)
+        pipe.execute()
+        if self.max_entries:
+            self.purge_expired()
+
+    def _optimistic(self, key, fn):
+        """Run fn(current, pttl) under WATCH, retrying when another writer wins"""
+        redis_key = self._key(key)
+        for _ in range(self.max_retries):
+            with self.client.pipeline(transaction=True) as pipe:
+                try:
+                    pipe.watch(redis_key)
+                    current = self._decode(pipe.get(redis_key))
+                    pttl = pipe.pttl(redis_key)
+                    proceed, value, ttl, result = fn(current, pttl)
+                    if not proceed:
+                        pipe.unwatch()
+                        return result
+                    pipe.multi()
+                    if value is None:
+                        pipe.delete(redis_key)
+                        pipe.zrem(self.index_key, key)
+                    else:
+                        self._queue_write(pipe, key, value, ttl, time.time())
+                    pipe.execute()
+                    return result
+                except self.watch_error:
+                    continue
+        raise RuntimeError(f"Too much contention updating {key}")
+
+    def compare_and_set(self, key, field, expected, value, ttl=None):
+        def swap(current, pttl):
+            if _field(current, field) != expected:
+                return False, None, None, False
+            return True, value, ttl, True
+        return self._optimistic(key, swap)
+
+    def patch(self, key, changes, ttl=None):
+        def merge(current, pttl):
+            if current is None:
+                return False, None, None, None
+            updated = dict(current, **changes)
+            remaining = ttl
+            if remaining is None and pttl and pttl > 0:
+                remaining = pttl / 1000
+            return True, updated, remaining, updated
+        return self._optimistic(key, merge)
+
+    def scan(self, cursor=None, limit=100):
+        """Page with ZSCAN; the cursor is Redis' own, so order is unspecified"""
+        now = time.time()
+        next_cursor, members = self.client.zscan(self.index_key, int(cursor or 0), count=limit)
+        keys = [self._member(member) for member, score in members if score > now]
+        values = self.get_many(keys)
+        return [(key, values[key]) for key in keys if key in values], (str(next_cursor) if next_cursor else None)
+
+    def __len__(self):
+        self.purge_expired()
+        return self.client.zcard(self.index_key)
+
+
+def create_state_store(namespace, backend='memory', sqlite_path='bot_state.db', redis_url=None, max_entries=None,
+                       codec=None):
+    """Build the configured store for one namespace (the memory backend keeps objects as-is)"""
+    if backend == 'memory':
+        return MemoryStateStore(namespace, max_entries=max_entries)
+    if backend == 'sqlite':
+        return SQLiteStateStore(sqlite_path, namespace=namespace, max_entries=max_entries, codec=codec)
+    if backend == 'redis':
+        return RedisStateStore(redis_url or 'redis://localhost:6379/0', namespace=namespace,
+                               max_entries=max_entries, codec=codec)
+    raise ValueError(f"Unknown state backend: {backend}")
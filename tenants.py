@@ -0,0 +1,234 @@
+import json
+import os
+import threading
+
+from bot_logging import get_logger
+
+logger = get_logger('tenants')
+
+# The tenant configured through the WHATSAPP_* environment variables
+DEFAULT_TENANT = 'default'
+
+
+class Tenant:
+    """One restaurant: its WhatsApp number and credentials, links and send limits"""
+
+    def __init__(self, tenant_id, phone_id, token, website_url, payment_link, namespace=None,
+                 pool_size=10, messages_per_second=80, recipient_per_minute=10, recipient_burst=6,
+                 qr_template=None, menu_source=None):
+        self.id = tenant_id
+        self.phone_id = str(phone_id) if phone_id else None
+        self.token = token
+        self.website_url = website_url
+        self.payment_link = payment_link
+        # None keeps the original store names (the default tenant's existing data)
+        self.namespace = namespace
+        self.pool_size = pool_size
+        self.messages_per_second = messages_per_second
+        self.recipient_per_minute = recipient_per_minute
+        self.recipient_burst = recipient_burst
+        self.qr_template = qr_template or f"{payment_link}{{amount}}"
+        self.menu_source = menu_source
+
+    @property
+    def default(self):
+        return self.id == DEFAULT_TENANT
+
+    def namespaced(self, name):
+        """State store namespace for this tenant's copy of a collection"""
+        return f"{self.namespace}:{name}" if self.namespace else name
+
+    def settings(self):
+        """Everything a running bot depends on, for change detection on reload"""
+        return dict(vars(self))
+
+    def describe(self):
+        """Settings without the token, for /health and /tenants"""
+        return {key: value for key, value in vars(self).items() if key != 'token'}
+
+
+# Record fields that must be strings when given
+_TEXT_FIELDS = ('token', 'token_env', 'website_url', 'payment_link', 'qr_template', 'menu_source')
+
+
+def _number(record, name, kind, default):
+    """record[name] as int/float (missing or null = default); anything else is a ValueError"""
+    value = record.get(name)
+    if value is None:
+        return default
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise ValueError(f"Tenant {record.get('id')!r}: {name} must be a number")
+    try:
+        return kind(value)
+    except ValueError:
+        raise ValueError(f"Tenant {record.get('id')!r}: {name} must be a number, not {value!r}")
+
+
+def parse_tenants(data, defaults):
+    """Tenants from {"tenants": [...]} (or a bare list) of records.
+
+    A record needs id, phone_id and token (or token_env, the name of an
+    environment variable holding it); website_url, payment_link, pool_size
+    and the rate limits default to the default tenant's settings. The QR code
+    follows the tenant's payment link unless qr_template is given (its
+    {amount} is filled in and the session's redirect appended), and
+    menu_source gives the tenant its own list menu.
+    """
+    records = data.get('tenants', []) if isinstance(data, dict) else data
+    if not isinstance(records, list):
+        raise ValueError('Tenants file must hold a list of tenants or {"tenants": [...]}')
+    tenants = []
+    ids = {DEFAULT_TENANT}
+    phone_ids = {defaults.phone_id} if defaults.phone_id else set()
+    for record in records:
+        if not isinstance(record, dict):
+            raise ValueError(f"Tenant record {record!r} is not an object")
+        for name in _TEXT_FIELDS:
+            if record.get(name) is not None and not isinstance(record[name], str):
+                raise ValueError(f"Tenant {record.get('id')!r}: {name} must be a string")
+        tenant_id = str(record.get('id') or '').strip()
+        token = record.get('token') or os.environ.get(record.get('token_env') or '', '')
+        if not tenant_id or not record.get('phone_id') or not token:
+            raise ValueError(f"Tenant {tenant_id or record!r} needs id, phone_id and token (or token_env)")
+        if tenant_id in ids or '/' in tenant_id:
+            raise ValueError(f"Tenant id {tenant_id!r} is reserved, repeated or contains '/'")
+        phone_id = str(record['phone_id'])
+        if phone_id in phone_ids:
+            raise ValueError(f"Phone number id {phone_id} is used by more than one tenant")
+        ids.add(tenant_id)
+        phone_ids.add(phone_id)
+        payment_link = record.get('payment_link') or defaults.payment_link
+        tenants.append(Tenant(
+            tenant_id, phone_id, token,
+            website_url=record.get('website_url') or defaults.website_url,
+            payment_link=payment_link,
+            namespace=tenant_id,
+            pool_size=_number(record, 'pool_size', int, defaults.pool_size),
+            messages_per_second=_number(record, 'messages_per_second', float, defaults.messages_per_second),
+            recipient_per_minute=_number(record, 'recipient_per_minute', float, defaults.recipient_per_minute),
+            recipient_burst=_number(record, 'recipient_burst', int, defaults.recipient_burst),
+            qr_template=record.get('qr_template'),
+            menu_source=record.get('menu_source')
+        ))
+    return tenants
+
+
+class TenantRouter:
+    """Bots by tenant id and by WhatsApp phone_number_id.
+
+    The default bot (environment config) is always present; more tenants come
+    from a JSON file that is re-read when its mtime changes. A reload builds
+    bots for new or changed tenants off to the side (build(tenant, previous)
+    lets a changed tenant keep its stores) and swaps both lookup tables in as
+    one tuple, so a webhook never sees a half-applied config. A file that
+    fails to parse leaves the running tenants untouched.
+    """
+
+    def __init__(self, default_bot, build, path=None, reload_interval=10.0, retire=None):
+        self.default_bot = default_bot
+        self.build = build
+        self.retire = retire
+        self.path = path
+        self.reload_interval = reload_interval
+        self.tag = None
+        self.tables = self._tables({DEFAULT_TENANT: default_bot})
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+        self.stats = {'reloads': 0, 'errors': 0, 'last_error': None}
+
+    @staticmethod
+    def _tables(bots):
+        by_phone = {target.tenant.phone_id: target for target in bots.values() if target.tenant.phone_id}
+        return bots, by_phone
+
+    def for_phone_id(self, phone_id):
+        """Bot for a webhook's metadata.phone_number_id (None when no tenant owns the number)"""
+        bots, by_phone = self.tables
+        if phone_id is None:
+            return self.default_bot
+        target = by_phone.get(str(phone_id))
+        if target is None and len(bots) == 1:
+            # Single tenant: keep answering whatever number Meta reports, as before tenants existed
+            return self.default_bot
+        return target
+
+    def get(self, tenant_id=None):
+        """Bot by tenant id (the default bot for None or ''), None if unknown"""
+        if not tenant_id:
+            return self.default_bot
+        return self.tables[0].get(tenant_id)
+
+    def bots(self):
+        return list(self.tables[0].values())
+
+    def reload(self, force=False):
+        """Re-read the tenants file if it changed, returns True when the tables were replaced"""
+        if not self.path:
+            return False
+        with self.lock:
+            tag = None
+            try:
+                stat = os.stat(self.path)
+                tag = (stat.st_mtime_ns, stat.st_size)
+                if tag == self.tag and not force:
+                    return False
+                with open(self.path, encoding='utf-8') as f:
+                    tenants = parse_tenants(json.load(f), self.default_bot.tenant)
+            except (OSError, ValueError, TypeError, AttributeError) as e:
+                # A bad file is reported once, not on every check until it is fixed
+                self.tag = tag or self.tag
+                self.stats['errors'] += 1
+                self.stats['last_error'] = str(e)
+                logger.error(f"❌ Tenants not reloaded, keeping {len(self.tables[0])} tenants: {e}")
+                return False
+
+            current = self.tables[0]
+            bots = {DEFAULT_TENANT: self.default_bot}
+            added, changed = [], []
+            for tenant in tenants:
+                previous = current.get(tenant.id)
+                if previous is not None and previous.tenant.settings() == tenant.settings():
+                    bots[tenant.id] = previous
+                    continue
+                bots[tenant.id] = self.build(tenant, previous)
+                (changed if previous is not None else added).append(tenant.id)
+            removed = [tenant_id for tenant_id in current if tenant_id not in bots]
+
+            self.tables = self._tables(bots)
+            self.tag = tag
+            self.stats['reloads'] += 1
+
+        if self.retire is not None:
+            for tenant_id in removed + changed:
+                self.retire(current[tenant_id], bots.get(tenant_id))
+        logger.info(f"🏪 Tenants reloaded: {len(bots)} active (added {added or '-'}, changed {changed or '-'}, "
+                    f"removed {removed or '-'})")
+        return True
+
+    def start(self):
+        """Initial load, then watch the file every reload_interval seconds"""
+        self.reload()
+        if self.path and self.reload_interval > 0:
+            threading.Thread(target=self._run, name='tenant-reload', daemon=True).start()
+        return self
+
+    def _run(self):
+        while not self.stop.wait(self.reload_interval):
+            try:
+                self.reload()
+            except Exception as e:
+                # E.g. a tenant bot that fails to build: keep watching, the next change may fix it
+                self.stats['errors'] += 1
+                self.stats['last_error'] = str(e)
+                logger.exception(f"❌ Tenants reload failed: {e}")
+
+    def shutdown(self):
+        self.stop.set()
+
+    def snapshot(self):
+        bots, by_phone = self.tables
+        stats = dict(self.stats)
+        stats['tenants'] = {tenant_id: target.tenant.describe() for tenant_id, target in bots.items()}
+        stats['phone_ids'] = len(by_phone)
+        return stats
+
@@ -0,0 +1,74 @@
+import atexit
+import json
+import os
+import sys
+import tempfile
+import threading
+
+import pytest
+
+# The bot modules live flat in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Importing Chatbot opens its sqlite stores (campaigns); keep them out of the working tree
+os.environ.setdefault('STATE_DB_PATH', os.path.join(tempfile.mkdtemp(prefix='bot-tests-'), 'bot_state.db'))
+
+
+class FakeResponse:
+    def __init__(self, status_code=200, body=None):
+        self.status_code = status_code
+        self.body = body or {}
+        self.text = json.dumps(self.body)
+
+    def json(self):
+        return self.body
+
+
+class FakeClient:
+    """Records what would have gone to the Graph API; respond(kind) picks the reply"""
+
+    def __init__(self):
+        self.sent = []
+        self.lock = threading.Lock()
+        self.respond = lambda kind: FakeResponse()
+
+    def send_raw(self, body, phone_number, kind='text'):
+        if isinstance(body, bytes):
+            body = body.decode('utf-8')
+        if not isinstance(body, str):
+            body = json.dumps(body, ensure_ascii=False)
+        with self.lock:
+            self.sent.append((phone_number, kind, body))
+        return self.respond(kind)
+
+    def kinds(self):
+        return [kind for _, kind, _ in self.sent]
+
+
+@pytest.fixture
+def fake_client():
+    return FakeClient()
+
+
+@pytest.fixture
+def make_bot():
+    """WhatsAppOrderBot on fresh in-memory stores (other stores and attachments passed as keywords)"""
+    from Chatbot import WhatsAppOrderBot
+    from state_store import create_state_store
+
+    def build(client, **attached):
+        stores = {name: attached.pop(name, None) or create_state_store(name, 'memory')
+                  for name in ('user_states', 'orders', 'customers')}
+        bot = WhatsAppOrderBot(client=client, payment_sessions=attached.pop('payment_sessions', None), **stores)
+        for name, value in attached.items():
+            setattr(bot, name, value)
+        return bot
+
+    return build
+
+
+def pytest_sessionfinish(session, exitstatus):
+    """Drain the bot's workers while pytest still owns stdout (atexit would log to a closed stream)"""
+    chatbot = sys.modules.get('Chatbot')
+    if chatbot is not None:
+        atexit.unregister(chatbot.shutdown_dispatcher)
+        chatbot.shutdown_dispatcher()
@@ -0,0 +1,119 @@
+"""Campaigns shared by several workers: one runs each campaign, every worker can pause it"""
+import threading
+import time
+from collections import Counter
+
+import pytest
+
+from campaigns import CampaignManager, COMPLETED, PAUSED, RUNNING, SENT
+from phones import PhoneNormalizer
+from state_store import create_state_store
+
+RECIPIENTS = [f"98765{i:05d}" for i in range(40)]
+
+
+class FakeBot:
+    """The parts of WhatsAppOrderBot a campaign uses"""
+
+    def __init__(self, delay=0.0):
+        self.phones = PhoneNormalizer(1024)
+        self.customers = create_state_store('customers', 'memory')
+        self.delay = delay
+        self.sent = Counter()
+        self.lock = threading.Lock()
+
+    def send_whatsapp_message(self, phone_number, message):
+        time.sleep(self.delay)
+        with self.lock:
+            self.sent[phone_number] += 1
+        return True
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+@pytest.fixture
+def stores():
+    return create_state_store('campaigns', 'memory'), create_state_store('campaign_markers', 'memory')
+
+
+@pytest.fixture
+def workers(stores):
+    """Build managers that share the stores, as gunicorn workers do"""
+    managers = []
+
+    def build(bot, **options):
+        options = dict(dict(workers=2, rate=1000, checkpoint_interval=0.05, lease_ttl=5.0), **options)
+        manager = CampaignManager(bot, *stores, **options)
+        managers.append(manager)
+        return manager
+
+    yield build
+    for manager in managers:
+        manager.shutdown(timeout=2)
+
+
+def status(manager, campaign_id):
+    return manager.store.get(campaign_id)['status']
+
+
+def test_one_worker_runs_each_campaign(workers):
+    bot = FakeBot(delay=0.002)
+    first, second = workers(bot), workers(bot)
+    record = first.create(RECIPIENTS, message='Special today')
+
+    assert second.resume_incomplete() == 0
+    assert wait_for(lambda: status(first, record['id']) == COMPLETED)
+    assert set(bot.sent.values()) == {1} and len(bot.sent) == len(RECIPIENTS)
+    done = first.store.get(record['id'])
+    assert (done['sent'], done['failed'], done['skipped']) == (len(RECIPIENTS), 0, 0)
+    # The finished run let go of its lease
+    assert first.markers.get(first._lease(record['id'])) is None
+
+
+def test_pause_through_another_worker_stops_the_owner(workers):
+    bot = FakeBot(delay=0.01)
+    owner, other = workers(bot, workers=1), workers(bot)
+    record = owner.create(RECIPIENTS, message='Special today')
+    assert wait_for(lambda: sum(bot.sent.values()) >= 3)
+
+    other.pause(record['id'])
+    # The owner notices at its next checkpoint and lets go of the lease once its last send finished
+    assert wait_for(lambda: owner.markers.get(owner._lease(record['id'])) is None)
+    sent = sum(bot.sent.values())
+    time.sleep(0.1)
+    assert sum(bot.sent.values()) == sent < len(RECIPIENTS)
+    paused = owner.store.get(record['id'])
+    assert paused['status'] == PAUSED
+    # Checkpointed counts come from the markers, not from one process's counters
+    assert paused['sent'] == sent
+
+    other.resume(record['id'])
+    assert wait_for(lambda: status(other, record['id']) == COMPLETED)
+    assert set(bot.sent.values()) == {1} and len(bot.sent) == len(RECIPIENTS)
+
+
+def test_campaign_of_a_stopped_worker_is_taken_over(workers, stores):
+    store, markers = stores
+    bot = FakeBot()
+    survivor = workers(bot)
+    phones = survivor.dedupe(RECIPIENTS)
+    store.set('c1', {'id': 'c1', 'name': 'c1', 'message': 'hi', 'recipients': phones, 'total': len(phones),
+                     'status': RUNNING, 'sent': 0, 'failed': 0, 'skipped': 0})
+    # A worker that died mid-campaign: its lease is still live, and it had sent to the first five
+    markers.set(survivor._lease('c1'), {'owner': 'dead-worker'}, ttl=0.2)
+    for phone in phones[:5]:
+        markers.set(survivor._marker('c1', phone), {'status': SENT})
+
+    assert survivor.resume_incomplete() == 0
+    time.sleep(0.25)
+    assert survivor.resume_incomplete() == 1
+    assert wait_for(lambda: store.get('c1')['status'] == COMPLETED)
+    assert len(bot.sent) == len(phones) - 5
+    assert store.get('c1')['sent'] == len(phones)
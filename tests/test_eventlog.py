@@ -0,0 +1,129 @@
+"""Event log: only what reached the disk is acknowledged, projected and replayed"""
+import glob
+import os
+import threading
+
+import eventlog
+from eventlog import ORDER_RECEIVED, PAYMENT_COMPLETED, SESSION_CREATED, EventLog, OrderProjection
+from state_machine import AWAITING_CONFIRMATION, PAYMENT_PENDING
+
+TTLS = {AWAITING_CONFIRMATION: 3600, PAYMENT_PENDING: 3600, 'completed': 3600}
+PHONE = '919876543210'
+
+
+def open_log(directory, **options):
+    log = EventLog(str(directory), OrderProjection(TTLS), **options)
+    log.replay()
+    log.start()
+    return log
+
+
+def received(log, phone, ref):
+    return log.append(ORDER_RECEIVED, phone, {'order_ref': ref, 'order': {'name': 'A'}, 'whatsapp_phone': phone})
+
+
+def crash(log):
+    """Stop the writer without the final snapshot"""
+    log.queue.put(EventLog._STOP)
+    log.writer.join()
+    log.segment.close()
+    log._lock_file.close()
+
+
+def test_replay_after_a_crash_matches_the_projection(tmp_path):
+    log = open_log(tmp_path, snapshot_every=3)
+    for i in range(10):
+        phone = f"9198765{i:05d}"
+        assert received(log, phone, f"{phone}-1")
+        assert log.append(SESSION_CREATED, f"S{i}", {'session': {'phone': phone, 'status': 'pending'}})
+    assert log.append(PAYMENT_COMPLETED, 'S0', {'order_id': 'ORD0', 'phone': '919876500000'})
+    expected = log.projection.dump()
+    crash(log)
+
+    replayed = EventLog(str(tmp_path), OrderProjection(TTLS))
+    replayed.replay()
+    assert replayed.seq == 21
+    assert replayed.projection.dump() == expected
+    replayed._lock_file.close()
+
+
+def test_failed_write_is_not_acknowledged_projected_or_replayed(tmp_path, monkeypatch):
+    log = open_log(tmp_path)
+    assert received(log, PHONE, 'ref-1')
+
+    def broken_fsync(fd):
+        raise OSError(28, 'No space left on device')
+
+    monkeypatch.setattr(eventlog.os, 'fsync', broken_fsync)
+    # Told right away, not after the append timeout
+    assert received(log, '919800000000', 'ref-2') is False
+    assert '919800000000' not in log.projection.collections['user_states']
+    assert log.seq == 1
+
+    monkeypatch.undo()
+    assert received(log, '919811111111', 'ref-3')
+    assert log.seq == 2
+    crash(log)
+
+    replayed = EventLog(str(tmp_path), OrderProjection(TTLS))
+    replayed.replay()
+    assert sorted(replayed.projection.collections['user_states']) == ['919811111111', PHONE]
+    assert replayed.seq == 2
+    replayed._lock_file.close()
+
+
+def test_close_skips_the_snapshot_while_the_writer_is_busy(tmp_path, monkeypatch):
+    log = open_log(tmp_path)
+    entered, release = threading.Event(), threading.Event()
+    fsync = os.fsync
+
+    def slow_fsync(fd):
+        entered.set()
+        release.wait(5)
+        fsync(fd)
+
+    monkeypatch.setattr(eventlog.os, 'fsync', slow_fsync)
+    log.append(ORDER_RECEIVED, PHONE, {'order_ref': 'ref-1', 'order': {}}, wait=False)
+    assert entered.wait(5)
+    log.close(timeout=0.05)
+    assert glob.glob(os.path.join(str(tmp_path), 'snapshot-*')) == []
+
+    release.set()
+    log.writer.join(5)
+    assert not log.writer.is_alive() and log.seq == 1
+
+
+def test_tenant_bots_share_the_log_under_their_namespace(tmp_path, fake_client, make_bot):
+    from Chatbot import WhatsAppOrderBot
+    from tenants import Tenant
+
+    outlet = Tenant('outlet7', '200', 't', 'https://example.com', 'https://pay0.shop/paylink?amt=', namespace='outlet7')
+    order = {'name': 'Asha', 'phone': PHONE, 'foodItems': 'Paneer Tikka', 'quantity': 2, 'total': 450}
+    log = open_log(tmp_path)
+    default = make_bot(fake_client, events=log)
+    tenant = WhatsAppOrderBot(client=fake_client, tenant=outlet)
+    tenant.events = log
+
+    # The same customer orders from both restaurants; only the outlet's order is confirmed
+    assert default.send_order_confirmation(order)
+    assert tenant.send_order_confirmation(order)
+    assert tenant.handle_button_response(PHONE, 'btn_2')
+    assert PHONE in log.projection.collections['user_states']
+    assert f"outlet7:{PHONE}" in log.projection.collections['user_states']
+
+    # Restarted bots each take back only their own records, under their own keys
+    restored_default = make_bot(fake_client)
+    restored_tenant = WhatsAppOrderBot(client=fake_client, tenant=outlet)
+    assert restored_default.restore(log.projection) == 2
+    assert restored_tenant.restore(log.projection) == 2
+    log.close()
+
+    state = restored_default.user_states.get(PHONE)
+    assert state.stage == AWAITING_CONFIRMATION
+    assert restored_default.orders.get(state.order_ref)['name'] == 'Asha'
+    assert restored_default.payment_sessions.keys() == []
+
+    state = restored_tenant.user_states.get(PHONE)
+    assert state.stage == PAYMENT_PENDING and state.order_ref is None
+    assert restored_tenant.payment_sessions.get(state.session_id)['status'] == 'pending'
+    assert state.session_id == tenant.user_states.get(PHONE).session_id
@@ -0,0 +1,53 @@
+"""Intent matching on real customer messages"""
+import pytest
+
+from intents import IntentMatcher
+
+# (message, stage, expected intent)
+CORPUS = [
+    ('hi', None, 'greeting'),
+    ('Hello there', None, 'greeting'),
+    ('hey!', None, 'greeting'),
+    ('hy', None, 'greeting'),
+    ('this is great', None, None),
+    ('which one', None, None),
+    ('show me the menu', None, 'menu'),
+    ('menu please, hi', None, 'greeting'),
+    ('order status?', None, 'status'),
+    ('where is my order', None, 'status'),
+    ('orders', None, None),
+    ('i need help', None, 'help'),
+    ('customer support', None, 'help'),
+    ('thanks', None, None),
+    ('1', 'awaiting_confirmation', 'edit'),
+    ('2', 'awaiting_confirmation', 'confirm'),
+    ('edit', 'awaiting_confirmation', 'edit'),
+    ('Confirm', 'awaiting_confirmation', 'confirm'),
+    ('I want 10 pizzas', 'awaiting_confirmation', None),
+    ('call me at 12 tomorrow', 'awaiting_confirmation', None),
+    ('confirm my order', 'awaiting_confirmation', 'confirm'),
+    ('2', None, None),
+    ('hi', 'awaiting_confirmation', 'greeting'),
+    ('edit', 'payment_pending', None),
+]
+
+
+@pytest.fixture(scope='module')
+def matcher():
+    return IntentMatcher()
+
+
+@pytest.mark.parametrize('text, stage, expected', CORPUS)
+def test_corpus(matcher, text, stage, expected):
+    assert matcher.match(text, stage) == expected
+
+
+def test_shared_keyword_goes_to_earlier_intent():
+    matcher = IntentMatcher({'status': ['order'], 'help': ['order', 'help']}, {})
+    assert matcher.match('order') == 'status'
+    assert matcher.match('help') == 'help'
+
+
+def test_multi_word_keyword_rejected():
+    with pytest.raises(ValueError):
+        IntentMatcher({'menu': ['the menu']}, {})
@@ -0,0 +1,49 @@
+"""Interactive messages the API keeps failing go straight to their text fallback"""
+from conftest import FakeResponse
+from resilience import CapabilityCache
+
+PHONE = '919876543210'
+REJECTED = FakeResponse(400, {'error': {'code': 131009, 'message': 'Parameter value is not valid'}})
+UNAVAILABLE = FakeResponse(503, {'error': {'code': 2, 'message': 'Service temporarily unavailable'}})
+
+
+def replying(status_by_kind):
+    return lambda kind: status_by_kind.get(kind) or FakeResponse()
+
+
+def test_type_rejection_switches_to_text_at_once(fake_client, make_bot):
+    bot = make_bot(fake_client)
+    fake_client.respond = replying({'cta_url': REJECTED})
+    bot.send_static_cta(PHONE, 'menu')
+    bot.send_static_cta(PHONE, 'menu')
+    assert fake_client.kinds() == ['cta_url', 'text', 'text']
+
+
+def test_server_errors_in_a_row_switch_to_text(fake_client, make_bot):
+    bot = make_bot(fake_client, capabilities=CapabilityCache(ttl=300, server_error_limit=3))
+    fake_client.respond = replying({'cta_url': UNAVAILABLE})
+    for _ in range(4):
+        assert bot.send_static_cta(PHONE, 'menu')
+    # Three doomed round trips, then the text right away
+    assert fake_client.kinds() == ['cta_url', 'text'] * 3 + ['text']
+    assert 'cta_url' in bot.capabilities.snapshot()['failing']
+
+
+def test_success_resets_the_server_error_streak(fake_client, make_bot):
+    bot = make_bot(fake_client, capabilities=CapabilityCache(ttl=300, server_error_limit=3))
+    responses = iter([UNAVAILABLE, UNAVAILABLE, FakeResponse(), UNAVAILABLE, UNAVAILABLE])
+    fake_client.respond = lambda kind: next(responses) if kind == 'cta_url' else FakeResponse()
+    for _ in range(5):
+        bot.send_static_cta(PHONE, 'menu')
+    assert bot.capabilities.snapshot()['failing'] == {}
+    assert bot.capabilities.snapshot()['server_error_streaks'] == {'cta_url': 2}
+
+
+def test_server_errors_of_one_type_leave_the_others_alone(fake_client, make_bot):
+    bot = make_bot(fake_client, capabilities=CapabilityCache(ttl=300, server_error_limit=2))
+    fake_client.respond = replying({'button': UNAVAILABLE})
+    for _ in range(2):
+        bot.send_interactive_buttons(PHONE, 'Confirm?', ['Edit Order', 'Confirm Order'])
+    bot.send_static_cta(PHONE, 'menu')
+    assert bot.capabilities.failing('button') and not bot.capabilities.failing('cta_url')
+    assert fake_client.kinds()[-1] == 'cta_url'
@@ -0,0 +1,98 @@
+"""Menu catalog: paged list messages built once per menu version"""
+import json
+import os
+
+import pytest
+
+from menu_catalog import LIST_ROWS, FileSource, MenuCatalog, parse_csv
+
+TO = '919876543210'
+ORDER_URL = 'https://example.com/order'
+MENU = {'sections': [
+    {'title': 'Pizzas', 'items': [{'name': f'Pizza {i}', 'price': 199 + i * 50} for i in range(12)]},
+    {'title': 'Drinks', 'items': [{'name': 'Cola', 'price': 49.0, 'description': 'Chilled, 300 ml'}]}
+]}
+
+
+class StaticSource:
+    def __init__(self, sections):
+        self.sections = sections
+
+    def fetch(self):
+        return self.sections
+
+
+def write(path, data):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(data if isinstance(data, str) else json.dumps(data))
+    # Every write is a new version for the mtime check, however fast the test runs
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+
+@pytest.fixture
+def menu_file(tmp_path):
+    path = str(tmp_path / 'menu.json')
+    write(path, MENU)
+    return path
+
+
+def rows(template):
+    page = json.loads(template.render(to=TO))
+    return [row for section in page['interactive']['action']['sections'] for row in section['rows']]
+
+
+def test_pages_hold_ten_rows_and_link_to_the_next(menu_file):
+    menu = MenuCatalog(FileSource(menu_file), ORDER_URL, refresh_interval=0).start().current()
+    assert len(menu) == 13 and len(menu.pages) == 2
+
+    first = rows(menu.page(1))
+    assert len(first) == LIST_ROWS
+    assert first[-1]['id'] == 'menu_page_2' and first[-1]['description'] == 'Page 2 of 2'
+    assert [row['id'] for row in rows(menu.page(2))] == ['menu_item_pizza-9', 'menu_item_pizza-10',
+                                                         'menu_item_pizza-11', 'menu_item_cola']
+    assert rows(menu.page(2))[-1]['description'] == '₹49 · Chilled, 300 ml'
+    assert menu.page(3) is None
+
+
+def test_item_detail_and_plain_text_fallback(menu_file):
+    menu = MenuCatalog(FileSource(menu_file), ORDER_URL, refresh_interval=0).start().current()
+    cola = menu.item('menu_item_cola')
+    body = json.loads(cola.render(to=TO))['interactive']
+    assert body['body']['text'] == '🍽 Cola\n💰 ₹49\n\nChilled, 300 ml'
+    assert body['action']['parameters'] == {'display_text': 'Order Now', 'url': ORDER_URL}
+    assert cola.fallback.endswith(f"🌐 Order Now: {ORDER_URL}")
+    assert '• Cola – ₹49' in menu.fallback and menu.fallback.endswith(f"🌐 Order: {ORDER_URL}")
+
+
+def test_refresh_rebuilds_only_when_the_menu_changed(menu_file):
+    catalog = MenuCatalog(FileSource(menu_file), ORDER_URL, refresh_interval=0).start()
+    first = catalog.current()
+    # Same mtime: the file is not even read
+    assert catalog.refresh() is False
+    # Rewritten with the same content: read, but the version is kept
+    write(menu_file, MENU)
+    assert catalog.refresh() is False and catalog.current() is first
+
+    write(menu_file, {'items': [{'name': 'Dosa', 'price': 120}]})
+    assert catalog.refresh() is True
+    assert len(catalog.current()) == 1 and catalog.current().digest != first.digest
+    assert catalog.snapshot()['loaded'] == 2 and catalog.snapshot()['unchanged'] == 2
+
+
+def test_broken_menu_keeps_the_current_version(menu_file):
+    catalog = MenuCatalog(FileSource(menu_file), ORDER_URL, refresh_interval=0).start()
+    version = catalog.current()
+    write(menu_file, '{not json')
+    assert catalog.refresh() is False
+    assert catalog.current() is version and catalog.snapshot()['errors'] == 1
+
+
+def test_csv_rows_hide_unavailable_items_and_keep_ids_unique():
+    sections = parse_csv('Name,Price,Category,Available\nDosa,120,South,yes\nIdli,60,South,no\nDosa,150,Specials,\n')
+    assert [(title, [item['name'] for item in items]) for title, items in sections] == \
+        [('South', ['Dosa']), ('Specials', ['Dosa'])]
+
+    catalog = MenuCatalog(StaticSource(sections), ORDER_URL)
+    assert catalog.refresh()
+    assert sorted(catalog.current().items) == ['menu_item_dosa', 'menu_item_dosa-2']
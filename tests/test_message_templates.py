@@ -0,0 +1,63 @@
+"""Pre-serialized payload templates render the same JSON the hand-built payloads did"""
+import json
+
+import pytest
+
+from message_templates import PayloadTemplate, Slot, TemplateRegistry, orjson
+
+HELP = "🆘 Support\n\n📞 Call: +91-9327256068\n🕒 Hours: 9 AM - 11 PM\n\nCommands:\n• 'hi' - Place order"
+ORDER = 'Order "Asha" \\ 2x Margherita\n💰 Total: ₹499\n\nPlease confirm your order:'
+TO = '919876543210'
+URL = 'https://example.com/menu?a=1&b="2"'
+
+
+@pytest.fixture(params=['json', 'orjson'])
+def registry(request):
+    if request.param == 'orjson' and orjson is None:
+        pytest.skip('orjson is not installed')
+    return TemplateRegistry(request.param)
+
+
+def interactive(kind, body, action):
+    return {"messaging_product": "whatsapp", "to": TO, "type": "interactive",
+            "interactive": {"type": kind, "body": {"text": body}, "action": action}}
+
+
+def test_text(registry):
+    registry.text('help', HELP)
+    registry.text('text')
+    expected = {"messaging_product": "whatsapp", "to": TO, "type": "text", "text": {"body": HELP}}
+    assert json.loads(registry.render('help', to=TO)) == expected
+    assert json.loads(registry.render('text', to=TO, body=HELP)) == expected
+
+
+def test_cta(registry):
+    registry.cta('menu', HELP, 'View Menu', URL)
+    registry.cta('cta')
+    expected = interactive('cta_url', HELP, {"name": "cta_url",
+                                             "parameters": {"display_text": "View Menu", "url": URL}})
+    assert json.loads(registry.render('menu', to=TO)) == expected
+    assert json.loads(registry.render('cta', to=TO, body=HELP, display_text='View Menu', url=URL)) == expected
+    assert registry['menu'].fallback == f"{HELP}\n\n🌐 View Menu: {URL}"
+    assert registry['cta'].fallback is None
+
+
+def test_buttons_are_built_once_per_title_set(registry):
+    titles = ['Edit Order', 'Confirm Order', 'A title longer than twenty']
+    template = registry.buttons(titles)
+    assert registry.buttons(tuple(titles)) is template
+    expected = interactive('button', ORDER, {"buttons": [
+        {"type": "reply", "reply": {"id": f"btn_{i}", "title": title[:20]}} for i, title in enumerate(titles, 1)
+    ]})
+    assert json.loads(template.render(to=TO, body=ORDER)) == expected
+
+
+def test_non_string_slot_values_use_the_encoder(registry):
+    template = PayloadTemplate('value', {"to": Slot('to'), "value": Slot('value')}, registry.encoder)
+    assert json.loads(template.render(to=TO, value={'n': 1, 'items': ['₹', None]})) == \
+        {"to": TO, "value": {'n': 1, 'items': ['₹', None]}}
+
+
+def test_repeated_slot_rejected():
+    with pytest.raises(ValueError):
+        PayloadTemplate('twice', {"a": Slot('to'), "b": Slot('to')})
@@ -0,0 +1,123 @@
+"""Order sink: batched, ordered export that survives failures and hands rows over between workers"""
+import pytest
+
+from order_sink import LEASE_PREFIX, MemoryBackend, OrderSink, order_row
+from resilience import RetryPolicy
+from state_store import create_state_store
+
+# Long enough that nothing is flushed on a timer while a test runs
+NEVER = 3600
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def open_store(request, tmp_path):
+    """Store factory; every call is another worker's view of the same rows"""
+    shared = create_state_store('order_sink', 'memory')
+
+    def open_store():
+        if request.param == 'memory':
+            return shared
+        return create_state_store('order_sink', 'sqlite', sqlite_path=str(tmp_path / 'sink.db'))
+
+    return open_store
+
+
+def start_sink(store, **options):
+    options.setdefault('flush_interval', NEVER)
+    options.setdefault('retry', RetryPolicy(attempts=3, base_delay=0.01, max_delay=0.01))
+    return OrderSink(options.pop('backend', MemoryBackend()), store, **options)
+
+
+def add(sink, session_id):
+    sink.add(session_id, order_row(session_id, {'phone': '919876543210', 'order_data': {'name': 'A', 'total': 99}}))
+
+
+def queued(store):
+    return sorted(key for key in store.keys() if not key.startswith(LEASE_PREFIX))
+
+
+def test_orders_go_out_in_full_batches_in_order(open_store):
+    store = open_store()
+    sink = start_sink(store, batch_size=10)
+    for i in range(25):
+        add(sink, f"s{i}")
+    sink.shutdown()
+
+    assert [row['session_id'] for row in sink.backend.rows] == [f"s{i}" for i in range(25)]
+    assert sink.backend.batches == 3
+    assert 'owner' not in sink.backend.rows[0] and 'queued_at' not in sink.backend.rows[0]
+    assert queued(store) == []
+    assert not any(key.startswith(LEASE_PREFIX) for key in store.keys())
+
+
+def test_flush_is_due_after_the_interval_or_a_full_batch(open_store):
+    sink = start_sink(open_store(), batch_size=3, flush_interval=60)
+    assert sink._due() is None
+    add(sink, 'single')
+    assert 59 < sink._due() <= 60
+    sink.pending['single']['queued_at'] -= 60
+    assert sink._due() == 0
+
+    sink.pending['single']['queued_at'] += 60
+    add(sink, 'second')
+    add(sink, 'third')
+    assert sink._due() == 0
+    sink.shutdown()
+
+
+def test_failed_batch_stays_queued(open_store):
+    store = open_store()
+    backend = MemoryBackend()
+    backend.fail_next = 1
+    sink = start_sink(store, backend=backend)
+    add(sink, 's1')
+    add(sink, 's2')
+
+    assert sink.flush(sink._next_batch()) is False
+    assert sink.snapshot()['failures'] == 1
+    assert queued(store) == ['s1', 's2']
+    sink.shutdown()
+    assert [row['session_id'] for row in backend.rows] == ['s1', 's2']
+
+
+def test_rows_left_at_shutdown_go_to_the_next_worker(open_store):
+    backend = MemoryBackend()
+    backend.fail_next = 1
+    sink = start_sink(open_store(), backend=backend)
+    add(sink, 'left')
+    # The backend fails while shutting down: the row stays in the store, the lease goes
+    sink.shutdown()
+    assert backend.rows == [] and queued(open_store()) == ['left']
+
+    resumed = start_sink(open_store())
+    resumed.shutdown()
+    assert [row['session_id'] for row in resumed.backend.rows] == ['left']
+    assert resumed.snapshot()['adopted'] == 1
+    assert queued(open_store()) == []
+
+
+def test_live_workers_rows_are_taken_over_only_after_its_lease_is_gone(open_store):
+    owner = start_sink(open_store())
+    add(owner, 'mine')
+    sibling = start_sink(open_store())
+    assert sibling._adopt() == 0 and sibling.pending == {}
+
+    # The owner stops renewing without flushing (a crash), and its lease runs out
+    owner.stop.set()
+    owner.lease_thread.join()
+    open_store().delete(LEASE_PREFIX + owner.owner)
+
+    assert sibling._adopt() == 1
+    # Claimed once: a second look (or a third worker) finds nothing to take
+    assert sibling._adopt() == 0
+    third = start_sink(open_store())
+    assert third._adopt() == 0
+    third.shutdown()
+    sibling.shutdown()
+    assert [row['session_id'] for row in sibling.backend.rows] == ['mine']
+    assert owner.backend.rows == []
+
+    owner.pending.clear()
+    owner.stopping = True
+    owner.wake.set()
+    owner.thread.join()
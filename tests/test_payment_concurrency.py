@@ -0,0 +1,83 @@
+"""Concurrent payment callbacks for one session confirm and export the order once"""
+import threading
+import time
+
+import pytest
+
+from order_sink import MemoryBackend, OrderSink
+from state_store import create_state_store
+
+CALLBACKS = 16
+
+
+@pytest.fixture
+def sink():
+    sink = OrderSink(MemoryBackend(), create_state_store('order_sink', 'memory'), batch_size=10,
+                     flush_interval=0.05)
+    yield sink
+    sink.shutdown()
+
+
+def start_session(bot):
+    session_id, _ = bot.generate_payment_session('919876543210', {
+        'name': 'Asha', 'foodItems': 'Paneer Tikka', 'quantity': 2, 'total': 450
+    })
+    return session_id
+
+
+def run_callbacks(targets, session_id):
+    barrier = threading.Barrier(len(targets))
+    results = []
+
+    def callback(bot):
+        barrier.wait()
+        results.append(bot.process_payment_success(session_id))
+
+    threads = [threading.Thread(target=callback, args=(bot,)) for bot in targets]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+    return results
+
+
+def confirmations(client):
+    return [sent for sent in client.sent if 'Payment Received' in sent[2]]
+
+
+def test_concurrent_callbacks_confirm_once(sink, fake_client, make_bot):
+    bot = make_bot(fake_client, order_sink=sink)
+    session_id = start_session(bot)
+
+    results = run_callbacks([bot] * CALLBACKS, session_id)
+    sink.shutdown()
+
+    assert results == [True] * CALLBACKS
+    assert len(confirmations(fake_client)) == 1
+    assert [row['session_id'] for row in sink.backend.rows] == [session_id]
+    assert bot.payment_sessions.get(session_id)['status'] == 'completed'
+
+
+def test_concurrent_callbacks_across_workers_confirm_once(sink, fake_client, make_bot, monkeypatch):
+    # One bot per worker: separate session locks, shared session store, so only the CAS decides
+    first = make_bot(fake_client, order_sink=sink)
+    workers = [first] + [make_bot(fake_client, order_sink=sink, payment_sessions=first.payment_sessions)
+                         for _ in range(CALLBACKS - 1)]
+    session_id = start_session(first)
+
+    # Every worker reads the session as pending before any of them swaps it
+    store = first.payment_sessions
+    read = store.get
+
+    def slow_get(key, default=None):
+        value = read(key, default)
+        time.sleep(0.05)
+        return value
+
+    monkeypatch.setattr(store, 'get', slow_get)
+    results = run_callbacks(workers, session_id)
+    sink.shutdown()
+
+    assert results == [True] * CALLBACKS
+    assert len(confirmations(fake_client)) == 1
+    assert [row['session_id'] for row in sink.backend.rows] == [session_id]
@@ -0,0 +1,65 @@
+"""Payment QR codes: one per pending session, encoding that session's payment link"""
+import pytest
+
+import Chatbot
+from payment_qr import PaymentQRCache, format_amount
+
+ORDER = {'name': 'Asha', 'foodItems': 'Paneer Tikka', 'quantity': 2, 'total': 450}
+
+
+@pytest.fixture
+def qr_codes():
+    qr_codes = PaymentQRCache(max_entries=4, workers=1)
+    yield qr_codes
+    qr_codes.shutdown()
+
+
+@pytest.mark.parametrize('value, expected', [
+    (299, '299'), ('299.00', '299'), ('249.50', '249.5'), (' 99.999 ', '100'),
+    ('-5', None), (0, None), ('abc', None), ('nan', None), (None, None),
+])
+def test_format_amount(value, expected):
+    assert format_amount(value) == expected
+
+
+def test_cache_shares_renders_and_evicts(qr_codes):
+    first = qr_codes.get('https://pay.example/?amt=1')
+    assert qr_codes.get('https://pay.example/?amt=1') is first
+    assert first.result(timeout=5).startswith(b'\x89PNG')
+    for amount in range(2, 6):
+        qr_codes.get(f'https://pay.example/?amt={amount}')
+    assert qr_codes.get('https://pay.example/?amt=1') is not first
+    assert qr_codes.snapshot()['cached'] == 4
+
+
+def test_qr_encodes_the_session_payment_link(fake_client, make_bot, qr_codes):
+    bot = make_bot(fake_client, qr_codes=qr_codes)
+    session_id, _ = bot.generate_payment_session('919876543210', ORDER)
+
+    future = bot.payment_qr(session_id)
+    assert future.result(timeout=5).startswith(b'\x89PNG')
+    [link] = qr_codes.cache
+    assert link == f"{bot.tenant.payment_link}450&redirect={bot.payment_callback_url(session_id)}"
+
+
+def test_qr_only_for_pending_sessions(fake_client, make_bot, qr_codes):
+    bot = make_bot(fake_client, qr_codes=qr_codes)
+    session_id, _ = bot.generate_payment_session('919876543210', ORDER)
+
+    assert bot.payment_qr(None) is None
+    assert bot.payment_qr('20260101000000unknown') is None
+    bot.process_payment_success(session_id)
+    assert bot.payment_qr(session_id) is None
+    assert qr_codes.snapshot()['misses'] == 0
+
+
+def test_qr_route(monkeypatch, qr_codes):
+    monkeypatch.setattr(Chatbot.bot, 'qr_codes', qr_codes)
+    session_id, _ = Chatbot.bot.generate_payment_session('919876543210', ORDER)
+    client = Chatbot.app.test_client()
+
+    response = client.get(f'/payment/qr?session={session_id}')
+    assert response.status_code == 200 and response.mimetype == 'image/png'
+    assert client.get('/payment/qr?session=nope').status_code == 404
+    assert client.get('/payment/qr?amount=450').status_code == 404
+    Chatbot.bot.payment_sessions.delete(session_id)
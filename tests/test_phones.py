@@ -0,0 +1,53 @@
+"""Phone normalization gives the same numbers the original replace chain did"""
+import pytest
+
+from phones import PhoneNormalizer, is_valid, normalize
+
+# (input, what WhatsAppOrderBot.normalize_phone_number returned before the normalizer)
+FORMATS = [
+    ('+91 98765 43210', '919876543210'),
+    ('098765-43210', '919876543210'),
+    ('(987) 654-3210', '919876543210'),
+    ('919876543210', '919876543210'),
+    ('9198765432', '919198765432'),
+    ('91-98765-43210', '919876543210'),
+    ('  +91 (98765) 43210 ', '919876543210'),
+    ('0091 9876543210', '919876543210'),
+    ('44 20 7946 0958', '91442079460958'),
+    ('+1 (415) 555-0100', '9114155550100'),
+    ('12345', '9112345'),
+    (9876543210, '919876543210'),
+]
+
+
+@pytest.mark.parametrize('phone, expected', FORMATS)
+def test_normalize_matches_the_original(phone, expected):
+    assert normalize(phone) == expected
+    assert PhoneNormalizer().normalize(phone) == expected
+
+
+def test_empty_input_is_none():
+    normalizer = PhoneNormalizer()
+    assert normalizer.normalize('') is None and normalizer.normalize(None) is None
+
+
+def test_is_valid():
+    assert is_valid('919876543210')
+    assert not is_valid('9112345') and not is_valid('91abc45678') and not is_valid('')
+    assert not is_valid('9' * 16)
+
+
+def test_normalize_many_keeps_order_and_reports_rejects():
+    numbers, rejects = PhoneNormalizer().normalize_many(['+91 98765 43210', '', '9876543210', 'abc', '12', '9876500001'])
+    assert numbers == ['919876543210', '919876500001']
+    assert rejects == [(1, '', 'empty'), (2, '9876543210', 'duplicate'), (3, 'abc', 'invalid'), (4, '12', 'invalid')]
+
+    numbers, rejects = PhoneNormalizer().normalize_many(['9876543210', '+91 9876543210'], unique=False)
+    assert numbers == ['919876543210', '919876543210'] and rejects == []
+
+
+def test_repeats_are_served_from_the_cache():
+    normalizer = PhoneNormalizer(cache_size=2)
+    for phone in ['9876543210', '9876543210', '9876500001', '9876543210']:
+        normalizer.normalize(phone)
+    assert normalizer.cache_info() == {'hits': 2, 'misses': 2, 'size': 2, 'max_size': 2}
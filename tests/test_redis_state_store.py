@@ -0,0 +1,151 @@
+"""RedisStateStore against an in-process Redis stand-in (fakeredis)"""
+import threading
+import time
+
+import pytest
+
+from state_store import RedisStateStore
+
+fakeredis = pytest.importorskip('fakeredis')
+
+
+@pytest.fixture
+def server():
+    return fakeredis.FakeServer()
+
+
+def open_store(server, **options):
+    return RedisStateStore(namespace='test', client=fakeredis.FakeRedis(server=server), **options)
+
+
+@pytest.fixture
+def store(server):
+    return open_store(server)
+
+
+def test_records_round_trip_with_native_expiry(store):
+    store.set('a', {'stage': 'x'})
+    store.set('b', {'stage': 'y'}, ttl=60)
+    assert store.get('a') == {'stage': 'x'}
+    assert store.get('missing', 'default') == 'default' and store.get(None) is None
+    assert store.get_many(['a', 'b', 'missing']) == {'a': {'stage': 'x'}, 'b': {'stage': 'y'}}
+    assert store.client.pttl('bot:test:a') == -1
+    assert 59000 < store.client.pttl('bot:test:b') <= 60000
+    assert store.delete('a') and not store.delete('a')
+    assert store.keys() == ['b'] and len(store) == 1
+
+
+def test_index_drops_expired_members_without_scanning_keys(store):
+    expired = []
+    store.on_remove(expired.extend)
+    store.set('live', 1, ttl=60)
+    # A record Redis already expired: its member is still in the index with a past deadline
+    store.client.zadd(store.index_key, {'gone': time.time() - 1})
+
+    assert store.keys() == ['live']
+    assert expired == ['gone'] and store.stats['expired'] == 1
+    assert store.client.zcard(store.index_key) == 1
+
+
+def test_max_entries_evicts_closest_to_expiry(server):
+    store = open_store(server, max_entries=2)
+    evicted = []
+    store.on_remove(evicted.extend)
+    store.set('late', 1, ttl=300)
+    store.set('forever', 2)
+    store.set('soon', 3, ttl=10)
+
+    assert evicted == ['soon'] and store.stats['evicted'] == 1
+    assert store.keys() == ['forever', 'late']
+    assert store.get('soon') is None
+
+
+def test_compare_and_set(store):
+    # A missing record matches None
+    assert store.compare_and_set('k', 'stage', None, {'stage': 'a'}, ttl=60)
+    assert not store.compare_and_set('k', 'stage', None, {'stage': 'b'})
+    assert not store.compare_and_set('k', 'stage', 'b', {'stage': 'c'})
+    assert store.compare_and_set('k', 'stage', 'a', {'stage': 'b'})
+    assert store.get('k') == {'stage': 'b'}
+    # None as the new value deletes the record and its index entry
+    assert store.compare_and_set('k', 'stage', 'b', None)
+    assert store.get('k') is None and store.keys() == []
+
+
+def test_compare_and_set_loses_no_updates_under_contention(server):
+    store = open_store(server)
+    store.set('counter', {'n': 0})
+
+    def increment():
+        for _ in range(25):
+            # Each worker has its own connection, as separate processes would
+            mine = open_store(server)
+            while True:
+                n = mine.get('counter')['n']
+                if mine.compare_and_set('counter', 'n', n, {'n': n + 1}):
+                    break
+
+    threads = [threading.Thread(target=increment) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=30)
+    assert store.get('counter') == {'n': 100}
+
+
+def test_watch_conflict_is_retried_on_the_new_value(server, store):
+    other = open_store(server)
+    store.set('k', {'stage': 'a', 'n': 0})
+    seen = []
+
+    def bump(current, pttl):
+        seen.append(current['n'])
+        if len(seen) == 1:
+            # Another writer commits between WATCH and EXEC
+            other.set('k', {'stage': 'a', 'n': 1})
+        return True, dict(current, n=current['n'] + 10), None, True
+
+    assert store._optimistic('k', bump)
+    assert seen == [0, 1]
+    assert store.get('k') == {'stage': 'a', 'n': 11}
+
+
+def test_endless_contention_gives_up(server):
+    store = open_store(server, max_retries=3)
+    other = open_store(server)
+    store.set('k', {'n': 0})
+
+    def always_beaten(current, pttl):
+        other.set('k', {'n': current['n'] + 1})
+        return True, current, None, True
+
+    with pytest.raises(RuntimeError, match='contention'):
+        store._optimistic('k', always_beaten)
+
+
+def test_patch_merges_and_keeps_the_remaining_ttl(store):
+    assert store.patch('missing', {'status': 'x'}) is None
+    assert store.get('missing') is None
+
+    store.set('s', {'status': 'pending', 'phone': '91'}, ttl=120)
+    assert store.patch('s', {'status': 'completed'}) == {'status': 'completed', 'phone': '91'}
+    assert store.get('s') == {'status': 'completed', 'phone': '91'}
+    assert 110000 < store.client.pttl('bot:test:s') <= 120000
+    assert store.client.zscore(store.index_key, 's') > time.time() + 110
+
+    store.patch('s', {'status': 'archived'}, ttl=600)
+    assert 590000 < store.client.pttl('bot:test:s') <= 600000
+
+
+def test_scan_pages_through_live_keys(store):
+    for i in range(30):
+        store.set(f"k{i:02d}", i, ttl=60)
+    store.client.zadd(store.index_key, {'gone': time.time() - 1})
+
+    found, cursor = {}, None
+    while True:
+        page, cursor = store.scan(cursor, limit=7)
+        found.update(page)
+        if cursor is None:
+            break
+    assert found == {f"k{i:02d}": i for i in range(30)}
@@ -0,0 +1,53 @@
+"""Conversation transitions commit with a compare-and-set on the record they read"""
+import pytest
+
+from state_machine import (
+    ANY, AWAITING_CONFIRMATION, CONFIRM, ORDER_RECEIVED, PAYMENT_PENDING, USER_STATE_CODEC,
+    ConversationMachine, UserState
+)
+from state_store import create_state_store
+
+PHONE = '919876543210'
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def machine(request, tmp_path):
+    store = create_state_store('user_states', request.param, sqlite_path=str(tmp_path / 'state.db'),
+                               codec=USER_STATE_CODEC)
+    return ConversationMachine(owner=None, store=store)
+
+
+def order(machine, order_ref):
+    return machine.replace(PHONE, machine.table[(ANY, ORDER_RECEIVED)], order_ref=order_ref)
+
+
+def test_advance_from_the_record_read(machine):
+    order(machine, 'ref-1')
+    state = machine.store.get(PHONE)
+    confirm = machine.table[(AWAITING_CONFIRMATION, CONFIRM)]
+
+    advanced = machine.advance(PHONE, state, confirm, session_id='s1')
+    assert advanced.stage == PAYMENT_PENDING
+    # The same read can not be used twice
+    assert machine.advance(PHONE, state, confirm, session_id='s2') is None
+    assert machine.store.get(PHONE).session_id == 's1'
+
+
+def test_order_replaced_in_the_same_stage_is_not_advanced(machine):
+    order(machine, 'ref-1')
+    stale = machine.store.get(PHONE)
+    # A new sheet order lands between the confirm reading the state and committing it
+    order(machine, 'ref-2')
+    confirm = machine.table[(AWAITING_CONFIRMATION, CONFIRM)]
+
+    assert machine.advance(PHONE, stale, confirm, session_id='s1') is None
+    current = machine.store.get(PHONE)
+    assert (current.stage, current.order_ref) == (AWAITING_CONFIRMATION, 'ref-2')
+    assert machine.advance(PHONE, current, confirm, session_id='s2').session_id == 's2'
+
+
+def test_version():
+    first, second = UserState(AWAITING_CONFIRMATION, order_ref='a'), UserState(AWAITING_CONFIRMATION, order_ref='b')
+    assert first.version != second.version
+    stored = UserState.from_record(UserState(PAYMENT_PENDING, session_id='s').to_record())
+    assert stored.version == (PAYMENT_PENDING, None, 's')
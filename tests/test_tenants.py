@@ -0,0 +1,122 @@
+"""Tenant routing by phone_number_id and hot reload of the tenants file"""
+import json
+
+import pytest
+
+from tenants import DEFAULT_TENANT, Tenant, TenantRouter, parse_tenants
+
+
+class TenantBot:
+    """What the router needs of a bot: its tenant, plus stores a changed tenant must keep"""
+
+    def __init__(self, tenant, previous=None):
+        self.tenant = tenant
+        self.stores = previous.stores if previous is not None else object()
+
+
+def write(path, data):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(data if isinstance(data, str) else json.dumps(data))
+
+
+@pytest.fixture
+def default():
+    return TenantBot(Tenant(DEFAULT_TENANT, '100', 't', 'https://example.com', 'https://pay0.shop/paylink?amt='))
+
+
+@pytest.fixture
+def tenants_file(tmp_path):
+    path = str(tmp_path / 'tenants.json')
+    write(path, {'tenants': [{'id': f'outlet{i}', 'phone_id': str(200 + i), 'token': f't{i}'} for i in range(50)]})
+    return path
+
+
+def test_single_tenant_answers_every_number(default):
+    router = TenantRouter(default, TenantBot)
+    assert router.for_phone_id('anything') is default
+    assert router.get() is default and router.get('missing') is None
+
+
+def test_routes_by_phone_number_id(default, tenants_file):
+    router = TenantRouter(default, TenantBot, tenants_file, reload_interval=0)
+    assert router.reload() and not router.reload()
+
+    north = router.for_phone_id('207')
+    assert north.tenant.id == 'outlet7' and router.get('outlet7') is north
+    assert north.tenant.namespaced('user_states') == 'outlet7:user_states'
+    assert default.tenant.namespaced('user_states') == 'user_states'
+    # Defaults come from the environment-configured tenant
+    assert north.tenant.website_url == 'https://example.com'
+    assert north.tenant.qr_template == 'https://pay0.shop/paylink?amt={amount}'
+    assert router.for_phone_id('999') is None and router.for_phone_id(None) is default
+    assert len(router.bots()) == 51
+
+
+def test_reload_keeps_the_stores_of_a_changed_tenant(default, tenants_file):
+    retired = []
+    router = TenantRouter(default, TenantBot, tenants_file, reload_interval=0,
+                          retire=lambda old, new: retired.append((old.tenant.id, new)))
+    router.reload()
+    north = router.for_phone_id('207')
+
+    write(tenants_file, [{'id': 'outlet7', 'phone_id': '207', 'token': 'rotated'}])
+    assert router.reload(force=True)
+    assert router.get('outlet7').tenant.token == 'rotated'
+    assert router.for_phone_id('207').stores is north.stores
+    assert router.for_phone_id('208') is None
+    assert len(retired) == 50 and ('outlet8', None) in retired
+
+
+def test_bad_file_keeps_the_running_tenants(default, tenants_file):
+    router = TenantRouter(default, TenantBot, tenants_file, reload_interval=0)
+    router.reload()
+    write(tenants_file, '[{"id": "outlet7"}]')
+    assert not router.reload(force=True)
+    assert router.get('outlet7').tenant.token == 't7'
+    assert router.snapshot()['errors'] == 1
+    # Reported once, not on every check until the file changes
+    assert not router.reload()
+    assert router.snapshot()['errors'] == 1
+
+
+@pytest.mark.parametrize('records, message', [
+    ([{'id': 'a', 'phone_id': '1', 'token': 't'}, {'id': 'a', 'phone_id': '2', 'token': 't'}], 'repeated'),
+    ([{'id': DEFAULT_TENANT, 'phone_id': '1', 'token': 't'}], 'reserved'),
+    ([{'id': 'a/b', 'phone_id': '1', 'token': 't'}], "contains '/'"),
+    ([{'id': 'a', 'phone_id': '100', 'token': 't'}], 'more than one tenant'),
+    ([{'id': 'a', 'phone_id': '1'}], 'needs id, phone_id and token'),
+])
+def test_invalid_records_rejected(default, records, message):
+    with pytest.raises(ValueError, match=message):
+        parse_tenants(records, default.tenant)
+
+
+def test_token_from_the_environment(default, monkeypatch):
+    monkeypatch.setenv('OUTLET_TOKEN', 'secret')
+    tenant, = parse_tenants({'tenants': [{'id': 'a', 'phone_id': 1, 'token_env': 'OUTLET_TOKEN',
+                                          'pool_size': '4', 'qr_template': 'upi://pay?am={amount}'}]}, default.tenant)
+    assert tenant.token == 'secret' and tenant.phone_id == '1' and tenant.pool_size == 4
+    assert tenant.qr_template == 'upi://pay?am={amount}'
+    assert 'token' not in tenant.describe()
+
+
+@pytest.mark.parametrize('data', [
+    {'tenants': ['outlet7']},
+    {'tenants': {'id': 'outlet7'}},
+    [{'id': 'outlet7', 'phone_id': '207', 'token': 't', 'pool_size': None, 'recipient_burst': [1]}],
+    [{'id': 'outlet7', 'phone_id': '207', 'token': 't', 'messages_per_second': 'fast'}],
+    [{'id': 'outlet7', 'phone_id': '207', 'token_env': 7}],
+    [{'id': 'outlet7', 'phone_id': '207', 'token': 't', 'qr_template': ['upi://']}],
+    'outlet7',
+])
+def test_malformed_file_is_reported_not_raised(default, tenants_file, data):
+    router = TenantRouter(default, TenantBot, tenants_file, reload_interval=0).start()
+    write(tenants_file, data)
+    assert not router.reload(force=True)
+    assert router.get('outlet7').tenant.token == 't7'
+    assert router.snapshot()['errors'] == 1
+
+
+def test_null_numbers_fall_back_to_the_defaults(default):
+    tenant, = parse_tenants([{'id': 'a', 'phone_id': '1', 'token': 't', 'pool_size': None}], default.tenant)
+    assert tenant.pool_size == default.tenant.pool_size
@@ -0,0 +1,59 @@
+"""Webhook message ids only stay marked as seen once their jobs are queued"""
+import uuid
+
+import pytest
+
+import Chatbot
+
+
+def payload(*messages):
+    return {'entry': [{'changes': [{'field': 'messages', 'value': {
+        'metadata': {'phone_number_id': '100'}, 'messages': list(messages)
+    }}]}]}
+
+
+def text(message_id, body='hi', sender='919876543210'):
+    message = {'id': message_id, 'type': 'text', 'text': {'body': body}}
+    if sender is not None:
+        message['from'] = sender
+    return message
+
+
+def new_ids(count):
+    return [f"wamid.{uuid.uuid4().hex}" for _ in range(count)]
+
+
+def test_duplicates_are_skipped(fake_client, make_bot):
+    bot = make_bot(fake_client)
+    first, second = new_ids(2)
+    jobs, ids = Chatbot.whatsapp_jobs(payload(text(first), text(second)), lambda phone_id: bot)
+    assert ids == [first, second] and len(jobs) == 2
+
+    jobs, ids = Chatbot.whatsapp_jobs(payload(text(first)), lambda phone_id: bot)
+    assert jobs == [] and ids == []
+
+
+def test_malformed_message_unmarks_the_whole_payload(fake_client, make_bot):
+    bot = make_bot(fake_client)
+    good, bad = new_ids(2)
+    with pytest.raises(KeyError):
+        Chatbot.whatsapp_jobs(payload(text(good), text(bad, sender=None)), lambda phone_id: bot)
+
+    # Meta redelivers the payload: both messages are still new
+    assert Chatbot.seen_messages.first_seen(good)
+    assert Chatbot.seen_messages.first_seen(bad)
+
+
+def test_failed_submit_unmarks_the_messages(fake_client, make_bot, monkeypatch):
+    bot = make_bot(fake_client)
+    ids = new_ids(2)
+    jobs, message_ids = Chatbot.whatsapp_jobs(payload(*[text(message_id) for message_id in ids]),
+                                              lambda phone_id: bot)
+
+    def broken_submit(jobs, label=None):
+        raise RuntimeError('executor shut down')
+
+    monkeypatch.setattr(Chatbot.message_executor, 'submit_batch', broken_submit)
+    with pytest.raises(RuntimeError):
+        Chatbot.queue_whatsapp_jobs(jobs, message_ids)
+    assert all(Chatbot.seen_messages.first_seen(message_id) for message_id in ids)